@@ -1,2 +1,17 @@
-from . import read
-from . import convert
+"""
+Submodules are imported on first access (PEP 562) to keep the package import
+fast and avoid loading the dependencies of the modules which aren't used.
+"""
+import importlib
+
+__all__ = ["read", "convert", "tools"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
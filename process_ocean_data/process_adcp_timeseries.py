@@ -41,14 +41,28 @@ hakai_to_ios_map = {
 }
 
 
-def process_hakai_adcp(raw_file, meta_file, dest_dir):
+def process_hakai_adcp(
+    raw_file, meta_file, dest_dir, chunks=None, complevel=4, output_format="netcdf"
+):
+    """
+    Process a Hakai ADCP deployment to L1 and save it as a Hakai L1 NetCDF file.
+    :param raw_file: raw ADCP file
+    :param meta_file: metadata csv file
+    :param dest_dir: output directory
+    :param chunks: dictionary of chunk size per dimension (ex: {"time": 50000}) used to
+        open the L0 and L1 datasets with dask and process them lazily. The Hakai L1 file
+        is written with the same chunks. Default to load the full datasets in memory.
+    :param complevel: zlib compression level of the Hakai L1 file
+    :param output_format: save the Hakai L1 file as "netcdf" or "zarr"
+    :return: path to the Hakai L1 file
+    """
     # Perform Initial L0 processing on the raw data and export as a netCDF file
     ncname_L0 = ADCP_processing_L0.nc_create_L0(
         f_adcp=raw_file, f_meta=meta_file, dest_dir=dest_dir
     )
 
     # Read Level 0 Data
-    ds = xr.open_dataset(ncname_L0)
+    ds = xr.open_dataset(ncname_L0, chunks=chunks)
 
     # Detect start and end times
     #  CMAGZZ## should have some good data
@@ -107,7 +121,7 @@ def process_hakai_adcp(raw_file, meta_file, dest_dir):
     )
 
     # Read Level 1 dataset and extra steps
-    ds = xr.open_dataset(ncname_L1)
+    ds = xr.open_dataset(ncname_L1, chunks=chunks)
 
     # If deployment is less than a day apply pressure offset
     if (
@@ -129,30 +143,19 @@ def process_hakai_adcp(raw_file, meta_file, dest_dir):
     if "station" in ds.attrs:
         ds["station"] = ds.attrs["station"]
 
-    # Flag Currents values
-    current_flag_variables = ["LCEWAP01_QC", "LCNSAP01_QC", "LRZAAP01_QC"]
-
-    # Flag out of water data
-    for var in current_flag_variables:
-        ds[var] = ds[var].where(ds["depth"] > 0, other=4)
-
-    # Flag side lobe region from surface data
-    side_lobe_coefficient = 1 - np.cos(np.deg2rad(int(ds.attrs["beam_angle"])))
-    side_lobe_depth = ds["PPSAADCP"] * side_lobe_coefficient + ds.attrs["cellSize"]
-    for var in current_flag_variables:
-        # Flag BAD any data above side lobe contaminated region
-        ds[var] = ds[var].where((ds["depth"] > side_lobe_depth), other=4)
-
-        # Flag BAD any data above surface
-        ds[var] = ds[var].where(ds["depth"] > 0, other=4)
-
-        # Flag GOOD any data unflagged yet
-        ds[var] = ds[var].where(ds[var].notnull(), other=1)
+    # Flag out of water and side lobe contaminated currents values
+    ds = process.flag_adcp_surface_and_side_lobe(ds)
 
     # Replace None which is not compatible with xarray
     ds.attrs["_FillValue"] = np.nan
 
-    # Save to a new NetCDF File
-    ncname_L1_hakai = ncname_L1[0:-3] + "_Hakai.nc"
-    ds.to_netcdf(ncname_L1[0:-3] + "_Hakai.nc", mode="w", format="NETCDF4")
+    # Save to a new NetCDF File, flags as int8 and float32 variables where precision
+    # allows, compressed and chunked along time
+    ncname_L1_hakai = ncname_L1[0:-3] + (
+        "_Hakai.zarr" if output_format == "zarr" else "_Hakai.nc"
+    )
+    process.save_dataset(
+        ds, ncname_L1_hakai, output_format, chunks=chunks, complevel=complevel
+    )
     ds.close()
+    return ncname_L1_hakai
@@ -3,8 +3,6 @@ from .tools import google, hakai, process
 from seabird.cnv import fCNV
 from seabird.netcdf import cnv2nc
 
-from ioos_qc.config import NcQcConfig
-
 import xarray as xr
 import netCDF4
 
@@ -13,7 +11,8 @@ from os import path
 
 
 def get_hakai_ctd_log(dest_dir='.',
-                      print_figure=False):
+                      print_figure=False,
+                      figure_queue=None):
     # Hakai CTD Deployment log
     INSTRUMENT_LOG_LINK = \
         "https://docs.google.com/spreadsheets/d/1lkI250zOMJIQ0Z3802QbJHM-dF-zqNxc16AcwxaYCM8/edit?usp=sharing"
@@ -27,7 +26,8 @@ def get_hakai_ctd_log(dest_dir='.',
     #  - Convert lat/long to decimal degrees
     #  - Compute trilateration if available
     #  - Generate standard Hakai File Name
-    df = hakai.transform_hakai_log(df, dest_dir, print_figure=print_figure)
+    df = hakai.transform_hakai_log(df, dest_dir, print_figure=print_figure,
+                                   figure_queue=figure_queue)
     return df
 
 
@@ -43,8 +43,12 @@ def download_raw_data(df, dest_dir='.'):
     return df
 
 
-def process_data(row, dest_dir='.', config=None):
-    """ Apply standard processing method and QAQC to the CTD time series."""
+def process_data(row, dest_dir='.', config=None, max_workers=1, output_format='netcdf'):
+    """ Apply standard processing method and QAQC to the CTD time series.
+    QARTOD tests of the different variables can be run in parallel over max_workers processes
+    (python>=3.8), default to run them sequentially.
+    The L1 file is saved as "netcdf" or "zarr" with int8 flags, float32 variables where
+    precision allows and compressed time chunks (see process.get_output_encoding)."""
     if row['Link to Raw Data'] is None:
         return
 
@@ -56,7 +60,7 @@ def process_data(row, dest_dir='.', config=None):
     # Save to NetCDF
     print('Save to '+row['file_name']+'_L0.nc')
     l0_file = path.join(dest_dir, row['file_name']+'_L0.nc')
-    l1_file = path.join(dest_dir, row['file_name'] + '_L1.nc')
+    l1_file = path.join(dest_dir, row['file_name'] + ('_L1.zarr' if output_format == 'zarr' else '_L1.nc'))
     cnv2nc(c, l0_file)
 
     # Add Metadata to NetCDF
@@ -103,22 +107,16 @@ def process_data(row, dest_dir='.', config=None):
     # Output Cropped time series a L1
     ds = ds.loc[dict(time=slice(start_end_results['first_good_record_time'],
                            start_end_results['last_good_record_time']))]
-    ds.to_netcdf(l1_file)
-    # Run QARTOD on the NetCDF file
+
+    # Run QARTOD on the cropped time series
     # Retrieve Hakai QARTOD Tests
     if not config:
         config = get_ctd_qc_config()
+    config = {var: var_config for var, var_config in config.items() if var in ds}
 
-    # Use deprecated NcQcConfig
-    qc = NcQcConfig(config, tinp='time')
-    qartod_results = qc.run(l1_file)
-
-    # Upload QARTOD Flags to NetCDF
-    qc.save_to_netcdf(l1_file, qartod_results)
-
-    # Move away from the NcQcConfig method temporary (hopefully we'll use the streams method soon.
-    # ds = process.run_qartod(ds, config)
-    # ds.to_netcdf(l1_file)
+    # Each variable tests are run in parallel and the flags are merged back to the dataset
+    ds = process.run_qartod(ds, config, max_workers=max_workers)
+    process.save_dataset(ds, l1_file, output_format)
     return {'l0': l0_file, 'l1': l1_file}
 
 
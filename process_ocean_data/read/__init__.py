@@ -1,6 +1,16 @@
-from . import rbr
-from . import van_essen_instruments
-from . import pme
-from . import onset
-from . import seabird
-from . import utils
\ No newline at end of file
+"""
+Instrument parsers, each submodule is imported on first access (PEP 562).
+"""
+import importlib
+
+__all__ = ["rbr", "van_essen_instruments", "pme", "onset", "seabird", "utils"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -4,7 +4,16 @@ import re
 from datetime import datetime
 from csv import reader
 import logging
-from .utils import test_parsed_dataset
+from io import BytesIO
+from .utils import (
+    get_data_offset,
+    get_file_index,
+    get_time_coverage,
+    get_time_slice_mask,
+    read_time_slice_bytes,
+    test_parsed_dataset,
+    to_arrow,
+)
 
 from dateutil.parser._parser import ParserError
 
@@ -146,13 +155,25 @@ def csv(
     convert_units_to_si: bool = True,
     input_read_csv_kwargs: dict = None,
     standardize_variable_names: bool = True,
+    time_slice: slice = None,
+    index_every: int = 1000,
+    header_only: bool = False,
 ):
 
     """tidbit_csv parses the Onset Tidbit CSV format into a pandas dataframe
 
+    Args:
+        time_slice: slice(start, end) of the time range to read. Only the matching
+            lines are read based on a sidecar index (path + ".index.json")
+            which is generated on the first sliced read.
+        index_every: number of lines between each line indexed
+        header_only: only read the header and the first and last lines of data
+
     Returns:
         df: data in pandas dataframe
         metadata: metadata dictionary
+        or if header_only, the header metadata with the variables and the
+        time_min and time_max of the data
     """
     if input_read_csv_kwargs is None:
         input_read_csv_kwargs = {}
@@ -191,7 +212,39 @@ def csv(
         "usecols": [id for id, name in enumerate(column_names)],
     }
     read_csv_kwargs.update(input_read_csv_kwargs)
-    df = pd.read_csv(path, **read_csv_kwargs)
+
+    time_variable = header["time_variables"][0]
+    time_column = column_names.index(time_variable)
+
+    def get_time(line):
+        line = line.decode(encoding, errors=encoding_errors or "strict")
+        time = list(reader([line]))[0][time_column]
+        return parse_onset_time(time, header["timezone"])
+
+    if header_only:
+        if standardize_variable_names:
+            column_names = list(standardized_variable_mapping(column_names).values())
+            header["instrument_type"] = detect_instrument_type(column_names)
+        time_min, time_max = get_time_coverage(
+            path, get_data_offset(path, header_lines + 1), get_time
+        )
+        return {
+            **header,
+            "variables": column_names,
+            "time_min": time_min,
+            "time_max": time_max,
+        }
+    elif time_slice is None:
+        df = pd.read_csv(path, **read_csv_kwargs)
+    else:
+        index = get_file_index(
+            path, get_data_offset(path, header_lines + 1), get_time, index_every
+        )
+        data = read_time_slice_bytes(path, index, time_slice)
+        read_csv_kwargs.update({"header": None, "memory_map": False})
+        df = pd.read_csv(BytesIO(data), **read_csv_kwargs)
+        df = df.loc[get_time_slice_mask(df[time_variable], time_slice)]
+        df = df.reset_index(drop=True)
 
     # Convert to dataset
     ds = df.to_xarray()
@@ -226,6 +279,8 @@ def csv(
 
     if output == "xarray":
         return ds
+    elif output == "arrow":
+        return to_arrow(ds)
     df = ds.to_dataframe()
     # Include instrument information within the dataframe
     for var in ["instrument_manufacturer", "instrument_type", "instrument_sn"][::-1]:
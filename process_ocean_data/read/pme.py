@@ -10,6 +10,7 @@ from datetime import datetime
 import pandas as pd
 
 from ..convert.oxygen import O2ctoO2s
+from .utils import get_data_offset, get_time_coverage, to_arrow
 
 logger = logging.getLogger(__name__)
 vars_attributes = {
@@ -34,9 +35,16 @@ vars_rename = {
 }
 
 
-def minidot_txt(path, output="xarray"):
+def _get_minidot_time(line):
+    """Retrieve the time of a minidot data line (unix time in seconds)."""
+    return pd.to_datetime(float(line.split(b",")[0]), unit="s", utc=True)
+
+
+def minidot_txt(path, output="xarray", header_only=False):
     """
     minidot_txt parses the txt format provided by the PME Minidot instruments.
+    If header_only, only the header and the first and last lines of data are read
+    and the header metadata with the variables, time_min and time_max is returned.
     """
     # Read MiniDot
     with open(path, "r") as f:
@@ -52,6 +60,23 @@ def minidot_txt(path, output="xarray"):
             warnings.warn("Failed to read: {path}", RuntimeWarning)
             return pd.DataFrame(), None
 
+        if header_only:
+            time_min, time_max = get_time_coverage(
+                path, get_data_offset(path, 3), _get_minidot_time
+            )
+            return {
+                **metadata.groupdict(),
+                "instrument_manufacturer": "PME",
+                "instrument_model": "MiniDot",
+                "instrument_sn": serial_number,
+                "variables": [
+                    vars_rename.get(var.strip(), var.strip())
+                    for var in f.readline().split(",")
+                ],
+                "time_min": time_min,
+                "time_max": time_max,
+            }
+
         # Read the data with pandas
         ds = pd.read_csv(
             f,
@@ -92,9 +117,15 @@ def minidot_txt(path, output="xarray"):
         "history"
     ] += f"\n{datetime.now().isoformat()} Apply variable rename: {vars_rename}"
 
-    # Output
+    return _get_output(ds, output)
+
+
+def _get_output(ds, output):
+    """Convert a parsed dataset to the "xarray", "arrow" or "dataframe" output"""
     if output == "xarray":
         return ds
+    elif output == "arrow":
+        return to_arrow(ds)
     elif output == "dataframe":
         df = ds.to_dataframe()
         add_attributes = [
@@ -107,31 +138,44 @@ def minidot_txt(path, output="xarray"):
         return df
 
 
-def minidot_txts(paths: list or str):
+def minidot_txts(paths: list or str, output="dataframe"):
     """
     txts reads individual minidot txt files,
     add the calibration, serial_number and software version
-    information as a new column and return a dataframe.
+    information as a new column and return a dataframe, or a pyarrow Table
+    if output="arrow".
     """
     # If a single string is givien, assume only one path
     if type(paths) is str:
         paths = [paths]
 
     df = pd.DataFrame()
+    tables = []
     for path in paths:
         # Ignore concatenated Cat.TXT files or not TXT file
         if path.endswith("Cat.TXT") or not path.endswith(("TXT", "txt")):
             print(f"Ignore {path}")
             continue
         # Read txt file
-        df = df.append(minidot_txt(path, output="dataframe"))
+        if output == "arrow":
+            tables.append(minidot_txt(path, output="arrow"))
+        else:
+            df = df.append(minidot_txt(path, output="dataframe"))
+
+    if output == "arrow":
+        import pyarrow as pa
 
+        return pa.concat_tables(tables) if tables else pa.table({})
     return df
 
 
-def minidot_cat(path):
+def minidot_cat(path, output="xarray", header_only=False):
     """
     cat reads PME MiniDot concatenated CAT files
+    If header_only, only the header and the first and last lines of data are read
+    and the header metadata with the variables, time_min and time_max is returned.
+    The data is returned as an "xarray" dataset, a pyarrow Table ("arrow") or a
+    "dataframe" with the instrument information.
     """
 
     with open(path, "r") as f:
@@ -148,6 +192,30 @@ def minidot_cat(path):
         names = columns[0].replace("\n", "").split(",")
         units = columns[1].replace("\n", "")
 
+        # Extract metadata from header
+        attrs = re.search(
+            (
+                "Sensor:\s*(?P<instrument_sn>.*)\n"
+                + "Concatenation Date:\s*(?P<concatenation_date>.*)\n\n"
+                + "DO concentration compensated for salinity:\s*(?P<reference_salinity>.*)\n"
+                + "Saturation computed at elevation:\s*(?P<elevation>.*)\n"
+            ),
+            "".join(header),
+        ).groupdict()
+
+        if header_only:
+            time_min, time_max = get_time_coverage(
+                path, get_data_offset(path, 9), _get_minidot_time
+            )
+            return {
+                **attrs,
+                "instrument_manufacturer": "PME",
+                "instrument_model": "MiniDot",
+                "variables": names,
+                "time_min": time_min,
+                "time_max": time_max,
+            }
+
         ds = pd.read_csv(f, names=names).to_xarray()
 
     # Include units
@@ -155,18 +223,12 @@ def minidot_cat(path):
         if units:
             ds[name].attrs[units] = units
 
-    # Extract metadata from header
-    ds.attrs = re.search(
-        (
-            "Sensor:\s*(?P<instrument_sn>.*)\n"
-            + "Concatenation Date:\s*(?P<concatenation_date>.*)\n\n"
-            + "DO concentration compensated for salinity:\s*(?P<reference_salinity>.*)\n"
-            + "Saturation computed at elevation:\s*(?P<elevation>.*)\n"
-        ),
-        "".join(header),
-    ).groupdict()
-
-    return ds
+    ds.attrs = {
+        **attrs,
+        "instrument_manufacturer": "PME",
+        "instrument_model": "MiniDot",
+    }
+    return _get_output(ds, output)
 
 
 def retrieve_oxygen_saturation_percent(
@@ -1,15 +1,23 @@
 import pandas as pd
 import re
 
-from process_ocean_data.read.utils import test_parsed_dataset
+from process_ocean_data.read.utils import (
+    get_data_offset,
+    get_time_coverage,
+    test_parsed_dataset,
+    to_arrow,
+)
 
 
-def rtext(file_path, encoding="UTF-8", output=None):
+def rtext(file_path, encoding="UTF-8", output=None, header_only=False):
     """
     Read RBR R-Text format.
     :param errors: default ignore
     :param encoding: default UTF-8
     :param file_path: path to file to read
+    :param output: "dataframe", "arrow" (pyarrow Table) or default to xarray
+    :param header_only: only read the header and the first and last lines of data
+        and return the header metadata with the variables, time_min and time_max
     :return: metadata dictionary dataframe
     """
     # MON File Header end
@@ -50,6 +58,25 @@ def rtext(file_path, encoding="UTF-8", output=None):
         # Read NumberOFSamples line
         metadata["NumberOfSamples"] = int(line.rsplit("=")[1])
 
+        if header_only:
+            # The columns line is ignored since it has no valid time
+            time_min, time_max = get_time_coverage(
+                file_path,
+                get_data_offset(file_path, end_of_header=rb"^NumberOfSamples"),
+                lambda line: pd.to_datetime(
+                    re.split(r"\s\s+", line.decode(encoding).strip())[0]
+                ),
+            )
+            return {
+                **metadata,
+                "instrument_manufacturer": "RBR",
+                "instrument_model": metadata["Model"],
+                "instrument_sn": metadata["Serial"],
+                "variables": re.split(r"\s\s+", fid.readline().strip()),
+                "time_min": time_min,
+                "time_max": time_max,
+            }
+
         # Read data
         df = pd.read_csv(fid, sep="\s\s+", engine="python")
 
@@ -68,7 +95,9 @@ def rtext(file_path, encoding="UTF-8", output=None):
         test_parsed_dataset(ds)
 
         # Ouput
-        if output == "dataframe":
+        if output == "arrow":
+            return to_arrow(ds)
+        elif output == "dataframe":
             for var in ["instrument_manufacturer", "instrument_model", "instrument_sn"][
                 ::-1
             ]:
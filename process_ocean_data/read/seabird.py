@@ -1,21 +1,58 @@
+import numpy as np
 import pandas as pd
 import re
 import logging
-import xarray as xr
 import xmltodict
 import json
 import os
+from functools import lru_cache
+from io import BytesIO
 
 import argparse
 
+from .utils import (
+    get_data_offset,
+    get_file_index,
+    get_time_coverage,
+    get_time_slice_mask,
+    parse_fixed_width_floats,
+    read_fixed_width,
+    read_head_and_tail,
+    read_time_slice_bytes,
+    to_arrow,
+)
+
 SBE_TIME_FORMAT = "%B %d %Y %H:%m:%s"  # Jun 23 2016 13:51:30
+# Seabird time variables origin and units
+SBE_TIME_VARIABLES = {
+    "timeS": ("start_time", "s"),
+    "timeM": ("start_time", "m"),
+    "timeH": ("start_time", "h"),
+    "timeJ": ("start_year", "D"),
+    "timeQ": ("2000-01-01", "s"),
+    "timeK": ("2000-01-01", "s"),
+    "timeN": ("1970-01-01", "s"),
+    "timeY": ("1970-01-01", "s"),
+}
 logger = logging.getLogger(__name__)
 
 reference_vocabulary_path = os.path.join(
     os.path.dirname(__file__), "vocabularies", "seabird_variable_attributes.json"
 )
-with open(reference_vocabulary_path) as f:
-    seabird_variable_attributes = json.load(f)
+
+
+@lru_cache(maxsize=None)
+def get_seabird_variable_attributes():
+    """Load the seabird vocabulary once, when first needed."""
+    with open(reference_vocabulary_path) as f:
+        return json.load(f)
+
+
+def __getattr__(name):
+    # Keep seabird_variable_attributes available without loading it on import
+    if name == "seabird_variable_attributes":
+        return get_seabird_variable_attributes()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def convert_to_netcdf_var_name(var_name):
@@ -23,6 +60,7 @@ def convert_to_netcdf_var_name(var_name):
 
 
 def add_seabird_vocabulary(variable_attributes):
+    seabird_variable_attributes = get_seabird_variable_attributes()
     for var in variable_attributes.keys():
         if var in seabird_variable_attributes:
             variable_attributes[var].update(seabird_variable_attributes[var])
@@ -31,22 +69,226 @@ def add_seabird_vocabulary(variable_attributes):
     return variable_attributes
 
 
-def cnv(file_path, output="xarray"):
+def get_seabird_start_time(header):
+    """Parse the start_time header attribute (ex: May 17 2022 11:21:24 [Instrument's time stamp, header])"""
+    return pd.to_datetime(header["start_time"].split("[")[0].strip())
+
+
+def get_seabird_time(values, variable, start_time=None):
+    """
+    Convert Seabird time variable values to timestamps.
+    :param values: time variable values
+    :param variable: Seabird time variable (one of SBE_TIME_VARIABLES)
+    :param start_time: file start time needed for the elapsed time variables
+    :return: timestamps
+    """
+    origin, unit = SBE_TIME_VARIABLES[variable]
+    if origin == "start_time":
+        origin = start_time
+    elif origin == "start_year":
+        # January 1st at midnight is day 1
+        origin = pd.Timestamp(start_time.year, 1, 1) - pd.Timedelta(1, "D")
+    return pd.to_datetime(values, unit=unit, origin=origin)
+
+
+def _get_cnv_time_parser(header):
+    """Retrieve the cnv time variable and its data lines time parser."""
+    variables = list(header["variables"].keys())
+    time_variable = next((var for var in variables if var in SBE_TIME_VARIABLES), None)
+    if time_variable is None:
+        return None, None
+    column = variables.index(time_variable)
+    start_time = get_seabird_start_time(header) if "start_time" in header else None
+
+    def get_time(line):
+        return get_seabird_time(float(line.split()[column]), time_variable, start_time)
+
+    return time_variable, get_time
+
+
+def _get_seabird_scan(header, time_min, time_max):
+    """Header metadata returned by the header_only mode."""
+    return {
+        **header,
+        "instrument_manufacturer": "Sea-Bird",
+        "instrument_type": header["instrument_type"].strip(),
+        "instrument_sn": header.get("temperature_sn"),
+        "variables": list(header["variables"]),
+        "time_min": time_min,
+        "time_max": time_max,
+    }
+
+
+def _scan_cnv(file_path, header):
+    """Retrieve the cnv time coverage from its first and last data lines."""
+    data_offset = get_data_offset(file_path, end_of_header=rb"^\*END\*")
+    time_variable, get_time = _get_cnv_time_parser(header)
+    if time_variable is not None:
+        return _get_seabird_scan(
+            header, *get_time_coverage(file_path, data_offset, get_time)
+        )
+    elif "start_time" in header:
+        return _get_seabird_scan(header, get_seabird_start_time(header), pd.NaT)
+    return _get_seabird_scan(header, pd.NaT, pd.NaT)
+
+
+def _get_bottle_times(lines):
+    """Retrieve each bottle time from its average (date) and next (time) lines."""
+    return [
+        pd.to_datetime(f"{line[10:22].decode()} {next_line[10:22].decode()}")
+        for line, next_line in zip(lines[:-1], lines[1:])
+        if line.rstrip().endswith(b"(avg)")
+    ]
+
+
+def _scan_btl(file_path, header):
+    """Retrieve the btl time coverage from the first and last bottles."""
+    head_lines, tail_lines = read_head_and_tail(
+        file_path, get_data_offset(file_path, end_of_header=rb"^\s*Position\s+Time")
+    )
+    first_times = _get_bottle_times(head_lines)
+    last_times = _get_bottle_times(tail_lines)
+    return _get_seabird_scan(
+        header,
+        first_times[0] if first_times else pd.NaT,
+        last_times[-1] if last_times else pd.NaT,
+    )
+
+
+def _read_cnv_time_slice(file_path, header, time_slice, index_every=1000):
+    """Read only the cnv data lines within time_slice based on the file sidecar index."""
+    time_variable, get_time = _get_cnv_time_parser(header)
+    if time_variable is None:
+        raise RuntimeError(f"No time variable available to slice {file_path}")
+    variables = list(header["variables"].keys())
+    start_time = get_seabird_start_time(header) if "start_time" in header else None
+
+    index = get_file_index(
+        file_path,
+        get_data_offset(file_path, end_of_header=rb"^\*END\*"),
+        get_time,
+        every=index_every,
+    )
+    df = pd.read_csv(
+        BytesIO(read_time_slice_bytes(file_path, index, time_slice)),
+        delimiter="\s+",
+        names=variables,
+    )
+    time = get_seabird_time(df[time_variable].values, time_variable, start_time)
+    return df.loc[get_time_slice_mask(time, time_slice)].reset_index(drop=True)
+
+
+def _get_fixed_width_dataframe(fields, columns):
+    """Convert fixed width fields to a dataframe, numbers without decimals are integers."""
+    df = pd.DataFrame(parse_fixed_width_floats(fields), columns=columns)
+    is_integer = ~((fields == ord(".")) | ((fields | 32) == ord("e"))).any(axis=(0, 2))
+    is_integer &= df.notnull().all().values
+    return df.astype({column: int for column in df.columns[is_integer]})
+
+
+def _read_cnv_fixed_width(file_path, variables):
+    """
+    Read the cnv data with a memory map. Seabird ascii data is fixed width
+    (11 characters columns by default).
+    """
+    data_offset = get_data_offset(file_path, end_of_header=rb"^\*END\*")
+    with open(file_path, "rb") as f:
+        f.seek(data_offset)
+        line_length = len(f.readline().rstrip(b"\r\n"))
+    width, remainder = divmod(line_length, len(variables))
+    if not line_length or remainder:
+        raise RuntimeError(f"{file_path} data isn't fixed width")
+    fields = read_fixed_width(
+        file_path, [width] * len(variables), data_offset, line_length
+    )
+    return _get_fixed_width_dataframe(fields, variables)
+
+
+def _read_btl_fixed_width(file_path, widths, columns):
+    """
+    Read the btl data with a memory map, the date/time and statistic columns
+    are kept as strings.
+    """
+    if len(widths) != len(columns):
+        raise RuntimeError("Bottle columns don't match the variables")
+    data_offset = get_data_offset(file_path, end_of_header=rb"^\s*Position\s+Time")
+    fields = read_fixed_width(file_path, widths, data_offset)
+    text_columns = {1: columns[1], len(columns) - 1: columns[-1]}
+    df = _get_fixed_width_dataframe(
+        fields[:, [id for id in range(len(columns)) if id not in text_columns]],
+        [column for id, column in enumerate(columns) if id not in text_columns],
+    )
+    for id, column in text_columns.items():
+        values = np.ascontiguousarray(fields[:, id, : widths[id]])
+        df.insert(id, column, np.char.strip(values.view(f"S{widths[id]}")[:, 0]))
+        df[column] = df[column].str.decode("ascii")
+    return df
+
+
+def cnv(
+    file_path,
+    output="xarray",
+    time_slice=None,
+    index_every=1000,
+    fixed_width=False,
+    header_only=False,
+):
+    """
+    Parse Seabird CNV format.
+    :param file_path: path to file to read
+    :param output: "dataframe", "arrow" (pyarrow Table) or default to xarray
+    :param time_slice: slice(start, end) of the time range to read. Only the matching
+        lines are read based on a sidecar index (file_path + ".index.json")
+        which is generated on the first sliced read.
+    :param index_every: number of lines between each line indexed
+    :param fixed_width: memory map the file and split the fixed width columns
+        with numpy instead of the pandas whitespace parser, fallback to pandas
+        if the lines aren't fixed width.
+    :param header_only: only read the header and the first and last lines of data
+        and return the header metadata with the variables, time_min and time_max
+    """
     with open(file_path) as f:
         header = parse_seabird_file_header(f)
+        if header_only:
+            return _scan_cnv(file_path, header)
         header["variables"] = add_seabird_vocabulary(header["variables"])
-        df = pd.read_csv(f, delimiter="\s+", names=header["variables"].keys())
+        if time_slice is None and not fixed_width:
+            df = pd.read_csv(f, delimiter="\s+", names=header["variables"].keys())
+        elif time_slice is None:
+            try:
+                df = _read_cnv_fixed_width(file_path, list(header["variables"]))
+            except (RuntimeError, ValueError):
+                logger.debug("Fallback to the whitespace delimited parser", exc_info=True)
+                df = pd.read_csv(f, delimiter="\s+", names=header["variables"].keys())
+    if time_slice is not None:
+        df = _read_cnv_time_slice(file_path, header, time_slice, index_every)
 
     header = generate_seabird_cf_history(header)
 
     if output == "dataframe":
         return df, header
-    return convert_sbe_dataframe_to_dataset(df, header)
+    ds = convert_sbe_dataframe_to_dataset(df, header)
+    if output == "arrow":
+        return to_arrow(ds)
+    return ds
 
 
-def btl(file_path, output="xarray"):
+def btl(file_path, output="xarray", header_only=False):
+    """
+    Parse Seabird BTL format.
+    :param file_path: path to file to read
+    :param output: "dataframe", "arrow" (pyarrow Table) or default to xarray
+    :param header_only: only read the header and the first and last bottles
+        and return the header metadata with the variables, time_min and time_max
+    """
     with open(file_path) as f:
         header = parse_seabird_file_header(f)
+        if header_only:
+            if not header["variables"]:
+                header["variables"] = {
+                    var[0].lower() + var[1:]: {} for var in header["bottle_columns"]
+                }
+            return _scan_btl(file_path, header)
         if header["variables"]:
             header["variables"] = add_seabird_vocabulary(header["variables"])
         else:
@@ -57,11 +299,12 @@ def btl(file_path, output="xarray"):
         # parse column header with fix width
         variable_list = list(header["variables"].keys())
         variable_list += ["stats"]
-        df = pd.read_fwf(
-            f,
-            widths=[10, 12] + [11] * (len(header["bottle_columns"]) - 1),
-            names=variable_list,
-        )
+        widths = [10, 12] + [11] * (len(header["bottle_columns"]) - 1)
+        try:
+            df = _read_btl_fixed_width(file_path, widths, variable_list)
+        except (RuntimeError, ValueError):
+            logger.debug("Fallback to the pandas fixed width parser", exc_info=True)
+            df = pd.read_fwf(f, widths=widths, names=variable_list)
 
     # Split statistical data info separate dateframes
     df["bottle"] = df["bottle"].ffill().astype(int)
@@ -99,6 +342,8 @@ def btl(file_path, output="xarray"):
                 "cell_method"
             ] = f"scan: mean (previous {n_scan_per_bottle} scans)"
 
+    if output == "arrow":
+        return to_arrow(ds)
     return ds
 
 
@@ -1,5 +1,13 @@
+import bisect
+import json
 import logging
-import xarray as xr
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
 import pandas as pd
 
 logger = logging.getLogger(__name__)
@@ -15,3 +23,426 @@ def test_parsed_dataset(ds):
     # time
     if "time" not in ds:
         logger.warning("Missing time variable")
+
+
+INSTRUMENT_METADATA_COLUMNS = [
+    "instrument_manufacturer",
+    "instrument_model",
+    "instrument_type",
+    "instrument_sn",
+]
+PARQUET_PARTITION_COLUMNS = ["instrument_manufacturer", "instrument_sn", "year"]
+
+
+def to_arrow(ds, metadata_columns=None):
+    """
+    Convert a parsed dataset to a pyarrow Table. The instrument attributes are
+    added as dictionary encoded columns in front of the data which only store
+    each value once and the dataset and variables attributes are saved as json
+    within the table schema metadata.
+    :param ds: xarray dataset generated by one of the parsers
+    :param metadata_columns: global attributes to add as columns,
+        default to INSTRUMENT_METADATA_COLUMNS
+    :return: pyarrow Table
+    """
+    import pyarrow as pa
+
+    metadata_columns = metadata_columns or INSTRUMENT_METADATA_COLUMNS
+    df = ds.to_dataframe()
+    df = df.reset_index(drop=df.index.name in (None, "index"))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    indices = pa.array(np.zeros(len(table), dtype="int32"))
+    for column in metadata_columns[::-1]:
+        if ds.attrs.get(column) is None or column in table.column_names:
+            continue
+        dictionary = pa.array([str(ds.attrs[column]).strip()])
+        table = table.add_column(
+            0, column, pa.DictionaryArray.from_arrays(indices, dictionary)
+        )
+
+    metadata = {
+        **(table.schema.metadata or {}),
+        b"attrs": json.dumps(ds.attrs, default=str),
+        b"variables": json.dumps(
+            {var: ds[var].attrs for var in ds.variables}, default=str
+        ),
+    }
+    return table.replace_schema_metadata(metadata)
+
+
+def get_arrow_attributes(schema):
+    """
+    Retrieve the dataset and variables attributes stored by to_arrow.
+    :param schema: pyarrow Table or Schema
+    :return: dataset attributes, variables attributes
+    """
+    metadata = getattr(schema, "schema", schema).metadata or {}
+    return (
+        json.loads(metadata.get(b"attrs", b"{}")),
+        json.loads(metadata.get(b"variables", b"{}")),
+    )
+
+
+def write_parquet_dataset(
+    tables,
+    root_path,
+    partition_cols=None,
+    time_variable="time",
+    compression="zstd",
+):
+    """
+    Append parsed files to a hive partitioned parquet dataset
+    (root_path/instrument_manufacturer=.../instrument_sn=.../year=.../*.parquet)
+    which can be scanned with pyarrow.dataset or pandas.read_parquet while only
+    reading the partitions matching the filters. Each file is converted and written
+    independently and the attributes of each file are kept within its schema metadata.
+    :param tables: iterable of pyarrow Tables or xarray datasets generated by the parsers
+    :param root_path: root directory of the parquet dataset
+    :param partition_cols: columns used to partition the dataset,
+        default to PARQUET_PARTITION_COLUMNS. "year" is generated from the time_variable.
+    :param time_variable: time column used to generate the year column
+    :param compression: parquet compression codec
+    :return: list of the parquet files written
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as pds
+
+    partition_cols = partition_cols or PARQUET_PARTITION_COLUMNS
+    file_options = pds.ParquetFileFormat().make_write_options(compression=compression)
+    written_files = []
+    for table in tables:
+        if not isinstance(table, pa.Table):
+            table = to_arrow(table)
+        if "year" in partition_cols and "year" not in table.column_names:
+            if time_variable in table.column_names:
+                year = pc.year(table[time_variable]).cast(pa.int16())
+            else:
+                logger.warning("Missing %s variable to generate year", time_variable)
+                year = pa.nulls(len(table), pa.int16())
+            table = table.append_column("year", year)
+        for column in partition_cols:
+            if column not in table.column_names:
+                logger.warning("Missing partition column %s", column)
+                table = table.append_column(column, pa.nulls(len(table), pa.string()))
+
+        pds.write_dataset(
+            table,
+            root_path,
+            format="parquet",
+            partitioning=partition_cols,
+            partitioning_flavor="hive",
+            basename_template=f"{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_options=file_options,
+            file_visitor=lambda written_file: written_files.append(written_file.path),
+        )
+    return written_files
+
+
+FILE_INDEX_SUFFIX = ".index.json"
+
+
+def get_time_bound(value, end=False):
+    """
+    Timestamp of a time slice bound. Partial date strings include the whole period
+    like xarray (ex: "2022-01" ends on "2022-01-31 23:59:59.999999999").
+    """
+    if isinstance(value, str):
+        period = pd.Period(value)
+        return period.end_time if end else period.start_time
+    return pd.Timestamp(value)
+
+
+def _to_utc_nanoseconds(time):
+    time = pd.Timestamp(time)
+    if time.tzinfo:
+        time = time.tz_convert("UTC").tz_localize(None)
+    return time.value
+
+
+def get_data_offset(path, header_lines=None, end_of_header=None):
+    """
+    Byte offset of the first data line of a file.
+    :param path: file path
+    :param header_lines: number of header lines
+    :param end_of_header: bytes regular expression matching the last header line
+    :return: byte offset
+    """
+    with open(path, "rb") as f:
+        for line_number, line in enumerate(f, 1):
+            if line_number == header_lines or (
+                end_of_header is not None and re.search(end_of_header, line)
+            ):
+                return f.tell()
+    raise RuntimeError(f"Failed to retrieve the end of the header of {path}")
+
+
+def build_file_index(path, data_offset, get_time, every=1000):
+    """
+    Index the byte offset and time of every Nth data line of a file.
+    :param path: file path
+    :param data_offset: byte offset of the first data line
+    :param get_time: function returning the time of a data line (bytes)
+    :param every: number of lines between each indexed line
+    :return: index dictionary
+    """
+    offsets, times = [], []
+    is_pending = False
+    with open(path, "rb") as f:
+        f.seek(data_offset)
+        offset = data_offset
+        for line_number, line in enumerate(iter(f.readline, b"")):
+            if line_number % every == 0 or is_pending:
+                # Lines without a valid time are replaced by the next one
+                try:
+                    time = get_time(line) if line.strip() else None
+                except (ValueError, IndexError):
+                    time = None
+                is_pending = time is None or pd.isna(time)
+                if not is_pending:
+                    offsets.append(offset)
+                    times.append(_to_utc_nanoseconds(time))
+            offset += len(line)
+    return {
+        "size": os.path.getsize(path),
+        "modified": os.path.getmtime(path),
+        "every": every,
+        "data_offset": data_offset,
+        "offsets": offsets,
+        "times": times,
+    }
+
+
+def get_file_index(path, data_offset, get_time, every=1000, index_path=None):
+    """
+    Load the sidecar index of a file (path + FILE_INDEX_SUFFIX) or build and save it
+    if it doesn't exist or the file was modified since.
+    :param path: file path
+    :param data_offset: byte offset of the first data line
+    :param get_time: function returning the time of a data line (bytes)
+    :param every: number of lines between each indexed line
+    :param index_path: sidecar index path, default to path + FILE_INDEX_SUFFIX
+    :return: index dictionary
+    """
+    index_path = index_path or str(path) + FILE_INDEX_SUFFIX
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if (
+            index["size"] == os.path.getsize(path)
+            and index["modified"] == os.path.getmtime(path)
+            and index["every"] == every
+        ):
+            return index
+        logger.info("Update outdated index %s", index_path)
+
+    index = build_file_index(path, data_offset, get_time, every)
+    try:
+        with open(index_path, "w") as f:
+            json.dump(index, f)
+    except OSError:
+        logger.warning("Failed to save index %s", index_path, exc_info=True)
+    return index
+
+
+def read_time_slice_bytes(path, index, time_slice):
+    """
+    Read the data lines of a file which may be within time_slice based on its
+    index. Lines are expected to be sorted in time and should still be
+    filtered once parsed.
+    :param path: file path
+    :param index: index generated by get_file_index
+    :param time_slice: slice(start, end) of the time range needed
+    :return: data lines bytes
+    """
+    times = index["times"]
+    if times != sorted(times):
+        raise RuntimeError(f"Time isn't sorted within {path}, it can't be sliced")
+    start, end = index["data_offset"], None
+    if time_slice.start is not None:
+        start_time = _to_utc_nanoseconds(get_time_bound(time_slice.start))
+        start_id = bisect.bisect_left(times, start_time) - 1
+        if start_id >= 0:
+            start = index["offsets"][start_id]
+    if time_slice.stop is not None:
+        stop_time = _to_utc_nanoseconds(get_time_bound(time_slice.stop, True))
+        stop_id = bisect.bisect_right(times, stop_time)
+        if stop_id < len(times):
+            end = index["offsets"][stop_id]
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start if end else -1)
+
+
+def get_time_slice_mask(time, time_slice):
+    """Mask of the times within the time slice, naive bounds are considered UTC."""
+    time = pd.to_datetime(pd.Series(time), utc=True).dt.tz_localize(None)
+    is_within = pd.Series(True, index=time.index)
+    if time_slice.start is not None:
+        start = get_time_bound(time_slice.start)
+        is_within &= time >= pd.Timestamp(_to_utc_nanoseconds(start))
+    if time_slice.stop is not None:
+        stop = get_time_bound(time_slice.stop, True)
+        is_within &= time <= pd.Timestamp(_to_utc_nanoseconds(stop))
+    return is_within.values
+
+
+def read_head_and_tail(path, data_offset=0, block_size=65536):
+    """
+    Read the first and last complete data lines of a file without reading the
+    rest of it.
+    :param path: file path
+    :param data_offset: byte offset of the first data line
+    :param block_size: number of bytes read at the start and end of the data
+    :return: (head_lines, tail_lines) lists of bytes lines
+    """
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(data_offset)
+        head = f.read(min(block_size, size - data_offset))
+        tail_offset = max(data_offset, size - block_size)
+        f.seek(tail_offset)
+        tail = f.read()
+    head_lines = head.splitlines()
+    tail_lines = tail.splitlines()
+    if data_offset + len(head) < size:
+        # Drop the incomplete line at the end of the head block
+        head_lines = head_lines[:-1]
+    if tail_offset > data_offset:
+        # and at the start of the tail block
+        tail_lines = tail_lines[1:]
+    return head_lines, tail_lines
+
+
+def _get_first_time(lines, get_time):
+    for line in lines:
+        try:
+            time = get_time(line) if line.strip() else None
+        except (ValueError, IndexError):
+            continue
+        if time is not None and not pd.isna(time):
+            return pd.Timestamp(_to_utc_nanoseconds(time))
+    return pd.NaT
+
+
+def get_time_coverage(path, data_offset, get_time, block_size=65536):
+    """
+    Retrieve the first and last valid time of a file by only reading the start
+    and the end of its data. Lines without a valid time are ignored.
+    :param path: file path
+    :param data_offset: byte offset of the first data line
+    :param get_time: function returning the time of a data line (bytes)
+    :param block_size: number of bytes read at the start and end of the data
+    :return: (time_min, time_max) UTC timestamps, NaT if not available
+    """
+    head_lines, tail_lines = read_head_and_tail(path, data_offset, block_size)
+    return (
+        _get_first_time(head_lines, get_time),
+        _get_first_time(tail_lines[::-1], get_time),
+    )
+
+
+def _scan_file_or_none(path, reader, **kwargs):
+    try:
+        return {"path": str(path), **reader(path, header_only=True, **kwargs)}
+    except Exception:
+        logger.error("Failed to scan %s", path, exc_info=True)
+
+
+def scan_files(paths, reader, max_workers=None, chunksize=100, **kwargs):
+    """
+    Retrieve the header metadata and time coverage of many files with the
+    reader header_only mode. Files which can't be scanned are ignored.
+    :param paths: list of files
+    :param reader: parser function with a header_only argument (ex: read.onset.csv)
+    :param max_workers: number of processes used to scan the files,
+        default to scan them sequentially
+    :param chunksize: number of files sent at once to each process
+    :param kwargs: extra arguments passed to the reader
+    :return: dataframe with one row per file scanned
+    """
+    scan = partial(_scan_file_or_none, reader=reader, **kwargs)
+    if max_workers:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            records = list(executor.map(scan, paths, chunksize=chunksize))
+    else:
+        records = map(scan, paths)
+    return pd.DataFrame([record for record in records if record])
+
+
+def parse_fixed_width_floats(fields):
+    """
+    Convert fixed width ascii numbers to float in bulk with numpy, without
+    creating a python string per value. Blank fields are NaN.
+    :param fields: uint8 array (n_lines, n_columns, width) of the ascii characters
+    :return: float64 array (n_lines, n_columns)
+    """
+    fields = np.ascontiguousarray(fields, dtype=np.uint8)
+    strings = fields.view(f"S{fields.shape[-1]}")[..., 0]
+    is_blank = (fields == 32).all(axis=-1)
+    if not is_blank.any():
+        return strings.astype(float)
+    # numpy strips the surrounding spaces but fails on blank strings
+    values = np.full(strings.shape, np.nan)
+    values[~is_blank] = strings[~is_blank].astype(float)
+    return values
+
+
+def _get_fixed_width_fields(data, widths, line_length=None):
+    """Retrieve the characters of each field from the bytes of fixed width lines."""
+    column_starts = np.cumsum([0] + list(widths[:-1]))
+    max_width = max(widths)
+    character_offsets = column_starts[:, None] + np.arange(max_width)
+    is_in_column = np.arange(max_width) < np.array(widths)[:, None]
+
+    line_ends = np.flatnonzero(data == 10)
+    if len(data) and data[-1] != 10:
+        line_ends = np.append(line_ends, len(data))
+    line_starts = np.append(0, line_ends[:-1] + 1)
+    has_carriage_return = data[np.maximum(line_ends - 1, 0)] == 13
+    line_lengths = line_ends - line_starts - has_carriage_return
+    is_not_empty = line_lengths > 0
+    line_starts = line_starts[is_not_empty]
+    line_lengths = line_lengths[is_not_empty]
+    if not len(line_starts):
+        return np.empty((0, len(widths), max_width), dtype=np.uint8)
+    if line_length is not None and (line_lengths != line_length).any():
+        raise RuntimeError(f"Lines aren't {line_length} characters long")
+
+    row_length = line_ends[0] + 1
+    if (line_lengths == line_lengths[0]).all() and (
+        line_starts == np.arange(len(line_starts)) * row_length
+    ).all():
+        rows = data[: len(line_starts) * row_length].reshape(-1, row_length)
+        if len(set(widths)) == 1 and sum(widths) <= line_lengths[0]:
+            # Columns are consecutive slices of each row
+            return rows[:, : sum(widths)].reshape(len(rows), len(widths), -1).copy()
+        fields = rows[:, np.minimum(character_offsets, row_length - 1)]
+        is_in_line = character_offsets < line_lengths[0]
+    else:
+        index = line_starts[:, None, None] + character_offsets
+        fields = data[np.minimum(index, len(data) - 1)]
+        is_in_line = character_offsets < line_lengths[:, None, None]
+    return np.where(is_in_line & is_in_column, fields, 32).astype(np.uint8)
+
+
+def read_fixed_width(path, widths, data_offset=0, line_length=None):
+    """
+    Memory map a fixed width text file and retrieve the characters of each field
+    with numpy. If all the lines have the same length, the data is reshaped in
+    rows without copy, otherwise fields are gathered from each line start.
+    Characters beyond the end of a line are replaced by spaces and empty lines
+    are ignored.
+    :param path: file path
+    :param widths: width of each column
+    :param data_offset: byte offset of the first data line
+    :param line_length: expected length of every line, raise a RuntimeError otherwise
+    :return: uint8 array (n_lines, n_columns, max(widths))
+    """
+    if os.path.getsize(path) <= data_offset:
+        data = np.empty(0, dtype=np.uint8)
+    else:
+        data = np.memmap(path, dtype=np.uint8, mode="r", offset=data_offset)
+    return _get_fixed_width_fields(data, widths, line_length)
@@ -2,7 +2,12 @@ import pandas as pd
 import json
 import re
 import logging
-from .utils import test_parsed_dataset
+from .utils import (
+    get_data_offset,
+    get_time_coverage,
+    test_parsed_dataset,
+    to_arrow,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -20,12 +25,16 @@ def MON(
     output=None,
     standardize_variable_names=True,
     kwargs_input_read_csv=None,
+    header_only=False,
 ):
     """
     Read MON file format from Van Essen Instrument format.
     :param errors: default ignore
     :param encoding: default UTF-8
     :param file_path: path to file to read
+    :param output: "dataframe", "arrow" (pyarrow Table) or default to xarray
+    :param header_only: only read the header and the first and last lines of data
+        and return the header metadata with the variables, time_min and time_max
     :return: metadata dictionary dataframe
     """
     # MON File Header end
@@ -81,6 +90,33 @@ def MON(
             + ":00"
         )
 
+        if header_only:
+            variables = [re.sub("^\d+\:\s*", "", var) for var in channel_names]
+            if standardize_variable_names:
+                variables = [
+                    van_essen_variable_mapping.get(var, var) for var in variables
+                ]
+
+            def get_time(line):
+                time, _ = re.split(r"\s\s+", line.decode("ascii", "ignore").strip(), 1)
+                return date_parser(time)
+
+            time_min, time_max = get_time_coverage(
+                file_path,
+                get_data_offset(file_path, end_of_header=rb"^\[Data\]"),
+                get_time,
+            )
+            return {
+                "instrument_manufacturer": "Van Essen Instruments",
+                "instrument_type": info["Logger settings"]["Instrument type"],
+                "instrument_sn": info["Logger settings"]["Serial number"],
+                "time_coverage_resolution": info["Logger settings"]["Sample period"],
+                "n_records": info["n_records"],
+                "variables": variables,
+                "time_min": time_min,
+                "time_max": time_max,
+            }
+
         # Read data (Seperator is minimum 2 spaces)
         df = pd.read_csv(
             fid,
@@ -138,7 +174,9 @@ def MON(
     test_parsed_dataset(ds)
 
     # Output
-    if output == "dataframe":
+    if output == "arrow":
+        return to_arrow(ds)
+    elif output == "dataframe":
         df = ds.to_pandas()
         for var in ["instrument_manufacturer", "instrument_type", "instrument_sn"][
             ::-1
@@ -1,4 +1,17 @@
-from . import geo
-from . import google
-from . import hakai
-from . import qc
\ No newline at end of file
+"""
+Processing tools, each submodule is imported on first access (PEP 562) since
+some rely on heavy optional dependencies (plotly, ipywidgets, matplotlib, ...).
+"""
+import importlib
+
+__all__ = ["figures", "geo", "google", "hakai", "qc", "catalog"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,200 @@
+"""
+Catalog module index the processed files of each site (time range, instrument
+serial number and variables available) to open a site full deployment history
+lazily while only reading the files overlapping the requested time range.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
+import xarray as xr
+
+from ..read.utils import get_time_bound
+
+logger = logging.getLogger(__name__)
+
+CATALOG_COLUMNS = [
+    "path",
+    "site",
+    "instrument_sn",
+    "time_min",
+    "time_max",
+    "variables",
+    "modified",
+]
+SITE_ATTRIBUTES = ["station", "site"]
+INSTRUMENT_SN_ATTRIBUTES = ["instrument_sn", "serialNumber", "serial_number"]
+
+
+def _open_dataset(path, **kwargs):
+    if str(path).endswith(".zarr"):
+        return xr.open_zarr(path, **kwargs)
+    return xr.open_dataset(path, **kwargs)
+
+
+def _get_attribute(ds, names):
+    """Retrieve the first global attribute or scalar variable available."""
+    for name in names:
+        if name in ds.variables and ds[name].size == 1:
+            return str(ds[name].values.item()).strip()
+        elif ds.attrs.get(name) not in (None, ""):
+            return str(ds.attrs[name]).strip()
+
+
+def get_catalog_record(path, time="time"):
+    """
+    Retrieve the catalog information of a processed file. Only the file metadata
+    and the time variable are read.
+    :param path: NetCDF or zarr file
+    :param time: time variable
+    :return: dictionary with the CATALOG_COLUMNS
+    """
+    with _open_dataset(path) as ds:
+        time_values = ds[time].values if time in ds.variables else []
+        return {
+            "path": str(path),
+            "site": _get_attribute(ds, SITE_ATTRIBUTES),
+            "instrument_sn": _get_attribute(ds, INSTRUMENT_SN_ATTRIBUTES),
+            "time_min": pd.to_datetime(time_values).min(),
+            "time_max": pd.to_datetime(time_values).max(),
+            "variables": " ".join(
+                str(var) for var in ds.data_vars if ds[var].dims != ()
+            ),
+            "modified": os.path.getmtime(path),
+        }
+
+
+def _get_catalog_record_or_none(path, time="time"):
+    try:
+        return get_catalog_record(path, time=time)
+    except Exception:
+        logger.error("Failed to catalog %s", path, exc_info=True)
+
+
+def build_catalog(paths, catalog_path=None, time="time", max_workers=None):
+    """
+    Build the catalog of the processed files. If catalog_path exists, the records of
+    the files which weren't modified since are reused and only the new or
+    modified files are read. Files which can't be read or were deleted are ignored.
+    :param paths: list of processed NetCDF or zarr files
+    :param catalog_path: csv file where the catalog is saved
+    :param time: time variable
+    :param max_workers: number of processes used to read the files,
+        default to read them sequentially
+    :return: catalog dataframe
+    """
+    existing = pd.DataFrame(columns=CATALOG_COLUMNS)
+    if catalog_path and os.path.exists(catalog_path):
+        existing = read_catalog(catalog_path)
+    existing = existing.set_index("path")
+    # Drop the records of deleted files
+    existing = existing.loc[[os.path.exists(path) for path in existing.index]]
+
+    records = []
+    new_paths = []
+    for path in map(str, paths):
+        if path in existing.index and existing.loc[
+            path, "modified"
+        ] == os.path.getmtime(path):
+            records.append({"path": path, **existing.loc[path].to_dict()})
+        else:
+            new_paths.append(path)
+
+    logger.info("Catalog %s new or modified files", len(new_paths))
+    get_record = partial(_get_catalog_record_or_none, time=time)
+    if max_workers:
+        # HDF5 isn't thread safe, files are read in separate processes
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            new_records = list(executor.map(get_record, new_paths))
+    else:
+        new_records = map(get_record, new_paths)
+    records += [record for record in new_records if record]
+
+    catalog = (
+        pd.DataFrame(records, columns=CATALOG_COLUMNS)
+        .sort_values(["site", "time_min"])
+        .reset_index(drop=True)
+    )
+    if catalog_path:
+        catalog.to_csv(catalog_path, index=False)
+    return catalog
+
+
+def read_catalog(catalog_path):
+    """Read a catalog saved by build_catalog."""
+    return pd.read_csv(
+        catalog_path,
+        parse_dates=["time_min", "time_max"],
+        dtype={"site": str, "instrument_sn": str, "variables": str},
+        keep_default_na=False,
+    )
+
+
+def get_site_files(catalog, site, variables=None, time_slice=None):
+    """
+    Retrieve the catalog records of the files needed to get a site data.
+    :param catalog: catalog dataframe or path to the catalog csv
+    :param site: site name
+    :param variables: list of variables, only files with any of them are kept
+    :param time_slice: slice(start, end) of the time range needed
+    :return: catalog records sorted by time
+    """
+    if isinstance(catalog, (str, os.PathLike)):
+        catalog = read_catalog(catalog)
+    is_needed = catalog["site"] == site
+    if variables:
+        is_needed &= (
+            catalog["variables"]
+            .str.split()
+            .apply(
+                lambda file_variables: bool(set(variables).intersection(file_variables))
+            )
+        )
+    if time_slice is not None:
+        if time_slice.start is not None:
+            is_needed &= catalog["time_max"] >= get_time_bound(time_slice.start)
+        if time_slice.stop is not None:
+            is_needed &= catalog["time_min"] <= get_time_bound(time_slice.stop, True)
+    return catalog.loc[is_needed].sort_values("time_min")
+
+
+def open_site(catalog, site, variables=None, time_slice=None, time="time", **kwargs):
+    """
+    Lazily open a site deployment history by concatenating along time the
+    files overlapping the time_slice. Data is only read when accessed.
+    :param catalog: catalog dataframe or path to the catalog csv
+    :param site: site name
+    :param variables: list of variables to retrieve, default to all
+    :param time_slice: slice(start, end) of the time range to retrieve
+    :param time: time variable
+    :param kwargs: extra arguments passed to xr.open_mfdataset
+    :return: dask backed xarray dataset
+    """
+    files = get_site_files(catalog, site, variables, time_slice)
+    if files.empty:
+        raise RuntimeError(
+            f"No files available for site={site} variables={variables} time_slice={time_slice}"
+        )
+
+    def _preprocess(ds):
+        if variables:
+            ds = ds[[var for var in variables if var in ds]]
+        if time_slice is not None:
+            ds = ds.sel({time: time_slice})
+        return ds
+
+    logger.info("Open %s files for %s", len(files), site)
+    open_kwargs = {
+        "combine": "nested",
+        "concat_dim": time,
+        "data_vars": "minimal",
+        "coords": "minimal",
+        "compat": "override",
+        "preprocess": _preprocess,
+    }
+    open_kwargs.update(kwargs)
+    if files["path"].str.endswith(".zarr").any():
+        open_kwargs["engine"] = "zarr"
+    return xr.open_mfdataset(files["path"].tolist(), **open_kwargs)
@@ -0,0 +1,129 @@
+"""
+Figures module present a queue of figure jobs which the processing tools can emit
+plot specifications into. The figures are rendered later, in a background process
+pool, at a configurable resolution or not at all.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class FigureJob:
+    """
+    Specification of a figure to render.
+    :param plot_function: picklable function called as plot_function(fig, *args, **kwargs)
+    :param path: path where to save the figure
+    :param figsize: figure size in inches
+    :param dpi: default resolution of the figure
+    :param savefig_kwargs: extra arguments passed to Figure.savefig
+    """
+
+    def __init__(
+        self,
+        plot_function,
+        path,
+        args=(),
+        kwargs=None,
+        figsize=None,
+        dpi=None,
+        savefig_kwargs=None,
+    ):
+        self.plot_function = plot_function
+        self.path = path
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.figsize = figsize
+        self.dpi = dpi
+        self.savefig_kwargs = savefig_kwargs or {}
+
+    def render(self, dpi=None):
+        """Render the figure and save it to path."""
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=self.figsize)
+        self.plot_function(fig, *self.args, **self.kwargs)
+        fig.savefig(
+            self.path, dpi=dpi or self.dpi or "figure", **self.savefig_kwargs
+        )
+        return self.path
+
+
+def render_figure_job(job, dpi=None):
+    """Render a figure job, used by the process pool workers."""
+    return job.render(dpi=dpi)
+
+
+class FigureQueue:
+    """
+    Queue of figure jobs to render once the numerical processing is completed.
+    :param enabled: if False, figure jobs are ignored and never rendered
+    :param dpi: resolution used for all figures, overwrite the jobs default
+    :param max_workers: maximum number of processes used to render the figures
+    """
+
+    def __init__(self, enabled=True, dpi=None, max_workers=None):
+        self.enabled = enabled
+        self.dpi = dpi
+        self.max_workers = max_workers
+        self.jobs = []
+        self._executor = None
+        self._futures = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, plot_function, path, *args, **kwargs):
+        """
+        Add a figure job to the queue.
+        :param plot_function: picklable function called as plot_function(fig, *args, **kwargs)
+        :param path: path where to save the figure
+        :param figsize: figure size in inches
+        :param dpi: default resolution of the figure
+        :param savefig_kwargs: extra arguments passed to Figure.savefig
+        """
+        if not self.enabled:
+            return
+        job_kwargs = {
+            key: kwargs.pop(key)
+            for key in ("figsize", "dpi", "savefig_kwargs")
+            if key in kwargs
+        }
+        self.jobs.append(FigureJob(plot_function, path, args, kwargs, **job_kwargs))
+
+    def render(self, dpi=None, wait_for_results=True):
+        """
+        Render all the queued figures in a background process pool.
+        :param dpi: resolution used for all figures, default to the queue dpi
+        :param wait_for_results: wait for all figures to be rendered
+        :return: paths of the figures rendered if wait_for_results otherwise futures
+        """
+        if not self.enabled or not self.jobs:
+            return []
+        dpi = dpi or self.dpi
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        futures = [
+            self._executor.submit(render_figure_job, job, dpi) for job in self.jobs
+        ]
+        self.jobs = []
+        self._futures += futures
+        if wait_for_results:
+            return self.wait()
+        return futures
+
+    def wait(self):
+        """Wait for all the figures submitted to be rendered and shut down the process pool."""
+        if self._executor is None:
+            return []
+        wait(self._futures)
+        paths = []
+        for future in self._futures:
+            if future.exception():
+                logger.error("Failed to render figure", exc_info=future.exception())
+            else:
+                paths.append(future.result())
+        self._executor.shutdown()
+        self._executor = None
+        self._futures = []
+        return paths
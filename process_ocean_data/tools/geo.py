@@ -1,9 +1,6 @@
 import re
 
 import numpy as np
-import requests
-from bs4 import BeautifulSoup
-from scipy.optimize import minimize
 
 
 def dms2dd(s):
@@ -38,6 +35,9 @@ def get_mag_dec_from_nrcan(time, lat, lon):
     Retrieve the magnetic declination for a specific site and time from the NRCAN website
     # Output the magnetic declination value and the rate of annual change East positive in degrees
     """
+    import requests
+    from bs4 import BeautifulSoup
+
     # Get Date from datetime object
     date = time.strftime("%Y-%m-%d")
 
@@ -95,6 +95,7 @@ def trilateration_from_utm(distances_to_station, stations_coordinates):
     #https://github.com/glucee/Multilateration/blob/master/Python/example.py
      Trilateration from UTM coordinates and distance from target.
     """
+    from scipy.optimize import minimize
 
     def error(x, c, r):
         return sum([(np.linalg.norm(x - c[i]) - r[i]) ** 2 for i in range(len(c))])
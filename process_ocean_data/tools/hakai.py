@@ -5,10 +5,8 @@ import re
 import warnings
 import os
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import utm
 from pytz import timezone
 
 from . import geo
@@ -47,7 +45,30 @@ def convert_hakai_datetime(date_str):
     return date
 
 
-def transform_hakai_log(df, dest_dir, print_figure=False, get_mag_dec=False):
+def plot_triangulation(fig, utm_loc, site_range, utm_triang, title):
+    """Generate a figure of the triangulation stations ranges and resulting location."""
+    from matplotlib.patches import Circle
+
+    ax = fig.add_subplot()
+    for pos in range(len(utm_loc[1])):
+        ax.scatter(utm_loc[1][pos], utm_loc[0][pos], color="b")
+        cc = Circle(
+            (utm_loc[1][pos], utm_loc[0][pos]),
+            site_range[pos],
+            alpha=0.1,
+            edgecolor="k",
+        )
+        ax.add_artist(cc)
+    ax.scatter(utm_triang[1], utm_triang[0], color="r")
+    ax.set_aspect("equal")
+    ax.set_xlabel("East UTM [m]")
+    ax.set_ylabel("North UTM [m]")
+    ax.set_title(title)
+
+
+def transform_hakai_log(
+    df, dest_dir, print_figure=False, get_mag_dec=False, figure_queue=None
+):
     """
     The transform_hakai_log function apply the following transformation to the Hakai Log
     Apply transformations to Hakai log
@@ -56,7 +77,11 @@ def transform_hakai_log(df, dest_dir, print_figure=False, get_mag_dec=False):
      - Convert lat/long to decimal degrees
      - Compute trilateration if available
      - Generate standard Hakai File Name
+    If a FigureQueue is given as figure_queue, the triangulation figures are added to it
+    instead of being rendered within the loop.
     """
+    import utm
+
     # Convert latitude/longitude string data to decimal
     for col in df.filter(regex="latitude|Latitude|Longitude|longitude").columns:
         if df[col].dtypes == object:
@@ -158,30 +183,29 @@ def transform_hakai_log(df, dest_dir, print_figure=False, get_mag_dec=False):
             df.at[index, "Longitude:Triangulation_Results"] = ll_triang[1]
 
             # Make a figure of the result
-            if print_figure:
+            figure_args = (
+                dest_dir + dd["file_name"] + "_triangulation.png",
+                utm_loc[:2],
+                site_range,
+                utm_triang,
+                dd["file_name"],
+            )
+            if print_figure and figure_queue is not None:
+                figure_queue.add(
+                    plot_triangulation,
+                    *figure_args,
+                    figsize=[10, 10],
+                    savefig_kwargs={"facecolor": "w", "format": "png"},
+                )
+            elif print_figure:
+                import matplotlib.pyplot as plt
+
                 print("Generate Figure")
-                fig, ax = plt.subplots(figsize=[10, 10])
-                for pos in range(len(utm_loc[1])):
-                    plt.scatter(utm_loc[1][pos], utm_loc[0][pos], color="b")
-                    cc = plt.Circle(
-                        (utm_loc[1][pos], utm_loc[0][pos]),
-                        site_range[pos],
-                        alpha=0.1,
-                        edgecolor="k",
-                    )
-                    ax.add_artist(cc)
-                plt.scatter(utm_triang[1], utm_triang[0], color="r")
-                ax.set_aspect("equal")
-                plt.xlabel("East UTM [m]")
-                plt.ylabel("North UTM [m]")
-                plt.title(dd["file_name"])
+                fig = plt.figure(figsize=[10, 10])
+                plot_triangulation(fig, *figure_args[1:])
 
                 # Output Figure for future reference
-                fig.savefig(
-                    dest_dir + dd["file_name"] + "_triangulation.png",
-                    facecolor="w",
-                    format="png",
-                )
+                fig.savefig(figure_args[0], facecolor="w", format="png")
 
     # Create a position field which is the triangulation position
     # if available otherwise it would be the deployment location
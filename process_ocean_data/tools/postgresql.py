@@ -1,84 +1,760 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from io import StringIO
+from itertools import islice
 import csv
 import logging
+import os
+import time
+import weakref
+
+import numpy as np
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + b"\x00" * 8
+PGCOPY_TRAILER = b"\xff\xff"
+# Postgres epoch used by the binary timestamp format
+PG_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
 
-def update_database_table(
-    df, table, conn, distinct_columns=None, schema=None, if_row_exist="UPDATE"
+
+class _CopySource(ABC):
+    """
+    File-like object generating the data of a COPY FROM STDIN command lazily, batch
+    per batch, as requested by cursor.copy_expert through read(size). Subclasses
+    generate the batches with _iter_batches.
+    """
+
+    _empty = ""
+
+    def __init__(self):
+        self._batches = self._iter_batches()
+        self._buffer = self._empty
+        self._position = 0
+
+    @abstractmethod
+    def _iter_batches(self):
+        """Generate the successive batches of data"""
+
+    def read(self, size=-1):
+        pieces = []
+        n_read = 0
+        while size is None or size < 0 or n_read < size:
+            if self._position >= len(self._buffer):
+                self._buffer = next(self._batches, None)
+                self._position = 0
+                if self._buffer is None:
+                    self._buffer = self._empty
+                    break
+            end = (
+                len(self._buffer)
+                if size is None or size < 0
+                else self._position + size - n_read
+            )
+            piece = self._buffer[self._position : end]
+            self._position += len(piece)
+            n_read += len(piece)
+            pieces.append(piece)
+        return self._empty.join(pieces)
+
+    def readline(self):
+        # COPY FROM only relies on read, readline is given for file-like compatibility
+        line = []
+        while True:
+            character = self.read(1)
+            line.append(character)
+            if not character or character in ("\n", b"\n"):
+                return self._empty.join(line)
+
+
+class CSVCopySource(_CopySource):
+    """
+    CSV COPY source generated in batches of batch_size rows.
+    :param data: dataframe or iterable of rows
+    :param batch_size: number of rows serialized at once
+    """
+
+    def __init__(self, data, batch_size=10000):
+        self.data = data
+        self.batch_size = batch_size
+        super().__init__()
+
+    def _iter_batches(self):
+        if isinstance(self.data, pd.DataFrame):
+            for start in range(0, len(self.data), self.batch_size):
+                yield self.data.iloc[start : start + self.batch_size].to_csv(
+                    header=False, index=False
+                )
+            return
+
+        rows = iter(self.data)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return
+            s_buf = StringIO()
+            csv.writer(s_buf).writerows(batch)
+            yield s_buf.getvalue()
+
+
+def _get_binary_fields(series):
+    """Retrieve the big endian binary values of a column and its missing values mask"""
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+    values = series.to_numpy()
+    if values.dtype.kind == "M":
+        is_null = np.isnat(values)
+        values = (values.astype("datetime64[us]") - PG_EPOCH).astype(">i8")
+    elif values.dtype.kind == "f":
+        is_null = np.isnan(values)
+        values = values.astype(">f%s" % values.dtype.itemsize)
+    elif values.dtype.kind in "iu":
+        is_null = np.zeros(len(values), dtype=bool)
+        # Postgres has no 1 byte integer
+        values = values.astype(">i%s" % max(values.dtype.itemsize, 2))
+    elif values.dtype.kind == "b":
+        is_null = np.zeros(len(values), dtype=bool)
+        values = values.astype("u1")
+    else:
+        raise RuntimeError(
+            f"Column {series.name} of type {series.dtype} can't be copied in binary format"
+        )
+    fields = np.ascontiguousarray(values).view("u1").reshape(len(values), -1)
+    return fields, is_null
+
+
+class BinaryCopySource(_CopySource):
+    """
+    PostgreSQL binary COPY source generated in batches of batch_size rows. Only numeric,
+    boolean and datetime columns are supported and their types must match the
+    destination columns types (ex: float64 -> double precision, int32 -> integer,
+    datetime64 -> timestamp).
+    :param df: dataframe
+    :param batch_size: number of rows serialized at once
+    """
+
+    _empty = b""
+
+    def __init__(self, df, batch_size=10000):
+        self.df = df
+        self.batch_size = batch_size
+        super().__init__()
+
+    def _iter_batches(self):
+        yield PGCOPY_HEADER
+        for start in range(0, len(self.df), self.batch_size):
+            yield self._get_batch(self.df.iloc[start : start + self.batch_size])
+        yield PGCOPY_TRAILER
+
+    def _get_batch(self, df):
+        columns = [_get_binary_fields(df[col]) for col in df.columns]
+        n_rows = len(df)
+
+        # Each tuple: number of fields then for each field its length and value
+        row_sizes = np.full(n_rows, 2 + 4 * len(columns), dtype=np.int64)
+        for fields, is_null in columns:
+            row_sizes += np.where(is_null, 0, fields.shape[1])
+        positions = np.zeros(n_rows, dtype=np.int64)
+        positions[1:] = np.cumsum(row_sizes[:-1])
+        buffer = np.empty(row_sizes.sum(), dtype="u1")
+
+        buffer[positions[:, None] + np.arange(2)] = np.frombuffer(
+            np.array(len(columns), dtype=">i2").tobytes(), dtype="u1"
+        )
+        positions += 2
+        for fields, is_null in columns:
+            field_size = fields.shape[1]
+            lengths = np.where(is_null, -1, field_size).astype(">i4").view("u1")
+            buffer[positions[:, None] + np.arange(4)] = lengths.reshape(n_rows, 4)
+            positions += 4
+            is_valid = ~is_null
+            buffer[positions[is_valid, None] + np.arange(field_size)] = fields[is_valid]
+            positions[is_valid] += field_size
+        return buffer.tobytes()
+
+
+def _quote(columns):
+    return ", ".join(f'"{col}"' for col in columns)
+
+
+def _get_upsert_sql(table_name, columns, distinct_columns, if_row_exist, tmp_table):
+    """Generate the statement inserting a temporary table into the destination table"""
+    if distinct_columns:
+        on_conflict = f"ON CONFLICT ({_quote(distinct_columns)}) DO "
+        if if_row_exist == "UPDATE":
+            excluded = ", ".join(f'EXCLUDED."{col}"' for col in columns)
+            on_conflict += f"UPDATE SET ({_quote(columns)}) = ROW({excluded})"
+        else:
+            on_conflict += "NOTHING"
+    else:
+        on_conflict = ""
+    # Rows inserted have no xmax while rows updated on conflict do
+    return (
+        f"WITH upserted AS (INSERT INTO {table_name} ({_quote(columns)}) "
+        f"SELECT {_quote(columns)} FROM {tmp_table} {on_conflict} "
+        "RETURNING (xmax = 0) AS inserted) "
+        "SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) "
+        "FROM upserted"
+    )
+
+
+def copy_upsert(
+    df,
+    table_name,
+    dbapi_conn,
+    distinct_columns=None,
+    if_row_exist="UPDATE",
+    copy_format="csv",
+    batch_size=10000,
+    commit_every=None,
+    tmp_table="tmp_table",
+    commit=True,
 ):
     """
-    Method use to update database table, it first upload to
-    a temporary table, which then update the original table with any new sample that aren't available already.
+    Stream a dataframe to a temporary table with COPY FROM STDIN and insert it into the
+    destination table, updating or ignoring the existing rows. A failed transaction
+    is rolled back before the error is raised.
+    :param df: dataframe with the columns to upload
+    :param table_name: destination table name including the schema if needed
+    :param dbapi_conn: DBAPI connection providing cursor.copy_expert (ex: psycopg2)
+    :param distinct_columns: columns of the conflict target
+    :param if_row_exist: "UPDATE" existing rows or do "NOTHING"
+    :param copy_format: "csv" or "binary", the binary format needs the dataframe dtypes
+        to match the table columns types
+    :param batch_size: number of rows serialized at once
+    :param commit_every: number of rows uploaded and committed per transaction,
+        default to a single transaction
+    :param tmp_table: temporary table name
+    :param commit: commit each transaction and roll it back on failure. Use False if
+        the connection transaction is handled by the caller (ex: the DBAPI connection
+        of a sqlalchemy Connection), the temporary table is then dropped after each
+        upsert and nothing is committed or rolled back.
+    :return: dictionary of the number of rows "inserted" and "updated"
     """
+    if copy_format == "binary":
+        copy_source, copy_options = BinaryCopySource, "(FORMAT binary)"
+    elif copy_format == "csv":
+        copy_source, copy_options = CSVCopySource, "CSV"
+    else:
+        raise RuntimeError(f"Unknown copy format {copy_format}")
 
-    def psql_insert_copy(table, conn, keys, data_iter):
-        """
-        Execute SQL statement inserting data into a postgresql db with using COPY from CSV to a temporary table and then update on conflict or nothing
-
-        Parameters
-        ----------
-        table : pandas.io.sql.SQLTable
-        conn : sqlalchemy.engine.Engine or sqlalchemy.engine.Connection
-        keys : list of str
-            Column names
-        data_iter : Iterable that iterates the values to be inserted
-        """
-        # gets a DBAPI connection that can provide a cursor
-        dbapi_conn = conn.connection
+    columns = list(df.columns)
+    upsert_sql = _get_upsert_sql(
+        table_name, columns, distinct_columns, if_row_exist, tmp_table
+    )
+    counts = {"inserted": 0, "updated": 0}
+    commit_every = commit_every or max(len(df), 1)
+    for start in range(0, len(df), commit_every):
+        df_chunk = df.iloc[start : start + commit_every]
+        try:
+            with dbapi_conn.cursor() as cur:
+                cur.execute(
+                    f"CREATE TEMP TABLE {tmp_table} "
+                    f"(LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP"
+                )
+                cur.copy_expert(
+                    sql=f"COPY {tmp_table} ({_quote(columns)}) FROM STDIN WITH {copy_options}",
+                    file=copy_source(df_chunk, batch_size=batch_size),
+                )
+                cur.execute(upsert_sql)
+                inserted, updated = cur.fetchone()
+                if not commit:
+                    cur.execute(f"DROP TABLE {tmp_table}")
+            if commit:
+                dbapi_conn.commit()
+        except Exception:
+            if commit:
+                dbapi_conn.rollback()
+            raise
+        counts["inserted"] += inserted
+        counts["updated"] += updated
+        logger.debug("Uploaded rows %s to %s", start + len(df_chunk), table_name)
+    return counts
+
+
+TABLE_COLUMNS_SQL = """
+SELECT column_name FROM information_schema.columns
+WHERE table_schema = coalesce(%(schema)s, current_schema())
+AND table_name = %(table)s
+ORDER BY ordinal_position
+"""
+
+# Columns of the primary key and unique indexes (partial and expression indexes can't
+# be used as a conflict target)
+TABLE_KEYS_SQL = """
+SELECT index_class.relname, i.indisprimary, a.attname
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_class index_class ON index_class.oid = i.indexrelid
+CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+WHERE n.nspname = coalesce(%(schema)s, current_schema())
+AND c.relname = %(table)s
+AND i.indisunique AND i.indpred IS NULL AND 0 <> ALL(i.indkey::int2[])
+ORDER BY i.indisprimary DESC, index_class.relname, k.ord
+"""
+
+_table_info_cache = weakref.WeakKeyDictionary()
+
+
+def _get_dbapi_connection(conn):
+    """Retrieve a DBAPI connection from a sqlalchemy engine or connection"""
+    if hasattr(conn, "raw_connection"):
+        return conn.raw_connection()
+    return getattr(conn, "connection", conn)
+
+
+def _get_catalog_table_info(cur, table, schema=None):
+    params = {"table": table, "schema": schema}
+    cur.execute(TABLE_COLUMNS_SQL, params)
+    columns = [row[0] for row in cur.fetchall()]
+    if not columns:
+        return None
+
+    cur.execute(TABLE_KEYS_SQL, params)
+    keys = {}
+    primary_key = []
+    for index_name, is_primary, column in cur.fetchall():
+        keys.setdefault(index_name, []).append(column)
+        if is_primary:
+            primary_key = keys[index_name]
+    unique_keys = [key for key in keys.values() if key is not primary_key]
+    return {"columns": columns, "primary_key": primary_key, "unique_keys": unique_keys}
+
+
+def get_table_info(conn, table, schema=None, dbapi_conn=None):
+    """
+    Retrieve a table columns, primary key and unique keys from the database catalog
+    without reading the table. Results are cached per connection. If the catalog
+    can't be read, only the columns are retrieved with an empty query.
+    Engines are queried through a new connection from their pool, other connections
+    query the catalog within a savepoint so a failure doesn't abort the caller's
+    transaction.
+    :param conn: sqlalchemy engine or connection, or DBAPI connection
+    :param table: table name
+    :param schema: table schema, default to the connection current schema
+    :param dbapi_conn: DBAPI connection of conn to use if conn isn't an engine,
+        default to the connection from conn
+    :return: dictionary with the table "columns", "primary_key" and "unique_keys"
+    """
+    try:
+        cache = _table_info_cache.setdefault(conn, {})
+    except TypeError:
+        # Connection can't be weak referenced
+        cache = {}
+    if (schema, table) in cache:
+        return cache[(schema, table)]
+
+    own_connection = hasattr(conn, "raw_connection")
+    if own_connection:
+        dbapi_conn = conn.raw_connection()
+    elif dbapi_conn is None:
+        dbapi_conn = _get_dbapi_connection(conn)
+    use_savepoint = not own_connection and not getattr(dbapi_conn, "autocommit", False)
+    table_name = f"{schema}.{table}" if schema else table
+    try:
         with dbapi_conn.cursor() as cur:
-            s_buf = StringIO()
-            writer = csv.writer(s_buf)
-            writer.writerows(data_iter)
-            s_buf.seek(0)
+            if use_savepoint:
+                cur.execute("SAVEPOINT get_table_info")
+            try:
+                table_info = _get_catalog_table_info(cur, table, schema)
+            except Exception as error:
+                logger.warning(
+                    "Failed to read %s from the catalog: %s", table_name, error
+                )
+                if use_savepoint:
+                    cur.execute("ROLLBACK TO SAVEPOINT get_table_info")
+                elif own_connection:
+                    dbapi_conn.rollback()
+                table_info = None
+            if use_savepoint:
+                cur.execute("RELEASE SAVEPOINT get_table_info")
+            if table_info is None:
+                cur.execute(f"SELECT * FROM {table_name} LIMIT 0")
+                table_info = {
+                    "columns": [column[0] for column in cur.description],
+                    "primary_key": [],
+                    "unique_keys": [],
+                }
+    finally:
+        if own_connection:
+            dbapi_conn.close()
+    cache[(schema, table)] = table_info
+    return table_info
+
+
+def clear_table_info_cache(conn=None):
+    """Clear the cached tables information of a connection or of all connections"""
+    if conn is None:
+        _table_info_cache.clear()
+    else:
+        _table_info_cache.pop(conn, None)
+
+
+def _get_conflict_target(table_info, columns):
+    """Retrieve the primary key or first unique key fully available within columns"""
+    for key in [table_info["primary_key"]] + table_info["unique_keys"]:
+        if key and all(col in columns for col in key):
+            return key
+    return None
 
-            columns = ", ".join(f'"{k}"' for k in keys)
-            table_name = f"{table.schema}.{table.name}" if table.schema else table.name
-            if distinct_columns:
-                on_conflict = f"ON CONFLICT ({','.join(distinct_columns)}) DO "
-                if if_row_exist == "UPDATE":
-                    on_conflict += f"UPDATE  SET ({','.join(available_columns)}) = ({','.join([f'EXCLUDED.{item}' for item in available_columns])})"
 
+def get_row_hashes(df):
+    """Hash each row of a dataframe as a signed 64 bits integer (postgres bigint)"""
+    return pd.util.hash_pandas_object(df, index=False).values.view("int64")
+
+
+def _to_python(value):
+    """Convert pandas and numpy scalars to python objects supported by the DBAPI"""
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _align_dtypes(df, reference):
+    """Cast the columns retrieved from the database to the reference dtypes"""
+    for col in df.columns:
+        if df[col].dtype == reference[col].dtype:
+            continue
+        try:
+            if pd.api.types.is_datetime64_any_dtype(reference[col]):
+                df[col] = pd.to_datetime(df[col], utc=True)
+                if reference[col].dt.tz is None:
+                    df[col] = df[col].dt.tz_localize(None)
                 else:
-                    on_conflict += "NOTHING"
+                    df[col] = df[col].dt.tz_convert(reference[col].dt.tz)
             else:
-                on_conflict = ""
-
-            sql = f"""
-            CREATE TEMP TABLE tmp_table
-            (LIKE {table_name} INCLUDING DEFAULTS)
-            ON COMMIT DROP;
-
-            COPY tmp_table ({columns}) FROM STDIN WITH CSV;
-        
-            INSERT INTO {table_name}
-            SELECT * FROM tmp_table
-            {on_conflict};
-            """
-            cur.copy_expert(sql=sql, file=s_buf)
-
-    # Sort columns to be same as datbase ignore the extra variables
-    table_columns = list(
-        conn.execute(f"SELECT * FROM {schema+'.' or ''}{table}").keys()
+                df[col] = df[col].astype(reference[col].dtype)
+        except (TypeError, ValueError):
+            logger.warning("Failed to cast column %s to %s", col, reference[col].dtype)
+    return df
+
+
+def get_changed_rows(df, table_name, dbapi_conn, key_columns, hash_column=None):
+    """
+    Retrieve the rows of a dataframe which are new or different from the rows
+    already in the table. The existing rows within the range of the key columns
+    values are retrieved in one query and compared through a hash of each row.
+    :param df: dataframe with the columns to upload
+    :param table_name: table name including the schema if needed
+    :param dbapi_conn: DBAPI connection
+    :param key_columns: columns identifying each row (ex: primary key)
+    :param hash_column: column of the table storing the hash of each row, if
+        available only the keys and hashes are retrieved and the rows with a NULL
+        hash are considered changed. The hash is added to the returned rows.
+    :return: dataframe of the new or changed rows
+    """
+    columns = [col for col in df.columns if col != hash_column]
+    row_hashes = get_row_hashes(df[columns])
+    if hash_column:
+        df = df.assign(**{hash_column: row_hashes})
+    if df.empty:
+        return df
+
+    selected_columns = key_columns + [hash_column] if hash_column else columns
+    conditions = " AND ".join(
+        f'"{col}" BETWEEN %(min_{id})s AND %(max_{id})s'
+        for id, col in enumerate(key_columns)
+    )
+    params = {}
+    for id, col in enumerate(key_columns):
+        params[f"min_{id}"] = _to_python(df[col].min())
+        params[f"max_{id}"] = _to_python(df[col].max())
+    with dbapi_conn.cursor() as cur:
+        cur.execute(
+            f"SELECT {_quote(selected_columns)} FROM {table_name} WHERE {conditions}",
+            params,
+        )
+        # Keep the stored hashes as python integers, NULL hashes would turn
+        # an inferred int64 column into a lossy float64 column
+        df_existing = pd.DataFrame(
+            cur.fetchall(),
+            columns=selected_columns,
+            dtype=object if hash_column else None,
+        )
+    if df_existing.empty:
+        return df
+
+    if hash_column:
+        # Rows written without hash (NULL) are considered changed
+        existing_hashes = df_existing.pop(hash_column)
+        has_hash = existing_hashes.notna().values
+        existing_hashes = existing_hashes.where(has_hash, 0).values.astype("int64")
+    df_existing = _align_dtypes(df_existing, df)
+    if not hash_column:
+        has_hash = np.ones(len(df_existing), dtype=bool)
+        existing_hashes = get_row_hashes(df_existing[columns])
+    existing_positions = pd.MultiIndex.from_frame(df_existing[key_columns]).get_indexer(
+        pd.MultiIndex.from_frame(df[key_columns])
+    )
+    is_changed = (
+        (existing_positions < 0)
+        | ~has_hash[existing_positions]
+        | (existing_hashes[existing_positions] != row_hashes)
     )
-    available_columns = [
-        col for col in table_columns if col in df or col in df.index.names
-    ]
-    df_update = df.reset_index()[available_columns]
-
-    logging.info(f"Append data to table {table}")
-    df_update.to_sql(
-        table,
-        schema=schema,
-        if_exists="append",
-        con=conn,
-        index=False,
-        method=psql_insert_copy,
+    logger.info(
+        "%s new or changed rows out of %s for %s",
+        is_changed.sum(),
+        len(df),
+        table_name,
     )
+    return df.loc[is_changed]
 
 
-def psql_insert_copy(table, conn, keys, data_iter):
+def update_database_table(
+    df,
+    table,
+    conn,
+    distinct_columns=None,
+    schema=None,
+    if_row_exist="UPDATE",
+    copy_format="csv",
+    batch_size=10000,
+    commit_every=None,
+    only_changed=False,
+    hash_column=None,
+    commit=True,
+):
+    """
+    Method use to update database table, it first upload to
+    a temporary table, which then update the original table with any new sample that aren't available already.
+    The data is streamed to the database in batches of batch_size rows.
+    :param df: dataframe to upload, index levels matching table columns are uploaded too
+    :param table: table name
+    :param conn: sqlalchemy engine or connection
+    :param distinct_columns: columns of the conflict target, default to the table
+        primary key or first unique key available within the dataframe
+    :param schema: table schema
+    :param if_row_exist: "UPDATE" existing rows or do "NOTHING"
+    :param copy_format: "csv" or "binary" (see copy_upsert)
+    :param batch_size: number of rows serialized at once
+    :param commit_every: number of rows committed per transaction
+    :param only_changed: only upload the rows which are new or different from the
+        existing rows (see get_changed_rows), requires a conflict target
+    :param hash_column: table column storing the hash of each row, used and filled
+        when only_changed is True
+    :param commit: commit each transaction and roll it back on failure. Use False
+        with a sqlalchemy connection to upload the data within its transaction,
+        which is then committed or rolled back by the caller.
+    :return: dictionary of the number of rows "inserted" and "updated"
+    """
+    # gets a DBAPI connection that can provide a cursor
+    dbapi_conn = _get_dbapi_connection(conn)
+    try:
+        # Sort columns to be same as datbase ignore the extra variables
+        table_info = get_table_info(conn, table, schema, dbapi_conn)
+        available_columns = [
+            col for col in table_info["columns"] if col in df or col in df.index.names
+        ]
+        df_update = df.reset_index()[available_columns]
+        if distinct_columns is None:
+            distinct_columns = _get_conflict_target(table_info, available_columns)
+
+        logging.info(f"Append data to table {table}")
+        table_name = f"{schema}.{table}" if schema else table
+        if only_changed:
+            if not distinct_columns:
+                raise RuntimeError(
+                    f"Can't detect changed rows without the {table_name} keys"
+                )
+            df_update = get_changed_rows(
+                df_update[[col for col in available_columns if col != hash_column]],
+                table_name,
+                dbapi_conn,
+                distinct_columns,
+                hash_column=hash_column,
+            )
+            if df_update.empty:
+                return {"inserted": 0, "updated": 0}
+        return copy_upsert(
+            df_update,
+            table_name,
+            dbapi_conn,
+            distinct_columns=distinct_columns,
+            if_row_exist=if_row_exist,
+            copy_format=copy_format,
+            batch_size=batch_size,
+            commit_every=commit_every,
+            commit=commit,
+        )
+    finally:
+        if hasattr(conn, "raw_connection"):
+            dbapi_conn.close()
+
+
+def iter_partitions(data, partition_by=None, time_column=None, time_freq="M"):
+    """
+    Split dataframes in partitions.
+    :param data: dataframe or iterable of dataframes (ex: parsed files)
+    :param partition_by: columns to partition by (ex: ["instrument_sn"])
+    :param time_column: time column to partition by periods of time_freq
+    :param time_freq: pandas period frequency of the time partitions, default to month
+    :return: generator of (partition key, dataframe)
+    """
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    for id, df in enumerate(data):
+        keys = [df[col] for col in partition_by or []]
+        if time_column:
+            keys.append(pd.to_datetime(df[time_column]).dt.to_period(time_freq))
+        if not keys:
+            yield (id,), df
+            continue
+        for key, df_partition in df.groupby(keys, sort=False):
+            yield (id, *(key if isinstance(key, tuple) else (key,))), df_partition
+
+
+def _load_partition(
+    engine, df, table_name, partition_id, max_retries, retry_delay, **kwargs
+):
+    """Upsert a partition in a single transaction, retrying on failure"""
+    for attempt in range(1, max_retries + 2):
+        dbapi_conn = None
+        try:
+            dbapi_conn = engine.raw_connection()
+            counts = copy_upsert(
+                df,
+                table_name,
+                dbapi_conn,
+                tmp_table=f"tmp_partition_{partition_id}",
+                **kwargs,
+            )
+            return {**counts, "attempts": attempt, "error": None}
+        except Exception as error:
+            logger.warning(
+                "Failed to load partition %s to %s (attempt %s): %s",
+                partition_id,
+                table_name,
+                attempt,
+                error,
+            )
+            if attempt > max_retries:
+                return {
+                    "inserted": 0,
+                    "updated": 0,
+                    "attempts": attempt,
+                    "error": error,
+                }
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+        finally:
+            if dbapi_conn is not None:
+                dbapi_conn.close()
+
+
+def _get_partition_result(future, key, table_name):
+    """Retrieve a partition result, an unexpected error is reported in the summary"""
+    try:
+        return future.result()
+    except Exception as error:
+        logger.warning("Failed to load partition %s to %s: %s", key, table_name, error)
+        return {"inserted": 0, "updated": 0, "attempts": 0, "error": error}
+
+
+def load_partitions(
+    data,
+    table,
+    engine,
+    partition_by=None,
+    time_column=None,
+    time_freq="M",
+    schema=None,
+    distinct_columns=None,
+    if_row_exist="UPDATE",
+    max_workers=4,
+    max_retries=2,
+    retry_delay=1,
+    copy_format="csv",
+    batch_size=10000,
+    max_pending=None,
+):
+    """
+    Load large dataframes to a database table by partitions upserted concurrently over
+    the engine connection pool. Each partition is copied to its own temporary table and
+    upserted in a single transaction, which is retried on failure, connection errors
+    included. Since existing rows are updated or ignored, a partition can safely be
+    loaded again. The partitions are read from data as the previous ones are loaded.
+    :param data: dataframe or iterable of dataframes (ex: parsed files)
+    :param table: table name
+    :param engine: sqlalchemy engine, its pool size should be at least max_workers
+    :param partition_by: columns to partition by (ex: ["instrument_sn"])
+    :param time_column: time column to partition by periods of time_freq
+    :param time_freq: pandas period frequency of the time partitions, default to month
+    :param schema: table schema
+    :param distinct_columns: columns of the conflict target, default to the table keys
+    :param if_row_exist: "UPDATE" existing rows or do "NOTHING"
+    :param max_workers: number of partitions loaded concurrently
+    :param max_retries: number of retries of a failed partition
+    :param retry_delay: seconds to wait before the first retry, doubled on each retry
+    :param copy_format: "csv" or "binary" (see copy_upsert)
+    :param batch_size: number of rows serialized at once
+    :param max_pending: maximum number of partitions submitted and not loaded yet,
+        which bounds the partitions held in memory, default to twice max_workers
+    :return: summary dataframe of the rows, inserted, updated, attempts and error
+        of each partition
+    """
+    table_info = get_table_info(engine, table, schema)
+    table_name = f"{schema}.{table}" if schema else table
+    max_pending = max_pending or 2 * (max_workers or os.cpu_count() or 1)
+
+    results = {}
+    pending = {}
+
+    def _collect(futures):
+        for future in futures:
+            key, n_rows = pending.pop(future)
+            results[key] = {
+                "rows": n_rows,
+                **_get_partition_result(future, key, table_name),
+            }
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for partition_id, (key, df) in enumerate(
+            iter_partitions(data, partition_by, time_column, time_freq)
+        ):
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done)
+            results[key] = None
+            df = df.reset_index()
+            columns = [col for col in table_info["columns"] if col in df]
+            future = executor.submit(
+                _load_partition,
+                engine,
+                df[columns],
+                table_name,
+                partition_id,
+                max_retries,
+                retry_delay,
+                distinct_columns=distinct_columns
+                or _get_conflict_target(table_info, columns),
+                if_row_exist=if_row_exist,
+                copy_format=copy_format,
+                batch_size=batch_size,
+            )
+            pending[future] = (key, len(df))
+        _collect(wait(pending).done)
+
+    summary = pd.DataFrame(
+        list(results.values()), index=pd.MultiIndex.from_tuples(list(results.keys()))
+    )
+    failed = summary["error"].notnull()
+    if failed.any():
+        logger.error("Failed to load %s partitions to %s", failed.sum(), table_name)
+    logger.info(
+        "Loaded %s rows to %s: %s inserted, %s updated",
+        summary["rows"].sum(),
+        table_name,
+        summary["inserted"].sum(),
+        summary["updated"].sum(),
+    )
+    return summary
+
+
+def psql_insert_copy(table, conn, keys, data_iter, batch_size=10000):
     """
     Execute SQL statement inserting data
 
@@ -93,12 +769,7 @@ def psql_insert_copy(table, conn, keys, data_iter):
     # gets a DBAPI connection that can provide a cursor
     dbapi_conn = conn.connection
     with dbapi_conn.cursor() as cur:
-        s_buf = StringIO()
-        writer = csv.writer(s_buf)
-        writer.writerows(data_iter)
-        s_buf.seek(0)
-
         columns = ", ".join(f'"{k}"' for k in keys)
         table_name = f"{table.schema}.{table.name}" if table.schema else table.name
         sql = f"COPY {table_name} ({columns}) FROM STDIN WITH CSV"
-        cur.copy_expert(sql=sql, file=s_buf)
+        cur.copy_expert(sql=sql, file=CSVCopySource(data_iter, batch_size=batch_size))
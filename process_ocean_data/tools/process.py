@@ -1,106 +1,296 @@
-import matplotlib.pyplot as plt
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 import xarray as xr
 
-from ioos_qc.config import QcConfig
+from . import qc
 
+logger = logging.getLogger(__name__)
 
-def detect_start_end(
-    ds,
-    time_variable,
-    pressure_variable,
+START_END_RESULTS = [
+    "first_good_record_time",
+    "last_good_record_time",
+    "cut_lead_ensembles",
+    "cut_trail_ensembles",
+    "pressure_offset_deployment",
+    "pressure_offset_retrieval",
+    "instrument_depth",
+]
+
+
+def _nanmedian(values):
+    """Median ignoring NaN values which returns NaN if no value is available."""
+    values = values[~np.isnan(values)]
+    return np.median(values) if values.size else np.nan
+
+
+def _get_start_end_results(
+    time,
+    pressure,
     good_data_mask=None,
     pressure_threshold=3,
     pressure_difference_threshold=0.3,
-    time_dim="time",
-    plot_results=True,
-    figure_path="detect_deployment_startend.png",
 ):
-
-    # Create mask of good data
-    is_good_data = (ds[pressure_variable] > pressure_threshold) & (
-        abs(ds[pressure_variable].diff(time_dim)) < pressure_difference_threshold
+    """
+    Compute the deployment start and end results from the 1D time and pressure arrays.
+    :return: dictionary of the results and the index of the good records
+    """
+    # Create mask of good data, the first record has no previous record to compare with
+    is_good_data = np.zeros(pressure.shape, dtype=bool)
+    is_good_data[1:] = (pressure[1:] > pressure_threshold) & (
+        np.abs(np.diff(pressure)) < pressure_difference_threshold
     )
     # Is mask input if given
     if good_data_mask is not None:
-        is_good_data = is_good_data & good_data_mask
+        is_good_data &= np.asarray(good_data_mask, dtype=bool)
+
+    good_index = np.flatnonzero(is_good_data)
+    if good_index.size == 0:
+        raise RuntimeError("No good pressure records detected")
+    first_good_index = good_index[0]
+    last_good_index = good_index[-1]
+
+    results = {
+        "first_good_record_time": time[first_good_index],
+        "last_good_record_time": time[last_good_index],
+        "cut_lead_ensembles": int(first_good_index),
+        "cut_trail_ensembles": len(time) - int(last_good_index),
+        # Review in air pressure value for offset
+        "pressure_offset_deployment": _nanmedian(pressure[:first_good_index]),
+        "pressure_offset_retrieval": _nanmedian(pressure[last_good_index + 1 :]),
+        "instrument_depth": pressure[good_index].mean(),
+    }
+    return results, good_index
 
-    ds_cropped = ds.where(is_good_data, drop=True)
 
-    first_good_record_time = ds_cropped[time_variable].min()
-    last_good_record_time = ds_cropped[time_variable].max()
+def plot_start_end(time, pressure, good_index, results, axes, label=None):
+    """
+    Plot the deployment and retrieval periods on two axes.
+    :param time: 1D time array
+    :param pressure: 1D pressure array
+    :param good_index: index of the good records
+    :param results: detect_start_end results
+    :param axes: deployment and retrieval axes
+    :param label: label added to the axes titles
+    """
+    for ax, title in zip(axes, ["Deployment", "Retrieval"]):
+        ax.plot(time, pressure, label="RAW")
+        ax.plot(time[good_index], pressure[good_index], label="GOOD")
+        ax.set_title(title if label is None else f"{label} - {title}")
+    axes[1].yaxis.tick_right()
+    axes[1].yaxis.set_label_position("right")
 
-    cut_lead_ensembles = int(
-        (ds[time_variable] == first_good_record_time.values).argmin().values
+    # Try to zoom within 1 hour of deployment and retrieval times if possible
+    time_interval = pd.Timedelta(hours=1)
+    axes[0].set_xlim(
+        [
+            results["first_good_record_time"] - time_interval,
+            results["first_good_record_time"] + time_interval,
+        ]
     )
-    cut_trail_ensembles = len(ds[time_variable]) - int(
-        (ds[time_variable] == last_good_record_time.values).argmax().values
+    axes[1].set_xlim(
+        [
+            results["last_good_record_time"] - time_interval,
+            results["last_good_record_time"] + time_interval,
+        ]
     )
+    axes[0].legend()
+    for ax in axes:
+        for tick in ax.get_xticklabels():
+            tick.set_rotation(30)
+            tick.set_horizontalalignment("right")
+
+
+def plot_start_end_figure(fig, time, pressure, good_index, results, label=None):
+    """Generate the deployment and retrieval figure of a single instrument."""
+    axes = fig.subplots(ncols=2)
+    plot_start_end(time, pressure, good_index, results, axes, label=label)
+
 
-    # Review in air pressure value for offset
-    pressure_offset_deployment = xr.where(
-        (ds[time_variable] < first_good_record_time), ds[pressure_variable], np.nan
-    ).median()
+def plot_start_end_summary_figure(fig, instruments):
+    """
+    Generate a multi-panel figure of the deployment and retrieval of multiple instruments.
+    :param fig: matplotlib figure
+    :param instruments: list of (label, time, pressure, good_index, results)
+    """
+    axes = fig.subplots(nrows=len(instruments), ncols=2, squeeze=False)
+    for ax, (label, time, pressure, good_index, results) in zip(axes, instruments):
+        plot_start_end(time, pressure, good_index, results, ax, label=label)
+    fig.tight_layout()
 
-    pressure_offset_retrieval = xr.where(
-        (ds[time_variable] > last_good_record_time), ds[pressure_variable], np.nan
-    ).median()
+
+def detect_start_end(
+    ds,
+    time_variable,
+    pressure_variable,
+    good_data_mask=None,
+    pressure_threshold=3,
+    pressure_difference_threshold=0.3,
+    time_dim="time",
+    plot_results=True,
+    figure_path="detect_deployment_startend.png",
+    figure_queue=None,
+):
+    """
+    Detect the first and last in water records of a deployment based on the pressure
+    record. Only the 1D time and pressure arrays are loaded, the rest of the dataset
+    is never copied.
+    :param ds: Dataset to review
+    :param time_variable: time variable name
+    :param pressure_variable: pressure variable name
+    :param good_data_mask: extra 1D boolean mask along time_dim of good records
+    :param pressure_threshold: minimum pressure of in water records
+    :param pressure_difference_threshold: maximum pressure difference with the previous record
+    :param time_dim: time dimension name
+    :param plot_results: generate a figure of the results
+    :param figure_path: path where to save the figure
+    :param figure_queue: FigureQueue where to add the figure instead of rendering it
+    :return: dictionary of the results
+    """
+    time = ds[time_variable].values
+    pressure = ds[pressure_variable].transpose(time_dim).values
+    results, good_index = _get_start_end_results(
+        time,
+        pressure,
+        good_data_mask,
+        pressure_threshold,
+        pressure_difference_threshold,
+    )
 
     print(
         "Pressure Offset [pre, post] = ["
-        + str(pressure_offset_deployment.values)
+        + str(results["pressure_offset_deployment"])
         + ", "
-        + str(pressure_offset_retrieval.values)
+        + str(results["pressure_offset_retrieval"])
         + "]"
     )
 
-    instrument_depth = ds_cropped[pressure_variable].mean()
-
-    if plot_results:
-        # Show resulting values
-        fig, axes = plt.subplots(ncols=2)
-
-        ds[pressure_variable].plot(label="RAW", ax=axes[0])
-        ds_cropped[pressure_variable].plot(label="GOOD", ax=axes[0])
-        axes[0].set_title("Deployment")
-        ds[pressure_variable].plot(label="RAW", ax=axes[1])
-        ds_cropped[pressure_variable].plot(label="GOOD", ax=axes[1])
-        axes[1].set_title("Retrieval")
-        axes[1].yaxis.tick_right()
-        axes[1].yaxis.set_label_position("right")
-
-        # Try to zoom within 1 hour of deployment and retrieval times if possible
-
-        time_interval = pd.Timedelta(hours=1)
-        axes[0].set_xlim(
-            [
-                first_good_record_time.values - time_interval,
-                first_good_record_time.values + time_interval,
-            ]
-        )
-        axes[1].set_xlim(
-            [
-                last_good_record_time.values - time_interval,
-                last_good_record_time.values + time_interval,
-            ]
+    if plot_results and figure_queue is not None:
+        figure_queue.add(
+            plot_start_end_figure,
+            figure_path,
+            time,
+            pressure,
+            good_index,
+            results,
+            dpi=300,
         )
+    elif plot_results:
+        import matplotlib.pyplot as plt
 
-        axes[0].legend()
+        # Show resulting values
+        fig = plt.figure()
+        plot_start_end_figure(fig, time, pressure, good_index, results)
         plt.draw()
         plt.savefig(figure_path, dpi=300)
 
     return {
-        "first_good_record_time": first_good_record_time,
-        "last_good_record_time": last_good_record_time,
-        "cut_lead_ensembles": cut_lead_ensembles,
-        "cut_trail_ensembles": cut_trail_ensembles,
-        "pressure_offset_deployment": pressure_offset_deployment,
-        "pressure_offset_retrieval": pressure_offset_retrieval,
-        "instrument_depth": instrument_depth,
+        key: value if key.startswith("cut_") else xr.DataArray(value)
+        for key, value in results.items()
     }
 
 
+def detect_start_end_batch(
+    datasets,
+    time_variable="time",
+    pressure_variable="PRESPR01",
+    good_data_masks=None,
+    pressure_threshold=3,
+    pressure_difference_threshold=0.3,
+    time_dim="time",
+    max_workers=None,
+    plot_results=False,
+    figure_path="detect_deployment_startend_summary.png",
+    dpi=300,
+    figure_queue=None,
+):
+    """
+    Detect the first and last in water records of multiple instruments at once.
+    Each instrument is processed in a thread pool and the figure rendering is
+    only done once all the results are computed.
+    :param datasets: list or dictionary of datasets
+    :param time_variable: time variable name
+    :param pressure_variable: pressure variable name
+    :param good_data_masks: list or dictionary of masks matching the datasets
+    :param pressure_threshold: minimum pressure of in water records
+    :param pressure_difference_threshold: maximum pressure difference with the previous record
+    :param time_dim: time dimension name
+    :param max_workers: maximum number of threads used
+    :param plot_results: generate a multi-panel summary figure of all the instruments
+    :param figure_path: path where to save the summary figure
+    :param dpi: resolution of the summary figure
+    :param figure_queue: FigureQueue where to add the summary figure instead of rendering it
+    :return: DataFrame of the results with one row per instrument
+    """
+    if not isinstance(datasets, dict):
+        datasets = dict(enumerate(datasets))
+    if good_data_masks is None:
+        good_data_masks = {}
+    elif not isinstance(good_data_masks, dict):
+        good_data_masks = dict(enumerate(good_data_masks))
+
+    def _get_instrument_results(item):
+        instrument, ds = item
+        time = ds[time_variable].values
+        pressure = ds[pressure_variable].transpose(time_dim).values
+        try:
+            results, good_index = _get_start_end_results(
+                time,
+                pressure,
+                good_data_masks.get(instrument),
+                pressure_threshold,
+                pressure_difference_threshold,
+            )
+        except RuntimeError:
+            logger.warning("Failed to detect start and end of %s", instrument)
+            return instrument, None, None
+        return instrument, results, (time, pressure, good_index)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        instruments_results = list(
+            executor.map(_get_instrument_results, datasets.items())
+        )
+
+    df = pd.DataFrame(
+        [results or {} for _, results, _ in instruments_results],
+        index=pd.Index([instrument for instrument, _, _ in instruments_results]),
+        columns=START_END_RESULTS,
+    )
+    df.index.name = "instrument"
+
+    if not plot_results:
+        return df
+
+    instruments = [
+        (instrument, *data, results)
+        for instrument, results, data in instruments_results
+        if results
+    ]
+    if not instruments:
+        logger.warning("No start and end detected, skip the summary figure")
+        return df
+
+    figsize = [10, 3 * len(instruments)]
+    if figure_queue is not None:
+        figure_queue.add(
+            plot_start_end_summary_figure,
+            figure_path,
+            instruments,
+            figsize=figsize,
+            dpi=dpi,
+        )
+    else:
+        import matplotlib.pyplot as plt
+
+        fig = plt.figure(figsize=figsize)
+        plot_start_end_summary_figure(fig, instruments)
+        fig.savefig(figure_path, dpi=dpi)
+        plt.close(fig)
+    return df
+
+
 def update_flag(ds, var, mask, true_flag=None, false_flag=None, history=""):
     # Keep attributes associated to variable
     temp_var = ds[var]
@@ -119,24 +309,545 @@ def update_flag(ds, var, mask, true_flag=None, false_flag=None, history=""):
     return ds
 
 
-def run_qartod(df, config, time="time", depth="depth"):
-    # Run QARTOD tests
-    # We are using the deprecated QcConfig method and hopefully will move
-    #  to a new stream method soon.
+ADCP_VELOCITY_FLAG_VARIABLES = ["LCEWAP01_QC", "LCNSAP01_QC", "LRZAAP01_QC"]
+
+
+def flag_adcp_surface_and_side_lobe(
+    ds,
+    variables=None,
+    depth="depth",
+    pressure="PPSAADCP",
+    beam_angle=None,
+    cell_size=None,
+    bad_flag=4,
+    good_flag=1,
+):
+    """
+    Flag ADCP velocity records out of water or within the surface side lobe
+    contaminated region. The masks are computed once and applied to all the
+    flag variables, records not flagged yet are flagged as good.
+    Works the same with dask backed datasets.
+    :param ds: ADCP dataset
+    :param variables: flag variables to update, default to the velocity flag variables
+    :param depth: depth variable of each bin
+    :param pressure: instrument pressure variable
+    :param beam_angle: beam angle in degrees, default to ds.attrs["beam_angle"]
+    :param cell_size: bin size in meters, default to ds.attrs["cellSize"]
+    :param bad_flag: flag given to out of water and side lobe records
+    :param good_flag: flag given to records not flagged yet
+    :return: dataset with int8 flag variables
+    """
+    if variables is None:
+        variables = ADCP_VELOCITY_FLAG_VARIABLES
+    if beam_angle is None:
+        beam_angle = int(ds.attrs["beam_angle"])
+    if cell_size is None:
+        cell_size = ds.attrs["cellSize"]
+
+    side_lobe_coefficient = 1 - np.cos(np.deg2rad(beam_angle))
+    side_lobe_depth = ds[pressure] * side_lobe_coefficient + cell_size
+    # Missing depths compare as False and are flagged bad
+    is_bad = ~((ds[depth] > side_lobe_depth) & (ds[depth] > 0))
 
-    # TODO this is a deprecated method and we should move on the Stream method in the near future.
-    for var in config.keys():
-        qc = QcConfig(config[var])
-        qc_result = qc.run(
-            inp=df[var],
-            tinp=df[time],
-            zinp=df[depth],
+    for var in variables:
+        flag = ds[var]
+        ds[var] = (
+            xr.where(is_bad, bad_flag, flag.fillna(good_flag))
+            .astype("int8")
+            .transpose(*flag.dims)
         )
+        ds[var].attrs = flag.attrs
+    return ds
+
+
+CF_ENCODING_KEYS = (
+    "dtype",
+    "_FillValue",
+    "scale_factor",
+    "add_offset",
+    "units",
+    "calendar",
+)
+
+
+def _get_cf_encoding(var):
+    """Keep the dtype, packing and time units a variable was read with."""
+    return {
+        key: value for key, value in var.encoding.items() if key in CF_ENCODING_KEYS
+    }
+
+
+def get_chunked_netcdf_encoding(
+    ds, chunks=None, complevel=4, chunk_bytes=2**18, time_dim="time"
+):
+    """
+    Generate a NetCDF4 encoding compressing all the numeric variables with zlib and
+    storing them in chunks. The dtype, _FillValue and packing of each variable
+    encoding are kept.
+    :param ds: dataset to save
+    :param chunks: dictionary of chunk size per dimension, default to the dask chunks
+        of each variable or to time chunks of about chunk_bytes
+    :param complevel: zlib compression level
+    :param chunk_bytes: approximate uncompressed size of the default time chunks
+    :param time_dim: time dimension
+    :return: encoding dictionary to pass to ds.to_netcdf
+    """
+    chunks = chunks or {}
+    encoding = {}
+    for var in ds.variables:
+        if ds[var].dtype.kind not in "biuf" or not ds[var].dims:
+            continue
+        cf_encoding = _get_cf_encoding(ds[var])
+        if ds[var].chunks:
+            var_chunks = tuple(
+                min(chunks.get(dim, dim_chunks[0]), size)
+                for dim, dim_chunks, size in zip(
+                    ds[var].dims, ds[var].chunks, ds[var].shape
+                )
+            )
+        else:
+            var_chunks = _get_time_chunks(
+                ds[var], chunks, chunk_bytes, time_dim, cf_encoding.get("dtype")
+            )
+        encoding[var] = {
+            **cf_encoding,
+            "zlib": True,
+            "complevel": complevel,
+            "contiguous": False,
+            "chunksizes": var_chunks,
+        }
+    return encoding
+
+
+def _is_flag_variable(var):
+    return (
+        "flag_values" in var.attrs
+        or "flag_meanings" in var.attrs
+        or var.name.endswith(("_flag", "_test", "_QC"))
+    )
+
+
+def _get_output_dtype(var, atol):
+    """
+    Smallest dtype preserving the variable values within atol. Dask variables are
+    kept as is since the check would compute them before they are written.
+    """
+    if _is_flag_variable(var) and var.dtype.kind in "iuf":
+        return "int8"
+    if isinstance(atol, dict):
+        atol = atol.get(var.name)
+    if var.dtype != np.float64 or atol is None or var.chunks:
+        return None
+    if float(abs(var - var.astype("float32")).max()) <= atol:
+        return "float32"
+
+
+def _get_time_chunks(var, chunks, chunk_bytes, time_dim, dtype):
+    """Chunk along time with the full extent of the other dimensions."""
+    itemsize = np.dtype(dtype or var.dtype).itemsize
+    record_size = itemsize * int(
+        np.prod([size for dim, size in zip(var.dims, var.shape) if dim != time_dim])
+    )
+    var_chunks = []
+    for dim, size in zip(var.dims, var.shape):
+        if dim in chunks:
+            var_chunks.append(min(chunks[dim], size))
+        elif dim == time_dim:
+            var_chunks.append(min(max(chunk_bytes // record_size, 1), size))
+        else:
+            var_chunks.append(size)
+    return tuple(var_chunks)
+
+
+def get_output_encoding(
+    ds,
+    output_format="netcdf",
+    chunks=None,
+    chunk_bytes=2**18,
+    time_dim="time",
+    compression="zlib",
+    complevel=4,
+    atol=1e-6,
+):
+    """
+    Generate the encoding used to save processed datasets:
+        - flag variables are stored as int8
+        - float64 variables are stored as float32 if the round trip error is within
+          atol, dask variables are kept as float64 to avoid computing them twice
+        - integer and packed (scale_factor/add_offset) variables keep the dtype and
+          _FillValue they were read with
+        - numeric variables are compressed and chunked along time, each chunk
+          holding about chunk_bytes of the full extent of the other dimensions,
+          which keeps time slice reads to a few chunks. The zarr variables share
+          the smallest chunk of each dimension to match the dataset dask chunks.
+    :param ds: dataset to save
+    :param output_format: "netcdf" or "zarr"
+    :param chunks: dictionary of chunk size per dimension overwriting the default chunks
+    :param chunk_bytes: approximate uncompressed size of each chunk
+    :param time_dim: time dimension
+    :param compression: "zlib" or "zstd", zstd within NetCDF files requires
+        a netCDF4 library and xarray version supporting the compression encoding
+    :param complevel: compression level
+    :param atol: maximum absolute error accepted to store a variable as float32,
+        can be a dictionary per variable. Variables without tolerance are kept as is.
+    :return: encoding dictionary to pass to ds.to_netcdf or ds.to_zarr
+    """
+    chunks = chunks or {}
+    if output_format == "zarr":
+        from numcodecs import Blosc
+
+        compressor = Blosc(cname=compression, clevel=complevel, shuffle=Blosc.SHUFFLE)
+    elif output_format != "netcdf":
+        raise RuntimeError(f"Unknown output format {output_format}")
+
+    encoding = {}
+    for var in ds.variables:
+        if ds[var].dtype.kind not in "biuf" or not ds[var].dims:
+            continue
+        var_encoding = _get_cf_encoding(ds[var])
+        source_dtype = var_encoding.pop("dtype", None)
+        dtype = _get_output_dtype(ds[var], atol)
+        if (
+            source_dtype is not None
+            and dtype != "int8"
+            and (
+                "scale_factor" in var_encoding
+                or "add_offset" in var_encoding
+                or np.dtype(source_dtype).kind in "iu"
+            )
+        ):
+            # Keep the integer or packed dtype the variable was read with
+            dtype = source_dtype
+        if dtype:
+            var_encoding["dtype"] = dtype
+            if dtype == "int8" and ds[var].dtype.kind == "f":
+                var_encoding["_FillValue"] = -1
+        var_chunks = _get_time_chunks(ds[var], chunks, chunk_bytes, time_dim, dtype)
+        if output_format == "zarr":
+            var_encoding.update({"compressor": compressor, "chunks": var_chunks})
+        else:
+            var_encoding.update(
+                {
+                    "zlib": compression == "zlib",
+                    "complevel": complevel,
+                    "contiguous": False,
+                    "chunksizes": var_chunks,
+                }
+            )
+            if compression != "zlib":
+                var_encoding["compression"] = compression
+        encoding[var] = var_encoding
+
+    if output_format == "zarr":
+        # Variables share the dask chunks of each dimension which have to match the
+        # zarr chunks, keep the smallest chunk of each dimension
+        dim_chunks = _get_dimension_chunks(ds, encoding)
+        for var, var_encoding in encoding.items():
+            var_encoding["chunks"] = tuple(dim_chunks[dim] for dim in ds[var].dims)
+    return encoding
+
+
+def _get_dimension_chunks(ds, encoding):
+    """Smallest zarr chunk size of each dimension across the variables"""
+    dim_chunks = {}
+    for var, var_encoding in encoding.items():
+        for dim, size in zip(ds[var].dims, var_encoding["chunks"]):
+            dim_chunks[dim] = min(size, dim_chunks.get(dim, size))
+    return dim_chunks
+
+
+def save_dataset(ds, path, output_format=None, **kwargs):
+    """
+    Save a processed dataset to NetCDF or zarr with the encoding generated by
+    get_output_encoding.
+    :param ds: dataset to save
+    :param path: output path, saved as zarr if it ends with ".zarr"
+    :param output_format: "netcdf" or "zarr", default based on the path extension
+    :param kwargs: extra arguments passed to get_output_encoding
+    :return: path
+    """
+    if output_format is None:
+        output_format = "zarr" if str(path).endswith(".zarr") else "netcdf"
+    encoding = get_output_encoding(ds, output_format, **kwargs)
+    if output_format == "zarr":
+        # zarr chunks need to match the dask chunks
+        if any(ds[var].chunks for var in encoding):
+            ds = ds.chunk(_get_dimension_chunks(ds, encoding))
+        ds.to_zarr(path, mode="w", encoding=encoding)
+    else:
+        ds.to_netcdf(path, mode="w", format="NETCDF4", encoding=encoding)
+    return path
+
+
+# Tests which only rely on each record independently
+QARTOD_POINTWISE_TESTS = [
+    "aggregate",
+    "climatology_test",
+    "gross_range_test",
+    "location_test",
+    "impossible_date_test",
+    "impossible_location_test",
+]
+# Number of neighbouring records [before, after] needed to run each test
+QARTOD_NEIGHBOUR_TESTS = {
+    "spike_test": [1, 1],
+    "rate_of_change_test": [1, 0],
+    "density_inversion_test": [1, 1],
+}
+
+
+def _get_time_interval_in_seconds(time):
+    """Median time interval in seconds rounded like ioos_qc."""
+    time_interval = np.median(np.diff(time))
+    if np.issubdtype(time.dtype, np.datetime64):
+        time_interval = time_interval.astype("timedelta64[s]")
+    return float(time_interval.astype(float))
+
+
+def get_qartod_overlap(var_config, time=None, chunk_size=None):
+    """
+    Number of records needed before and after each chunk to reproduce the results of
+    a full array run of the tests defined for a variable. Windowed tests
+    (flat_line_test, attenuated_signal_test) are converted to records based on the
+    median time interval of the full time series. Since ioos_qc computes that median
+    on each chunk, the tests can't be split if any chunk median differs from it.
+    :param var_config: ioos_qc configuration of the variable
+    :param time: time array used to convert time windows to records
+    :param chunk_size: number of records per chunk used to check the chunks median
+        time interval
+    :return: [before, after] overlap or None if the tests can't be split in chunks
+    """
+    time_interval = None
+    if time is not None and len(time) > 1:
+        time_interval = _get_time_interval_in_seconds(time)
+
+    overlap = [0, 0]
+    has_window = False
+    for module, tests in var_config.items():
+        for test, kwargs in tests.items():
+            window = None
+            if test in QARTOD_POINTWISE_TESTS:
+                continue
+            elif test in QARTOD_NEIGHBOUR_TESTS:
+                test_overlap = QARTOD_NEIGHBOUR_TESTS[test]
+            elif test == "flat_line_test":
+                window = max(kwargs["suspect_threshold"], kwargs["fail_threshold"])
+            elif test == "attenuated_signal_test" and kwargs.get("test_period"):
+                window = kwargs["test_period"]
+            else:
+                return None
+
+            if window is not None:
+                if not time_interval:
+                    return None
+                has_window = True
+                test_overlap = [int(window / time_interval) + 1, 0]
+            overlap = [
+                max(overlap[0], test_overlap[0]),
+                max(overlap[1], test_overlap[1]),
+            ]
+
+    if has_window and chunk_size:
+        n_records = len(time)
+        for start in range(0, n_records, chunk_size):
+            chunk = time[
+                max(start - overlap[0], 0) : min(
+                    start + chunk_size + overlap[1], n_records
+                )
+            ]
+            if len(chunk) < 2 or _get_time_interval_in_seconds(chunk) != time_interval:
+                return None
+    return overlap
+
+
+def run_qartod_variable(var_config, inp, time=None, depth=None, chunk_size=None):
+    """
+    Run the QARTOD tests of a single variable over overlapping chunks of the time series.
+    The overlap is sized to each test window, so the results match a full array run.
+    :param var_config: ioos_qc configuration of the variable
+    :param inp: data array
+    :param time: time array
+    :param depth: depth array
+    :param chunk_size: number of records per chunk, default to run the full array at once
+    :return: dictionary of int8 flag arrays {module: {test: flags}}
+    """
+    from ioos_qc.config import Config
+    from ioos_qc.results import collect_results
+    from ioos_qc.streams import NumpyStream
+
+    stream_id = "_stream"
+    qc = Config(var_config, default_stream_key=stream_id)
+    n_records = len(inp)
+    overlap = get_qartod_overlap(var_config, time, chunk_size)
+    if chunk_size is None or overlap is None:
+        chunk_size = n_records
+        overlap = [0, 0]
+
+    flags = {}
+    for start in range(0, n_records, max(chunk_size, 1)):
+        end = min(start + chunk_size, n_records)
+        chunk = slice(max(start - overlap[0], 0), min(end + overlap[1], n_records))
+        stream = NumpyStream(
+            inp=inp[chunk],
+            time=None if time is None else time[chunk],
+            z=None if depth is None else depth[chunk],
+        )
+        chunk_results = collect_results(stream.run(qc), how="dict")[stream_id]
+
+        # Only keep the records within the chunk
+        chunk_start = start - chunk.start
+        for module, tests in chunk_results.items():
+            for test, flag in tests.items():
+                if test not in flags.setdefault(module, {}):
+                    flags[module][test] = np.empty(n_records, dtype="int8")
+                flags[module][test][start:end] = np.ma.filled(flag)[
+                    chunk_start : chunk_start + end - start
+                ]
+    return flags
+
+
+def _run_qartod_variable_from_shared_memory(var_config, arrays, chunk_size=None):
+    """
+    Run the QARTOD tests of a variable on arrays stored in shared memory blocks.
+    :param arrays: dictionary of (shared memory name, shape, dtype) for inp, time and depth
+    """
+    from multiprocessing.shared_memory import SharedMemory
+
+    shared_memories = []
+    kwargs = {}
+    try:
+        for key, item in arrays.items():
+            if item is None:
+                kwargs[key] = None
+                continue
+            name, shape, dtype = item
+            shm = SharedMemory(name=name)
+            shared_memories.append(shm)
+            kwargs[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return run_qartod_variable(var_config, chunk_size=chunk_size, **kwargs)
+    finally:
+        kwargs.clear()
+        for shm in shared_memories:
+            shm.close()
+
+
+def _copy_to_shared_memory(values, shared_memories):
+    """Copy an array to a new shared memory block and return its description."""
+    from multiprocessing.shared_memory import SharedMemory
+
+    if values is None:
+        return None
+    values = np.ascontiguousarray(values)
+    shm = SharedMemory(create=True, size=max(values.nbytes, 1))
+    shared_memories.append(shm)
+    np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+    return shm.name, values.shape, values.dtype
+
+
+def run_qartod(
+    df,
+    config,
+    time="time",
+    depth="depth",
+    chunk_size=None,
+    max_workers=1,
+    executor="process",
+):
+    """
+    Run QARTOD tests on each variable of a dataset or dataframe and add the
+    resulting flags as int8 variables/columns named [var]_[module]_[test].
+    Dataset flags get the QARTOD flag_values and flag_meanings attributes and are
+    listed in the ancillary_variables attribute of their variable.
+    Each variable tests can be run in parallel within a thread or process pool, the
+    process pool workers access the data through shared memory.
+    :param df: xarray Dataset or pandas DataFrame
+    :param config: ioos_qc configuration by variable
+    :param time: time variable
+    :param depth: depth variable, ignored if not available
+    :param chunk_size: number of records processed at once, default to all records
+    :param max_workers: number of variables processed in parallel,
+        None to use all the cpus and 1 to run sequentially
+    :param executor: "process" or "thread" pool
+    :return: df with the flags
+    """
+    tinp = df[time].values
+    zinp = df[depth].values if depth in df else None
+
+    if max_workers == 1:
+        qc_results = {
+            var: run_qartod_variable(
+                config[var],
+                df[var].values,
+                time=tinp,
+                depth=zinp,
+                chunk_size=chunk_size,
+            )
+            for var in config.keys()
+        }
+    elif executor == "thread":
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                var: pool.submit(
+                    run_qartod_variable,
+                    config[var],
+                    df[var].values,
+                    time=tinp,
+                    depth=zinp,
+                    chunk_size=chunk_size,
+                )
+                for var in config.keys()
+            }
+            qc_results = {var: future.result() for var, future in futures.items()}
+    elif executor == "process":
+        shared_memories = []
+        try:
+            shared_time = _copy_to_shared_memory(tinp, shared_memories)
+            shared_depth = _copy_to_shared_memory(zinp, shared_memories)
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = {
+                    var: pool.submit(
+                        _run_qartod_variable_from_shared_memory,
+                        config[var],
+                        {
+                            "inp": _copy_to_shared_memory(
+                                df[var].values, shared_memories
+                            ),
+                            "time": shared_time,
+                            "depth": shared_depth,
+                        },
+                        chunk_size=chunk_size,
+                    )
+                    for var in config.keys()
+                }
+                qc_results = {var: future.result() for var, future in futures.items()}
+        finally:
+            for shm in shared_memories:
+                shm.close()
+                shm.unlink()
+    else:
+        raise RuntimeError(f"Unknown executor={executor}")
+
+    # Merge flags back into the dataset
+    for var, qc_result in qc_results.items():
+        flag_names = []
         for module, tests in qc_result.items():
             for test, flag in tests.items():
                 flag_name = var + "_" + module + "_" + test
+                flag_names.append(flag_name)
                 if type(df) is xr.Dataset:
-                    df[flag_name] = (df[var].dims, flag)
+                    df[flag_name] = qc.flags_to_dataarray(
+                        flag,
+                        "QARTOD",
+                        dims=df[var].dims,
+                        attrs={
+                            "long_name": f"{var} {test.replace('_', ' ')}",
+                            "standard_name": f"{test}_quality_flag",
+                        },
+                    )
                 else:
-                    df.loc[flag_name] = flag
+                    df[flag_name] = flag
+        if type(df) is xr.Dataset and flag_names:
+            df[var].attrs["ancillary_variables"] = " ".join(
+                df[var].attrs.get("ancillary_variables", "").split() + flag_names
+            )
     return df
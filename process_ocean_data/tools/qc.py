@@ -1,12 +1,14 @@
 """
 QC Module present a set of tools to manually qc data.
 """
+import json
+import logging
 from logging import disable
-import plotly.graph_objects as go
-from ipywidgets import interactive, HBox, VBox, widgets
-from IPython.display import display
+import numpy as np
+import pandas as pd
 import xarray as xr
-from xarray.core.dataset import Dataset
+
+logger = logging.getLogger(__name__)
 
 flag_conventions = {
     "QARTOD": {
@@ -199,6 +201,415 @@ def compare_flags(flags, convention=None, flag_priority=None):
     return record_flag
 
 
+def get_flag_dtype(convention):
+    """
+    Categorical dtype of a flag convention ordered from the least to the most
+    prioritized flag. Categoricals store each flag as an int8 code.
+    :param convention: flag convention present in flag_conventions or list of flags
+    :return: pandas CategoricalDtype
+    """
+    if isinstance(convention, str):
+        priority = flag_conventions["priority"][convention]
+        flags = [flag for flag in flag_conventions[convention] if flag not in priority]
+        flags += priority
+    else:
+        flags = list(convention)
+    return pd.CategoricalDtype(flags, ordered=True)
+
+
+def to_flag_categorical(flags, convention):
+    """
+    Convert flags to a compact categorical backed by int8 codes.
+    :param flags: array of flags
+    :param convention: flag convention present in flag_conventions or list of flags
+    :return: pandas Categorical, unknown flags are set to NaN
+    """
+    return pd.Categorical(flags, dtype=get_flag_dtype(convention))
+
+
+def flags_to_dataarray(flags, convention, dims="index", attrs=None):
+    """
+    Convert flags to an int8 DataArray with the CF flag_values and flag_meanings
+    attributes. QARTOD flags are stored as is while HAKAI flags are stored as the
+    categorical codes and the flag names as meanings. Records without flag are
+    stored as -1.
+    :param flags: array, Series or Categorical of flags
+    :param convention: flag convention present in flag_conventions
+    :param dims: dimensions of the DataArray
+    :param attrs: extra attributes
+    :return: xarray DataArray
+    """
+    dtype = get_flag_dtype(convention)
+    flags = pd.Categorical(flags, dtype=dtype)
+    attrs = {**(attrs or {}), "flag_convention": convention}
+    if all(isinstance(flag, int) for flag in dtype.categories):
+        values = np.asarray(list(dtype.categories) + [-1], dtype="int8")
+        attrs["flag_values"] = values[:-1]
+        attrs["flag_meanings"] = " ".join(
+            flag_conventions[convention][flag]["Meaning"] for flag in dtype.categories
+        )
+        return xr.DataArray(values.take(flags.codes), dims=dims, attrs=attrs)
+
+    attrs["flag_values"] = np.arange(len(dtype.categories), dtype="int8")
+    attrs["flag_meanings"] = " ".join(dtype.categories)
+    return xr.DataArray(flags.codes.astype("int8"), dims=dims, attrs=attrs)
+
+
+def flags_from_dataarray(da):
+    """
+    Convert an int8 flag DataArray generated by flags_to_dataarray back to a
+    categorical based on its flag_values and flag_meanings attributes.
+    :param da: xarray DataArray of flags
+    :return: pandas Categorical
+    """
+    values = np.asarray(da.values)
+    if np.issubdtype(values.dtype, np.floating):
+        # Fill values masked by xarray
+        values = np.where(np.isnan(values), -1, values)
+    values = values.astype("int8")
+
+    flag_values = np.atleast_1d(da.attrs["flag_values"])
+    convention = da.attrs.get("flag_convention")
+    if convention in flag_conventions and all(
+        isinstance(flag, str) for flag in flag_conventions[convention]
+    ):
+        categories = da.attrs["flag_meanings"].split(" ")
+        return pd.Categorical.from_codes(
+            values, dtype=pd.CategoricalDtype(categories, ordered=True)
+        )
+    dtype = pd.CategoricalDtype(flag_values.tolist(), ordered=True)
+    return pd.Categorical(values, dtype=dtype)
+
+
+def _get_flag_columns(flags):
+    """Retrieve a list of 1D flag arrays from a DataFrame, Dataset, 2D array or list of arrays."""
+    if isinstance(flags, pd.DataFrame):
+        return [flags[col].values for col in flags]
+    elif isinstance(flags, xr.Dataset):
+        return [flags[var].values for var in flags]
+    elif isinstance(flags, dict):
+        flags = list(flags.values())
+    elif isinstance(flags, np.ndarray) and flags.ndim == 2:
+        return [flags[:, id] for id in range(flags.shape[1])]
+    return [
+        values.values if isinstance(values, pd.Series) else values
+        if isinstance(values, pd.Categorical) else np.asarray(values)
+        for values in flags
+    ]
+
+
+def _get_integer_flag_ranks(columns, flag_priority, block_size):
+    """Compute the maximum priority rank of integer flags of each record through a
+    lookup array of each flag rank, unknown flags have a rank of -1."""
+    rank_lookup = np.full(max(flag_priority) + 2, -1, dtype=np.int8)
+    rank_lookup[list(flag_priority)] = np.arange(len(flag_priority), dtype=np.int8)
+    unknown = len(rank_lookup) - 1
+
+    ranks = np.empty(len(columns[0]), dtype=np.int8)
+    # Process by blocks to keep the ranks of all the columns within the cpu cache
+    for start in range(0, len(ranks), block_size):
+        block = slice(start, start + block_size)
+        np.maximum.reduce(
+            [
+                rank_lookup.take(
+                    np.where(
+                        (column[block] < 0) | (column[block] >= unknown),
+                        unknown,
+                        column[block],
+                    )
+                )
+                for column in columns
+            ],
+            out=ranks[block],
+        )
+    return ranks
+
+
+def aggregate_flags(
+    flags, convention=None, flag_priority=None, fill_value=None, block_size=2**16
+):
+    """
+    Vectorized version of compare_flags which aggregates multiple flag columns into a
+    single flag per record by retrieving the most prioritized flag of each record.
+    :param flags: DataFrame, Dataset, 2D array (records x flags) or list of flag arrays
+    :param convention: flag convention present in flag_conventions
+    :param flag_priority: list of flags ordered from the least to most prioritized flag
+    :param fill_value: flag given to records without any known flag,
+        default to the least prioritized flag
+    :param block_size: number of records processed at once for integer flags
+    :return: array of the aggregated flags
+    """
+    if convention and convention in flag_conventions:
+        flag_priority = flag_conventions["priority"][convention]
+    columns = _get_flag_columns(flags)
+
+    is_integer = all(
+        isinstance(column, np.ndarray) and np.issubdtype(column.dtype, np.integer)
+        for column in columns
+    ) and all(
+        isinstance(flag, (int, np.integer)) and 0 <= flag < 2**16
+        for flag in flag_priority
+    )
+    if is_integer:
+        ranks = _get_integer_flag_ranks(columns, flag_priority, block_size)
+    else:
+        ranks = np.full(len(columns[0]), -1, dtype=np.int8)
+        for column in columns:
+            if isinstance(column, pd.Categorical):
+                # Map each category code to its priority rank
+                code_ranks = pd.Index(flag_priority).get_indexer(column.categories)
+                codes = np.append(code_ranks, -1).astype(np.int8).take(column.codes)
+            else:
+                # Flag codes within a categorical ordered by priority are the priority rank
+                codes = pd.Categorical(column, categories=flag_priority).codes
+            np.maximum(ranks, codes, out=ranks)
+
+    if fill_value is None:
+        fill_value = flag_priority[0]
+    ranks[ranks < 0] = len(flag_priority)
+    lookup = np.asarray(
+        list(flag_priority) + [fill_value],
+        dtype=columns[0].dtype if is_integer else None,
+    )
+    return lookup.take(ranks)
+
+
+def map_flags(flags, mapping="QARTOD-HAKAI"):
+    """
+    Map flags from one convention to another through a lookup array.
+    :param flags: array of flags to map
+    :param mapping: mapping present in flag_conventions["mapping"] or a dictionary
+    :return: object array of the mapped flags, unknown flags are mapped to None
+    """
+    if isinstance(mapping, str):
+        mapping = flag_conventions["mapping"][mapping]
+    flags = np.asarray(flags)
+    if np.issubdtype(flags.dtype, np.integer) and all(
+        isinstance(key, int) and key >= 0 for key in mapping
+    ):
+        lookup = np.full(max(mapping) + 2, None, dtype=object)
+        for key, value in mapping.items():
+            lookup[key] = value
+        is_unknown = (flags < 0) | (flags > max(mapping))
+        return lookup.take(np.where(is_unknown, len(lookup) - 1, flags))
+    return pd.Series(flags).map(mapping).astype(object).values
+
+
+def _to_numeric(values):
+    """Convert values (including datetimes) to a float array."""
+    values = values.values if isinstance(values, pd.Series) else np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[ns]").astype("int64").astype(float)
+    return values.astype(float)
+
+
+def _to_numeric_like(values, reference):
+    """Convert plotly axis values (date strings for date axes) to floats comparable with reference."""
+    reference = reference.values if isinstance(reference, pd.Series) else reference
+    if np.issubdtype(np.asarray(reference).dtype, np.datetime64):
+        return _to_numeric(pd.to_datetime(list(values)).tz_localize(None).values)
+    return np.asarray(values, dtype=float)
+
+
+def downsample_minmax(x, y, n_buckets):
+    """
+    Downsample records by keeping the minimum and maximum y value within each of
+    n_buckets equally spaced x intervals.
+    :param x: x values
+    :param y: y values
+    :param n_buckets: number of x intervals
+    :return: sorted positional indexes of the records to keep
+    """
+    x = _to_numeric(x)
+    y = _to_numeric(y)
+    is_valid = np.isfinite(x) & np.isfinite(y)
+    if is_valid.sum() <= 2 * n_buckets:
+        return np.flatnonzero(is_valid)
+    valid_index = np.flatnonzero(is_valid)
+    x, y = x[is_valid], y[is_valid]
+
+    x_min, x_max = x.min(), x.max()
+    buckets = ((x - x_min) / ((x_max - x_min) or 1) * n_buckets).astype(int)
+    buckets = np.minimum(buckets, n_buckets - 1)
+    grouped = pd.Series(y).groupby(buckets)
+    index = []
+    for extreme in ("min", "max"):
+        # Keep the first record matching the bucket extreme
+        hits = np.flatnonzero(y == grouped.transform(extreme).values)
+        _, first_hits = np.unique(buckets[hits], return_index=True)
+        index.append(hits[first_hits])
+    return valid_index[np.union1d(*index)]
+
+
+def downsample_lttb(x, y, n_out):
+    """
+    Downsample records with the Largest-Triangle-Three-Buckets algorithm which keeps
+    the records forming the largest triangles with their neighbouring buckets.
+    :param x: x values
+    :param y: y values
+    :param n_out: number of records to keep
+    :return: sorted positional indexes of the records to keep
+    """
+    x = _to_numeric(x)
+    y = _to_numeric(y)
+    valid_index = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(valid_index) <= n_out or n_out < 3:
+        return valid_index
+    # LTTB requires records sorted along x
+    valid_index = valid_index[np.argsort(x[valid_index], kind="stable")]
+    x, y = x[valid_index], y[valid_index]
+
+    n_records = len(x)
+    bucket_edges = np.linspace(1, n_records - 1, n_out - 1).astype(int)
+    bucket_edges = np.append(bucket_edges, n_records)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n_records - 1
+    previous = 0
+    for id in range(n_out - 2):
+        start, end = bucket_edges[id], bucket_edges[id + 1]
+        next_end = bucket_edges[id + 2]
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(area))
+        selected[id + 1] = previous
+    return np.sort(valid_index[selected])
+
+
+def get_selector_mask(x, y, selector):
+    """
+    Retrieve the records within a plotly box or lasso selector.
+    :param x: x values
+    :param y: y values
+    :param selector: plotly BoxSelector or LassoSelector
+    :return: boolean mask of the selected records
+    """
+    x_values = _to_numeric(x)
+    y_values = _to_numeric(y)
+    if selector.type == "box":
+        x_range = np.sort(_to_numeric_like(selector.xrange, x))
+        y_range = np.sort(_to_numeric_like(selector.yrange, y))
+        return (
+            (x_values >= x_range[0])
+            & (x_values <= x_range[1])
+            & (y_values >= y_range[0])
+            & (y_values <= y_range[1])
+        )
+    elif selector.type == "lasso":
+        from matplotlib.path import Path
+
+        polygon = Path(
+            np.column_stack(
+                [_to_numeric_like(selector.xs, x), _to_numeric_like(selector.ys, y)]
+            )
+        )
+        return polygon.contains_points(np.column_stack([x_values, y_values]))
+    raise RuntimeError(f"Unknown selector type {selector.type}")
+
+
+def write_qc_journal(
+    path,
+    index,
+    variable,
+    flag_column,
+    flag,
+    comment=None,
+    comment_column=None,
+    reviewer=None,
+):
+    """
+    Append a manual review action to a JSON lines journal file.
+    :param path: path to the journal file
+    :param index: index labels of the reviewed records
+    :param variable: variable reviewed
+    :param flag_column: column in which the flag is stored
+    :param flag: flag applied
+    :param comment: comment applied
+    :param comment_column: column in which the comment is stored
+    :param reviewer: name of the reviewer
+    """
+    record = {
+        "timestamp": pd.Timestamp.utcnow().isoformat(),
+        "reviewer": reviewer,
+        "variable": variable,
+        "flag_column": flag_column,
+        "flag": flag.item() if hasattr(flag, "item") else flag,
+        "comment_column": comment_column if comment else None,
+        "comment": comment or None,
+        # Datetime labels are stored as UTC ISO strings
+        "index": json.loads(
+            pd.Series(index).to_json(orient="values", date_format="iso", date_unit="ns")
+        ),
+    }
+    with open(path, "a") as file_handle:
+        file_handle.write(json.dumps(record) + "\n")
+
+
+def read_qc_journal(path):
+    """
+    Read a manual review journal file.
+    :param path: path to the journal file
+    :return: list of journal records
+    """
+    with open(path) as file_handle:
+        return [json.loads(line) for line in file_handle if line.strip()]
+
+
+def _get_journal_positions(index, labels):
+    """Retrieve the row positions of the journal index labels"""
+    if not index.is_unique:
+        raise RuntimeError("A unique index is needed to apply a review journal")
+    if isinstance(index, pd.DatetimeIndex):
+        labels = pd.to_datetime(labels)
+        if index.tz is not None:
+            labels = labels.tz_localize("UTC")
+    positions = index.get_indexer(labels)
+    if (positions < 0).any():
+        logger.warning(
+            "%s journal records are missing from the dataset", (positions < 0).sum()
+        )
+    return positions[positions >= 0]
+
+
+def apply_qc_journal(df, path):
+    """
+    Replay a manual review journal on a dataframe. Later journal records take
+    precedence over the earlier ones.
+    :param df: dataframe to update, indexed by the same labels as the reviewed dataframe
+    :param path: path to the journal file
+    :return: updated dataframe
+    """
+    updates = {}
+    for record in read_qc_journal(path):
+        positions = _get_journal_positions(df.index, record["index"])
+        for column, value in (
+            (record["flag_column"], record["flag"]),
+            (record.get("comment_column"), record.get("comment")),
+        ):
+            if column is None or value is None:
+                continue
+            column_positions, column_values = updates.setdefault(column, ([], []))
+            column_positions.append(positions)
+            column_values.append(np.full(len(positions), value, dtype=object))
+
+    for column, (positions, values) in updates.items():
+        positions = np.concatenate(positions)
+        values = np.concatenate(values)
+        # Keep the last journal value of each record
+        _, last = np.unique(positions[::-1], return_index=True)
+        last = len(positions) - 1 - last
+        if column not in df:
+            df[column] = pd.Series(None, index=df.index, dtype=object)
+        df.iloc[positions[last], df.columns.get_loc(column)] = (
+            pd.Series(values[last]).infer_objects().values
+        )
+    return df
+
+
 def manual_qc_interface(
     df,
     variable_list: list,
@@ -206,16 +617,33 @@ def manual_qc_interface(
     review_flag: str = "_review_flag",
     comment_column: str = "_review_comment",
     default_flag=None,
+    downsample: str = None,
+    max_points: int = 5000,
+    journal_path: str = None,
+    reviewer: str = None,
 ):
     """
     Manually QC interface to manually QC oceanographic data, through a Jupyter notebook.
-    :param default_flag:
+    With downsample, only up to max_points records per flag within the visible x range
+    are sent to the figure and the figure is updated on zoom. Flags are then applied to
+    all the records within the selection area, not only the plotted ones.
+    :param default_flag: flag given to records not reviewed yet
     :param comment_column:
     :param df: DataFrame input to QC
     :param variable_list: Variable List to review
     :param flags: Flag convention used
     :param review_flag:
+    :param downsample: downsampling method "minmax" or "lttb", default to plot all records
+    :param max_points: maximum number of records plotted per flag when downsampling
+    :param journal_path: path to a journal file to which each review action is appended,
+        use apply_qc_journal to replay the review on the dataset. Records are
+        identified by their index labels which should be unique.
+    :param reviewer: name of the reviewer saved in the journal
     """
+    import plotly.graph_objects as go
+    from ipywidgets import interactive, HBox, VBox, widgets
+    from IPython.display import display
+
     #     # Generate a copy of the provided dataframe which will be use for filtering and plotting data|
     #     df_temp = df
 
@@ -231,7 +659,9 @@ def manual_qc_interface(
         )
 
     else:
+        flag_convention = list(flags.keys())
         flag_descriptor = "\n".join([f"{key} = {item}" for key, item in flags.items()])
+    flag_dtype = get_flag_dtype(flag_convention)
 
     # Set Widgets of the interface
     yaxis = widgets.Dropdown(
@@ -298,12 +728,96 @@ def manual_qc_interface(
 
     selected_table = widgets.Output()
 
-    def get_filtered_data(df):
-        """Apply query if available otherwise give back the full dataframe"""
+    # Visible x range and last selection area of the figure
+    state = {"x_range": None, "xvar": xaxis.value, "selector": None}
+    # Filtered row positions partitioned by flag, invalidated if the filter or flag column changes
+    cache = {"key": None, "groups": {}}
+
+    def add_review_flag_column(var):
+        """Create a compact categorical review flag column filled with default_flag if missing"""
+        flag_name = var + review_flag
+        if flag_name not in df:
+            default_code = (
+                flag_dtype.categories.get_loc(default_flag)
+                if default_flag in flag_dtype.categories
+                else -1
+            )
+            df[flag_name] = pd.Categorical.from_codes(
+                np.full(len(df), default_code, dtype="int8"), dtype=flag_dtype
+            )
+        return flag_name
+
+    def get_filtered_positions():
+        """Retrieve the row positions matching the filter if available otherwise all rows"""
         try:
-            return df.query(filter_by.value)
+            is_selected = np.asarray(df.eval(filter_by.value))
         except ValueError:
-            return df
+            return np.arange(len(df))
+        if is_selected.dtype != bool or is_selected.shape != (len(df),):
+            return np.arange(len(df))
+        return np.flatnonzero(is_selected)
+
+    def get_flag_groups():
+        """Retrieve the filtered row positions grouped by flag value"""
+        key = (filter_by.value, yaxis.value + review_flag)
+        if cache["key"] != key:
+            positions = get_filtered_positions()
+            flag_values = df[key[1]].iloc[positions]
+            indices = (
+                pd.Series(positions)
+                .groupby(flag_values.values, sort=False, observed=True)
+                .indices
+            )
+            cache["groups"] = {
+                flag_name: positions[indices.get(flag_name, [])]
+                for flag_name in flags
+            }
+            cache["key"] = key
+        return cache["groups"]
+
+    def update_flag_groups(selected_positions, flag_name, previous_flags):
+        """Move the selected row positions from their previous flag groups to flag_name"""
+        groups = get_flag_groups()
+        changed_flags = set(previous_flags) | {flag_name}
+        for previous_flag in set(previous_flags) - {flag_name}:
+            group = groups.get(previous_flag)
+            if group is None or len(group) == 0:
+                continue
+            index = np.minimum(
+                np.searchsorted(group, selected_positions), len(group) - 1
+            )
+            groups[previous_flag] = np.delete(
+                group, index[group[index] == selected_positions]
+            )
+        groups[flag_name] = np.union1d(groups[flag_name], selected_positions)
+        return changed_flags
+
+    def get_plotted_positions(positions):
+        """Retrieve the records to plot within the visible x range, downsampled if needed"""
+        if not downsample:
+            return positions
+        if state["x_range"]:
+            x = _to_numeric(df[xaxis.value].iloc[positions])
+            x_range = _to_numeric_like(state["x_range"], df[xaxis.value])
+            positions = positions[(x >= x_range[0]) & (x <= x_range[1])]
+        if len(positions) <= max_points:
+            return positions
+        x = df[xaxis.value].iloc[positions]
+        y = df[yaxis.value].iloc[positions]
+        if downsample == "lttb":
+            index = downsample_lttb(x, y, max_points)
+        else:
+            index = downsample_minmax(x, y, max_points // 2)
+        return positions[index]
+
+    def get_trace_data(flag_name):
+        """Retrieve the x, y and row positions to plot for a given flag"""
+        positions = get_plotted_positions(get_flag_groups()[flag_name])
+        return (
+            df[xaxis.value].iloc[positions],
+            df[yaxis.value].iloc[positions],
+            positions,
+        )
 
     # Create the initial plots
     # Plot widget with
@@ -311,6 +825,7 @@ def manual_qc_interface(
         """Generate plots based on the dataframe df, yaxis and xaxis values present
         within the respective widgets and flags in seperate colors"""
         plots = []
+        add_review_flag_column(yaxis.value)
         for flag_name, flag_value in flags.items():
             if type(flag_value) is dict and "Color" in flag_value:
                 flag_color = flag_value["Color"]
@@ -319,13 +834,13 @@ def manual_qc_interface(
                 flag_color = flag_value
                 flag_meaning = flag_value
 
-            df_temp = get_filtered_data(df)
-
-            df_flag = df_temp.loc[df_temp[yaxis.value + review_flag] == flag_name]
+            x, y, positions = get_trace_data(flag_name)
+            # Each trace carries the row positions of its records within df
             plots += [
                 go.Scattergl(
-                    x=df_flag[xaxis.value],
-                    y=df_flag[yaxis.value],
+                    x=x,
+                    y=y,
+                    customdata=positions,
                     mode="markers",
                     name=flag_meaning,
                     marker={"color": flag_color, "opacity": 1},
@@ -356,14 +871,14 @@ def manual_qc_interface(
 
     def update_filter(query_string=None):
         """Update filter report below the filter_by cell"""
-        df_temp = get_filtered_data(df)
+        n_records = len(get_filtered_positions())
 
-        if len(df_temp) == 0:
+        if n_records == 0:
             # Give a message back saying no match and don't change anything else
             filter_by_result.value = "<p style='color:red;'>0 records found</p>"
         else:
             # Update text back and update plot with selection
-            filter_by_result.value = "{0} records found".format(len(df_temp))
+            filter_by_result.value = "{0} records found".format(n_records)
 
     def update_figure(_):
         """Update figure with present x and y items in menu"""
@@ -375,59 +890,76 @@ def manual_qc_interface(
         :param xvar:
         :param yvar:
         """
-        kk = 0
+        if xvar != state["xvar"]:
+            # Reset the visible range if the x axis variable changed
+            state["xvar"] = xvar
+            state["x_range"] = None
+        add_review_flag_column(yvar)
         with f.batch_update():
             f.layout.xaxis.title = xvar
             f.layout.yaxis.title = yvar
-            for plot in _get_plots():
-                f.data[kk].x = plot.x
-                f.data[kk].y = plot.y
-                kk += 1
-
-    def _get_selected_records():
-        """Method to retrieve the x and y coordinates of the records selected with the plotly lasso tool."""
-        xs = []
-        ys = []
-        for layer in figure_data:
-            if layer["selectedpoints"]:
-                xs += list(layer.x[list(layer["selectedpoints"])])
-                ys += list(layer.y[list(layer["selectedpoints"])])
-        return xs, ys
-
-    def _get_selected_indexes(xs, ys):
-        """Method to retrieve dataframe indexes of the selected x,y records shown on the figure."""
-        df_temp = get_filtered_data(df)
-        is_indexes_selected = (
-            df_temp[[xaxis.value, yaxis.value]]
-            .apply(tuple, axis=1)
-            .isin(tuple(zip(xs, ys)))
-        )
-        return df_temp.index[is_indexes_selected].tolist()
+            update_traces()
+
+    def update_traces(flag_names=None):
+        """Update the traces of the given flags, default to all flags"""
+        with f.batch_update():
+            for trace, flag_name in zip(f.data, flags):
+                if flag_names is not None and flag_name not in flag_names:
+                    continue
+                trace.x, trace.y, trace.customdata = get_trace_data(flag_name)
+                # Selected points indexes are not valid anymore
+                trace.selectedpoints = None
+
+    def update_x_range(_, x_range):
+        """Re-query the records within the visible x range on zoom"""
+        state["x_range"] = x_range
+        update_axes(xaxis.value, yaxis.value)
+
+    def store_selector(trace, points, selector):
+        """Keep the selection area to apply flags to the full resolution data"""
+        state["selector"] = selector
+
+    def _get_selected_positions():
+        """Method to retrieve the dataframe row positions of the records selected with the plotly lasso tool."""
+        selected_positions = [
+            np.asarray(layer.customdata)[list(layer.selectedpoints)]
+            for layer in figure_data
+            if layer.selectedpoints
+        ]
+        if not selected_positions:
+            return np.array([], dtype=int)
+        if downsample and state["selector"] is not None:
+            # Plotted records are only a subset, retrieve all the records in the selected area
+            positions = get_filtered_positions()
+            positions = positions[df[yaxis.value].iloc[positions].notnull().values]
+            is_selected = get_selector_mask(
+                df[xaxis.value].iloc[positions],
+                df[yaxis.value].iloc[positions],
+                state["selector"],
+            )
+            return positions[is_selected]
+        return np.sort(np.concatenate(selected_positions).astype(int))
 
     def selection_fn(_):
         """Method to update the table showing the selected records."""
-        xs, ys = _get_selected_records()
-        selected_indexes = _get_selected_indexes(xs, ys)
-        if selected_indexes:
+        selected_positions = _get_selected_positions()
+        if len(selected_positions):
             with selected_table:
                 selected_table.clear_output()
-                display(df.loc[selected_indexes])
+                display(df.iloc[selected_positions])
 
     def update_flag_in_dataframe(_):
         """Tool triggered  when flag is applied to selected records."""
         # Retrieve selected records and flag column
-        xs, ys = _get_selected_records()
-        selected_indexes = _get_selected_indexes(xs, ys)
-        flag_name = yaxis.value + review_flag
+        selected_positions = _get_selected_positions()
         comment_name = yaxis.value + comment_column
 
         # Create a column for the manual flag if it doesn't exist
-        if flag_name not in df:
-            df[flag_name] = default_flag
+        flag_name = add_review_flag_column(yaxis.value)
         # Print below the interface what's happening
         print(
             "Apply {0} to {1} records to {2}".format(
-                flag_selection.value, len(selected_indexes), flag_name
+                flag_selection.value, len(selected_positions), flag_name
             ),
             end="",
         )
@@ -436,14 +968,45 @@ def manual_qc_interface(
         print(" ... ", end="")
 
         # Update flag value within the data frame
-        df.loc[selected_indexes, flag_name] = flag_selection.value
+        previous_flags = df[flag_name].iloc[selected_positions].unique()
+        df.iloc[
+            selected_positions, df.columns.get_loc(flag_name)
+        ] = flag_selection.value
+        if flag_name in (filter_by.value or "") or comment_name in (
+            filter_by.value or ""
+        ):
+            # The filter depends on the reviewed flags
+            cache["key"] = None
 
         # Update comment
         if flag_comment.value:
-            df.loc[selected_indexes, comment_name] = flag_comment.value
+            if comment_name not in df:
+                df[comment_name] = pd.Series(None, index=df.index, dtype=object)
+            df.iloc[
+                selected_positions, df.columns.get_loc(comment_name)
+            ] = flag_comment.value
 
-        # Update figure with the new flags
-        update_figure(True)
+        if journal_path:
+            write_qc_journal(
+                journal_path,
+                df.index[selected_positions],
+                yaxis.value,
+                flag_name,
+                flag_selection.value,
+                comment=flag_comment.value,
+                comment_column=comment_name,
+                reviewer=reviewer,
+            )
+
+        # Update only the figure traces which gained or lost records
+        if cache["key"] is None:
+            update_traces()
+        else:
+            update_traces(
+                update_flag_groups(
+                    selected_positions, flag_selection.value, previous_flags
+                )
+            )
         print("Completed")
 
     # Setup the interaction between the different components
@@ -452,6 +1015,10 @@ def manual_qc_interface(
     apply_filter.on_click(update_figure)
     apply_flag.on_click(update_flag_in_dataframe)
     filter_data = interactive(update_filter, query_string=filter_by)
+    if downsample:
+        f.layout.xaxis.on_change(update_x_range, "range")
+        for trace in f.data:
+            trace.on_selection(store_selector)
 
     # Create the interface layout
     plot_interface = VBox(axis_dropdowns.children)
@@ -478,22 +1045,80 @@ def manual_qc_interface(
     )
 
 
+def _stack_dataframe_block(df, by, stack_name, result_name, keep, dropna, start=0):
+    """Stack the by columns of df into long format, see stack_dataframe_variables"""
+    # Row major values block, each wide row gives len(by) consecutive long rows
+    values = df[by].to_numpy().ravel()
+    if dropna:
+        positions = np.flatnonzero(pd.notnull(values))
+        values = values[positions]
+    else:
+        positions = np.arange(len(values))
+    rows, variables = np.divmod(positions, len(by))
+    del positions
+
+    stacked = {col: df[col].array.take(rows) for col in keep}
+    stacked[stack_name] = pd.Categorical.from_codes(
+        variables.astype("int16"), categories=by
+    )
+    stacked[result_name] = values
+    return pd.DataFrame(
+        stacked, index=pd.RangeIndex(start, start + len(values)), copy=False
+    )
+
+
 def stack_dataframe_variables(
     df,
     by: list,
     stack_name: str,
     result_name: str,
     keep: list = None,
+    dropna: bool = True,
 ):
-    df_to_stack = df.copy()
+    """
+    Stack multiple variables of a wide dataframe into a long format dataframe.
+    :param df: wide dataframe
+    :param by: columns to stack
+    :param stack_name: name of the column listing the stacked column names (categorical)
+    :param result_name: name of the column with the stacked values
+    :param keep: columns repeated for each stacked value, default to all other columns
+    :param dropna: drop the missing stacked values
+    :return: long format dataframe
+    """
     if keep is None:
-        keep = set(df.columns) - by
+        keep = [col for col in df.columns if col not in by]
+    return _stack_dataframe_block(
+        df, list(by), stack_name, result_name, list(keep), dropna
+    )
 
-    # Stack given variables
-    df_stacked = df_to_stack.set_index(keep)[by].stack()
 
-    # Reset indexes and rename the group of stacked values and the resulting stacked column
-    df_stacked.index.names = list(df_stacked.index.names[:-1]) + [stack_name]
-    df_stacked = df_stacked.reset_index()
-    df_stacked.columns = list(df_stacked.columns[:-1]) + [result_name]
-    return df_stacked
+def iter_stack_dataframe_variables(
+    df,
+    by: list,
+    stack_name: str,
+    result_name: str,
+    keep: list = None,
+    dropna: bool = True,
+    chunk_size: int = 100000,
+):
+    """
+    Generate the long format dataframe of stack_dataframe_variables in chunks of
+    chunk_size rows of the wide dataframe.
+    :param chunk_size: number of wide dataframe rows stacked per chunk
+    :return: generator of long format dataframes
+    """
+    if keep is None:
+        keep = [col for col in df.columns if col not in by]
+    start = 0
+    for chunk_start in range(0, len(df), chunk_size):
+        df_stacked = _stack_dataframe_block(
+            df.iloc[chunk_start : chunk_start + chunk_size],
+            list(by),
+            stack_name,
+            result_name,
+            list(keep),
+            dropna,
+            start,
+        )
+        start += len(df_stacked)
+        yield df_stacked
@@ -26,11 +26,14 @@ setup(
         "NetCDF4",
         "IPython",
     ],
-    extras={
+    extras_require={
         "processing": [
             "ioos_qc @ git+https://github.com/HakaiInstitute/ioos_qc.git@development"
         ],
-        "adcp_processing": ["pycurrents_ADCP_processing"],
+        "adcp_processing": ["pycurrents_ADCP_processing", "dask"],
+        "arrow": ["pyarrow"],
+        "zarr": ["zarr"],
+        "dask": ["dask"],
     },
     classifiers=[
         "Programming Language :: Python :: 3",
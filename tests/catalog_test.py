@@ -0,0 +1,90 @@
+from process_ocean_data.tools import catalog
+import unittest
+import tempfile
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def write_yearly_deployments(dest_dir, site="QU5", years=range(2012, 2022)):
+    """Write one hourly deployment file per year"""
+    paths = []
+    for year in years:
+        time = pd.date_range(f"{year}-01-01", f"{year}-12-31 23:00", freq="1H")
+        ds = xr.Dataset(
+            {
+                "TEMP": ("time", np.random.normal(10, 1, len(time))),
+                "PSAL": ("time", np.random.normal(30, 1, len(time))),
+                "station": site,
+            },
+            coords={"time": time},
+            attrs={"instrument_sn": str(year)},
+        )
+        paths.append(os.path.join(dest_dir, f"{site}_{year}.nc"))
+        ds.to_netcdf(paths[-1])
+    return paths
+
+
+class CatalogTests(unittest.TestCase):
+    def test_build_catalog(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = write_yearly_deployments(tmp_dir)
+            paths += write_yearly_deployments(tmp_dir, "QU24", [2020])
+            catalog_path = os.path.join(tmp_dir, "catalog.csv")
+            df = catalog.build_catalog(paths, catalog_path)
+
+            self.assertEqual(len(df), 11)
+            self.assertEqual(
+                df["site"].value_counts().to_dict(), {"QU5": 10, "QU24": 1}
+            )
+            record = df.query("site == 'QU24'").iloc[0]
+            self.assertEqual(record["instrument_sn"], "2020")
+            self.assertEqual(record["variables"], "TEMP PSAL")
+            self.assertEqual(record["time_max"], pd.Timestamp("2020-12-31 23:00"))
+            pd.testing.assert_frame_equal(
+                catalog.build_catalog(paths, max_workers=2), df
+            )
+
+            # Unmodified files are not read again
+            os.remove(paths[0])
+            df_updated = catalog.build_catalog(paths[1:], catalog_path)
+            pd.testing.assert_frame_equal(
+                df_updated,
+                df.query("path != @paths[0]").reset_index(drop=True),
+                check_dtype=False,
+            )
+            pd.testing.assert_frame_equal(
+                catalog.read_catalog(catalog_path), df_updated, check_dtype=False
+            )
+
+            # Deleted files still listed are dropped from the catalog
+            os.remove(paths[1])
+            df_updated = catalog.build_catalog(paths[1:], catalog_path)
+            self.assertNotIn(paths[1], df_updated["path"].tolist())
+            self.assertEqual(len(df_updated), 9)
+
+    @unittest.skipUnless(importlib.util.find_spec("dask"), "dask is not installed")
+    def test_open_site(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = write_yearly_deployments(tmp_dir)
+            df = catalog.build_catalog(paths)
+            time_slice = slice("2015-12-01", "2016-01-31")
+
+            files = catalog.get_site_files(df, "QU5", ["TEMP"], time_slice)
+            self.assertEqual(files["instrument_sn"].tolist(), ["2015", "2016"])
+
+            ds = catalog.open_site(df, "QU5", ["TEMP"], time_slice)
+            self.assertEqual(list(ds.data_vars), ["TEMP"])
+            self.assertIsNotNone(ds["TEMP"].chunks)
+            self.assertEqual(len(ds["time"]), 62 * 24)
+            with xr.open_dataset(paths[4]) as ds_2016:
+                np.testing.assert_array_equal(
+                    ds["TEMP"].sel(time="2016-01").values,
+                    ds_2016["TEMP"].sel(time="2016-01").values,
+                )
+
+            with self.assertRaises(RuntimeError):
+                catalog.open_site(df, "QU24")
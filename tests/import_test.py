@@ -0,0 +1,68 @@
+import subprocess
+import sys
+import unittest
+
+import process_ocean_data
+
+HEAVY_MODULES = [
+    "plotly",
+    "ipywidgets",
+    "IPython",
+    "matplotlib",
+    "utm",
+    "scipy",
+    "bs4",
+    "ioos_qc",
+]
+
+
+def get_import_times(statement):
+    """Run statement in a new interpreter with -X importtime and retrieve the
+    self and cumulative import time in seconds of each module imported."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative_time, module = line[len("import time:") :].split("|")
+        times[module.strip()] = (int(self_time) / 1e6, int(cumulative_time) / 1e6)
+    return times
+
+
+class ImportTimeTests(unittest.TestCase):
+    def test_package_import_budget(self):
+        times = get_import_times("import process_ocean_data")
+        self.assertLess(times["process_ocean_data"][1], 0.5)
+        self.assertNotIn("pandas", times)
+
+    def test_reader_import_budget(self):
+        times = get_import_times("import process_ocean_data.read.onset")
+        for module in HEAVY_MODULES + ["xarray"]:
+            self.assertNotIn(module, times)
+        package_time = sum(
+            self_time
+            for module, (self_time, _) in times.items()
+            if module.startswith("process_ocean_data")
+        )
+        self.assertLess(package_time, 0.2)
+
+    def test_tools_import_budget(self):
+        times = get_import_times(
+            "import process_ocean_data.tools.qc, process_ocean_data.tools.hakai, "
+            "process_ocean_data.tools.geo, process_ocean_data.tools.figures, "
+            "process_ocean_data.tools.process"
+        )
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, times)
+
+    def test_lazy_submodules(self):
+        self.assertIn("read", dir(process_ocean_data))
+        self.assertTrue(callable(process_ocean_data.read.onset.csv))
+        self.assertTrue(callable(process_ocean_data.tools.catalog.open_site))
+        with self.assertRaises(AttributeError):
+            process_ocean_data.missing_module
@@ -1,7 +1,14 @@
 from process_ocean_data import read
 import unittest
+import importlib.util
+import tempfile
+import shutil
+import os
 from glob import glob
 
+import numpy as np
+import pandas as pd
+
 class PMEParserTests(unittest.TestCase):
     def test_txt_parser(self):
         paths = glob("tests/parsers_test_files/pme")
@@ -35,3 +42,245 @@ class RBRParserTests(unittest.TestCase):
         paths = glob('tests/parsers_test_files/rbr/*.txt')
         for path in paths:
             read.rbr.rtext(path)
+
+
+@unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+class ArrowOutputTests(unittest.TestCase):
+    def test_arrow_output(self):
+        import pyarrow as pa
+
+        path = glob("tests/parsers_test_files/onset/**/*.csv")[0]
+        df = read.onset.csv(path, output="dataframe")
+        table = read.onset.csv(path, output="arrow")
+
+        self.assertEqual(table.column_names[:3], list(df.columns[:3]))
+        self.assertTrue(pa.types.is_dictionary(table["instrument_sn"].type))
+        self.assertLess(table.nbytes, df.memory_usage(deep=True).sum())
+        attrs, variables = read.utils.get_arrow_attributes(table)
+        self.assertEqual(attrs["instrument_sn"], df["instrument_sn"].iloc[0])
+        self.assertIn("temperature", variables)
+
+    def test_minidot_arrow_output(self):
+        import pyarrow as pa
+
+        paths = sorted(glob("tests/parsers_test_files/pme/*.txt"))
+        table = read.pme.minidot_txts(paths, output="arrow")
+        df = read.pme.minidot_txts(paths)
+        self.assertEqual(table.num_rows, len(df))
+        self.assertTrue(pa.types.is_dictionary(table["instrument_sn"].type))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "Cat.TXT")
+            with open(path, "w") as f:
+                f.write(
+                    "MiniDOT Logger Concatenated Data File\n"
+                    "Sensor: 7450-647102\n"
+                    "Concatenation Date: 2022-03-10 00:00:00 UTC\n\n"
+                    "DO concentration compensated for salinity: 0.0 PSU\n"
+                    "Saturation computed at elevation: 0.0 meters\n\n"
+                    "Time (sec),BV (Volts),T (deg C),DO (mg/l),Q ()\n"
+                    "(sec),(Volts),(deg C),(mg/l),()\n"
+                    "1646177940,3.48,7.477,10.468,0.984\n"
+                    "1646178540,3.48,7.458,10.471,0.985\n"
+                )
+            table = read.pme.minidot_cat(path, output="arrow")
+        self.assertEqual(table.num_rows, 2)
+        self.assertEqual(table["instrument_sn"][0].as_py(), "7450-647102")
+        self.assertEqual(table["T (deg C)"].to_pylist(), [7.477, 7.458])
+
+    def test_write_parquet_dataset(self):
+        import pyarrow.dataset as pds
+
+        paths = glob("tests/parsers_test_files/van_essen_instruments/ctd_divers/*.MON")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            datasets = [read.van_essen_instruments.MON(path) for path in paths]
+            files = read.utils.write_parquet_dataset(datasets, tmp_dir)
+            # Deployment spans two years
+            self.assertEqual(len(files), 2 * len(paths))
+            self.assertTrue(
+                all("instrument_manufacturer=Van" in file for file in files)
+            )
+
+            dataset = pds.dataset(tmp_dir, partitioning="hive")
+            table = dataset.to_table(filter=pds.field("year") == 2022)
+            self.assertEqual(
+                table.num_rows,
+                sum(
+                    (pd.to_datetime(ds["time"].values).year == 2022).sum()
+                    for ds in datasets
+                ),
+            )
+
+
+class TimeSliceTests(unittest.TestCase):
+    def assert_time_slice(self, df, df_sliced, time, time_slice):
+        start = pd.Timestamp(time_slice.start)
+        end = pd.Timestamp(time_slice.stop) + pd.Timedelta("1D")
+        time = pd.to_datetime(time, utc=True).dt.tz_localize(None)
+        expected = df.loc[(time >= start) & (time < end)].reset_index(drop=True)
+        self.assertGreater(len(expected), 0)
+        pd.testing.assert_frame_equal(
+            df_sliced.reset_index(drop=True), expected, check_dtype=False
+        )
+
+    def test_onset_time_slice(self):
+        time_slice = slice("2022-01-04", "2022-01-06")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = shutil.copy(
+                "tests/parsers_test_files/onset/tidbit_v2/QU5_Mooring_60m_20392474_20220222.csv",
+                tmp_dir,
+            )
+            df = read.onset.csv(path, output="dataframe")
+            df_sliced = read.onset.csv(
+                path, output="dataframe", time_slice=time_slice, index_every=100
+            )
+            self.assert_time_slice(df, df_sliced, df["time"], time_slice)
+
+            # The sidecar index is reused
+            index_path = path + read.utils.FILE_INDEX_SUFFIX
+            self.assertTrue(os.path.exists(index_path))
+            index_modified = os.path.getmtime(index_path)
+            read.onset.csv(path, time_slice=time_slice, index_every=100)
+            self.assertEqual(os.path.getmtime(index_path), index_modified)
+
+    def test_onset_unsorted_time_slice(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = shutil.copy(
+                "tests/parsers_test_files/onset/tidbit_v2/QU5_Mooring_15m_20392468_20210803.csv",
+                tmp_dir,
+            )
+            with open(path, "a") as f:
+                f.write("5897,06/16/21 02:35:28 PM,32.587,,,,\n")
+            with self.assertRaises(RuntimeError):
+                read.onset.csv(
+                    path, time_slice=slice("2021-06-20", "2021-06-21"), index_every=1
+                )
+
+    def test_cnv_time_slice(self):
+        time_slice = slice("2022-05-17 11:22:00", "2022-05-17 11:22:30")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = shutil.copy(
+                "tests/parsers_test_files/seabird/1_datCnv_SBE19plus_01907674_2022_05_17_0002.cnv",
+                tmp_dir,
+            )
+            df, header = read.seabird.cnv(path, output="dataframe")
+            df_sliced, _ = read.seabird.cnv(
+                path, output="dataframe", time_slice=time_slice, index_every=50
+            )
+            time = read.seabird.get_seabird_time(
+                df["timeS"], "timeS", read.seabird.get_seabird_start_time(header)
+            )
+            # Partial date strings include the whole period (the full second)
+            end = pd.Timestamp(time_slice.stop) + pd.Timedelta("1s")
+            expected = df.loc[
+                (time >= time_slice.start) & (time < end)
+            ].reset_index(drop=True)
+            self.assertTrue(0 < len(expected) < len(df))
+            pd.testing.assert_frame_equal(df_sliced, expected)
+
+
+class FixedWidthTests(unittest.TestCase):
+    def test_cnv_fixed_width(self):
+        for path in glob("tests/parsers_test_files/seabird/*.cnv"):
+            df, _ = read.seabird.cnv(path, output="dataframe")
+            df_fixed_width, _ = read.seabird.cnv(
+                path, output="dataframe", fixed_width=True
+            )
+            pd.testing.assert_frame_equal(df_fixed_width, df)
+
+    def test_cnv_not_fixed_width(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = shutil.copy(
+                "tests/parsers_test_files/seabird/1_datCnv_SBE19plus_01907674_2022_05_17_0002.cnv",
+                tmp_dir,
+            )
+            with open(path, "rb") as f:
+                lines = f.read().split(b"\n")
+            lines[-2] = b" ".join(lines[-2].split())
+            with open(path, "wb") as f:
+                f.write(b"\n".join(lines))
+            df, _ = read.seabird.cnv(path, output="dataframe")
+            df_fixed_width, _ = read.seabird.cnv(
+                path, output="dataframe", fixed_width=True
+            )
+            pd.testing.assert_frame_equal(df_fixed_width, df)
+
+    def test_btl_fixed_width(self):
+        for path in glob("tests/parsers_test_files/seabird/*.btl"):
+            with open(path) as f:
+                header = read.seabird.parse_seabird_file_header(f)
+                columns = [
+                    var[0].lower() + var[1:] for var in header["bottle_columns"]
+                ] + ["stats"]
+                widths = [10, 12] + [11] * (len(header["bottle_columns"]) - 1)
+                expected = pd.read_fwf(f, widths=widths, names=columns)
+            df = read.seabird._read_btl_fixed_width(path, widths, columns)
+            pd.testing.assert_frame_equal(df, expected)
+
+    def test_parse_fixed_width_floats(self):
+        fields = np.frombuffer(
+            b"  1.5e+01     -2   \n    0.001        \n", dtype=np.uint8
+        )
+        values = read.utils._get_fixed_width_fields(fields, [9, 9])
+        self.assertEqual(
+            read.utils.parse_fixed_width_floats(values).tolist()[0], [15.0, -2.0]
+        )
+        self.assertEqual(read.utils.parse_fixed_width_floats(values)[1, 0], 0.001)
+        self.assertTrue(np.isnan(read.utils.parse_fixed_width_floats(values)[1, 1]))
+
+
+class HeaderOnlyTests(unittest.TestCase):
+    def assert_time_coverage(self, header, time):
+        time = pd.to_datetime(pd.Series(time), utc=True).dt.tz_localize(None)
+        self.assertEqual(header["time_min"], time.min())
+        self.assertEqual(header["time_max"], time.max())
+
+    def test_onset_header_only(self):
+        path = "tests/parsers_test_files/onset/tidbit_v2/QU5_Mooring_15m_20392468_20210803.csv"
+        header = read.onset.csv(path, header_only=True)
+        ds = read.onset.csv(path)
+        self.assertEqual(header["instrument_sn"], ds.attrs["instrument_sn"])
+        self.assertEqual(header["instrument_type"], ds.attrs["instrument_type"])
+        self.assertEqual(header["variables"], list(ds))
+        self.assert_time_coverage(header, ds["time"].values)
+
+    def test_seabird_header_only(self):
+        path = "tests/parsers_test_files/seabird/1_datCnv_SBE19plus_01907674_2022_05_17_0002.cnv"
+        header = read.seabird.cnv(path, header_only=True)
+        df, attrs = read.seabird.cnv(path, output="dataframe")
+        self.assertEqual(header["variables"], list(df))
+        self.assert_time_coverage(
+            header,
+            read.seabird.get_seabird_time(
+                df["timeS"].values, "timeS", read.seabird.get_seabird_start_time(attrs)
+            ),
+        )
+
+        path = "tests/parsers_test_files/seabird/MI18MHDR.btl"
+        header = read.seabird.btl(path, header_only=True)
+        self.assertEqual(header["instrument_sn"], "5553")
+        self.assert_time_coverage(header, read.seabird.btl(path)["time"].values)
+
+    def test_van_essen_header_only(self):
+        path = "tests/parsers_test_files/van_essen_instruments/ctd_divers/VEI_X2427_220223095229_X2427.MON"
+        header = read.van_essen_instruments.MON(path, header_only=True)
+        ds = read.van_essen_instruments.MON(path)
+        self.assertEqual(header["instrument_sn"], ds.attrs["instrument_sn"])
+        self.assertEqual(header["variables"], list(ds)[: len(header["variables"])])
+        self.assert_time_coverage(header, ds["time"].values)
+
+    def test_minidot_header_only(self):
+        for path in glob("tests/parsers_test_files/pme/*.txt"):
+            header = read.pme.minidot_txt(path, header_only=True)
+            ds = read.pme.minidot_txt(path)
+            self.assertEqual(header["instrument_sn"], ds.attrs["instrument_sn"])
+            self.assert_time_coverage(header, ds["time"].values)
+
+    def test_scan_files(self):
+        paths = sorted(glob("tests/parsers_test_files/pme/*.txt")) + ["missing.txt"]
+        inventory = read.utils.scan_files(paths, read.pme.minidot_txt)
+        self.assertEqual(inventory["path"].tolist(), paths[:-1])
+        pd.testing.assert_frame_equal(
+            read.utils.scan_files(paths, read.pme.minidot_txt, max_workers=2),
+            inventory,
+        )
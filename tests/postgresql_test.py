@@ -0,0 +1,504 @@
+from process_ocean_data.tools import postgresql
+import unittest
+from unittest import mock
+import struct
+import threading
+import time
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+
+class CopyCursor:
+    """Stand-in DBAPI cursor reading COPY FROM STDIN files in small reads"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.connection.statements.append(sql)
+        self.results = []
+        self.description = None
+        for pattern, results in self.connection.results.items():
+            if pattern in sql:
+                if isinstance(results, Exception):
+                    raise results
+                self.results = results
+                self.description = [(column,) for column in results]
+
+    def fetchall(self):
+        return self.results
+
+    def fetchone(self):
+        if "WITH upserted" in self.connection.statements[-1]:
+            # All the rows copied in CSV are inserted
+            copied = self.connection.copied[-1]
+            return (0 if isinstance(copied, bytes) else copied.count("\n")), 0
+        return self.results[0]
+
+    def copy_expert(self, sql, file, size=8192):
+        self.connection.statements.append(sql)
+        if self.connection.copy_errors:
+            raise self.connection.copy_errors.pop()
+        pieces = []
+        while True:
+            piece = file.read(size)
+            if not piece:
+                break
+            self.connection.max_read = max(self.connection.max_read, len(piece))
+            pieces.append(piece)
+        self.connection.copied.append(type(piece)().join(pieces))
+
+
+class CopyConnection:
+    """Stand-in DBAPI connection keeping the statements and data copied"""
+
+    def __init__(self, results=None, copy_errors=None):
+        self.copy_errors = copy_errors if copy_errors is not None else []
+        self.statements = []
+        self.copied = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.max_read = 0
+        # Results returned by the statements containing a given pattern
+        self.results = results or {}
+
+    def cursor(self):
+        return CopyCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+class Engine:
+    """Stand-in sqlalchemy engine, give a new connection from the pool if connection is None"""
+
+    def __init__(
+        self, connection=None, results=None, copy_errors=None, connect_errors=None
+    ):
+        self.dbapi_connection = connection
+        self.results = results
+        self.copy_errors = copy_errors if copy_errors is not None else []
+        self.connect_errors = connect_errors if connect_errors is not None else []
+        self.connections = []
+
+    def raw_connection(self):
+        if self.connect_errors:
+            raise self.connect_errors.pop()
+        if self.dbapi_connection:
+            return self.dbapi_connection
+        connection = CopyConnection(self.results, self.copy_errors)
+        self.connections.append(connection)
+        return connection
+
+
+class SQLAlchemyConnection:
+    """Stand-in sqlalchemy connection handling the transactions of its DBAPI connection"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+def get_timeseries_dataframe(n_time=25000):
+    df = pd.DataFrame(
+        {
+            "time": pd.date_range("2022-01-01", periods=n_time, freq="1s"),
+            "temperature": np.random.normal(10, 1, n_time),
+            "flag": np.random.choice([1, 3, 4], n_time).astype("int32"),
+        }
+    )
+    df.loc[::10, "temperature"] = np.nan
+    return df
+
+
+class CopySourceTests(unittest.TestCase):
+    def test_csv_copy_source(self):
+        df = get_timeseries_dataframe()
+        content = postgresql.CSVCopySource(df, batch_size=1000).read()
+
+        # Reads of any size across batches give back the same content
+        source = postgresql.CSVCopySource(df, batch_size=1000)
+        pieces = [source.read(size) for size in (100, 50000, 1)]
+        pieces.append(source.read())
+        self.assertEqual([len(piece) for piece in pieces[:3]], [100, 50000, 1])
+        self.assertEqual("".join(pieces), content)
+        self.assertEqual(source.read(), "")
+
+        df_read = pd.read_csv(StringIO(content), names=df.columns, parse_dates=["time"])
+        pd.testing.assert_frame_equal(df_read, df, check_dtype=False)
+
+    def test_csv_copy_source_from_rows(self):
+        rows = [(1, "a,b", None), (2, "c", 3.5)]
+        content = postgresql.CSVCopySource(iter(rows), batch_size=1).read()
+        self.assertEqual(content, '1,"a,b",\r\n2,c,3.5\r\n')
+
+    def test_binary_copy_source(self):
+        df = get_timeseries_dataframe(n_time=3)
+        content = postgresql.BinaryCopySource(df, batch_size=2).read()
+
+        self.assertTrue(content.startswith(postgresql.PGCOPY_HEADER))
+        self.assertTrue(content.endswith(postgresql.PGCOPY_TRAILER))
+        position = len(postgresql.PGCOPY_HEADER)
+        for row in df.itertuples(index=False):
+            self.assertEqual(struct.unpack_from(">h", content, position), (3,))
+            position += 2
+            # Microseconds since 2000-01-01
+            self.assertEqual(struct.unpack_from(">iq", content, position)[0], 8)
+            self.assertEqual(
+                struct.unpack_from(">iq", content, position)[1],
+                (row.time - pd.Timestamp("2000-01-01")) // pd.Timedelta("1us"),
+            )
+            position += 12
+            # Missing values have a length of -1
+            if np.isnan(row.temperature):
+                self.assertEqual(struct.unpack_from(">i", content, position), (-1,))
+                position += 4
+            else:
+                self.assertEqual(
+                    struct.unpack_from(">id", content, position), (8, row.temperature)
+                )
+                position += 12
+            self.assertEqual(
+                struct.unpack_from(">ii", content, position), (4, row.flag)
+            )
+            position += 8
+        self.assertEqual(content[position:], postgresql.PGCOPY_TRAILER)
+
+
+class CopyUpsertTests(unittest.TestCase):
+    def test_copy_upsert(self):
+        df = get_timeseries_dataframe()
+        conn = CopyConnection()
+        counts = postgresql.copy_upsert(
+            df,
+            "sensors.timeseries",
+            conn,
+            distinct_columns=["time"],
+            batch_size=1000,
+            commit_every=10000,
+        )
+
+        self.assertEqual(counts, {"inserted": len(df), "updated": 0})
+        self.assertEqual(conn.commits, 3)
+        self.assertEqual(len(conn.copied), 3)
+        # Data is streamed in batches instead of one full CSV
+        self.assertLessEqual(conn.max_read, 8192)
+        df_copied = pd.read_csv(
+            StringIO("".join(conn.copied)), names=df.columns, parse_dates=["time"]
+        )
+        pd.testing.assert_frame_equal(df_copied, df, check_dtype=False)
+        self.assertIn(
+            'INSERT INTO sensors.timeseries ("time", "temperature", "flag") '
+            'SELECT "time", "temperature", "flag" FROM tmp_table '
+            'ON CONFLICT ("time") DO UPDATE SET ("time", "temperature", "flag") = '
+            'ROW(EXCLUDED."time", EXCLUDED."temperature", EXCLUDED."flag") '
+            "RETURNING (xmax = 0) AS inserted",
+            conn.statements[2],
+        )
+
+    def test_binary_copy_upsert(self):
+        df = get_timeseries_dataframe(n_time=100)
+        conn = CopyConnection()
+        postgresql.copy_upsert(df, "timeseries", conn, copy_format="binary")
+        self.assertIn("WITH (FORMAT binary)", conn.statements[1])
+        self.assertEqual(conn.copied[0], postgresql.BinaryCopySource(df).read())
+        self.assertEqual(conn.commits, 1)
+
+    def test_copy_upsert_rollback(self):
+        df = get_timeseries_dataframe(n_time=100)
+        conn = CopyConnection(copy_errors=[RuntimeError("timeout")])
+        with self.assertRaises(RuntimeError):
+            postgresql.copy_upsert(df, "timeseries", conn, commit_every=50)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(conn.commits, 0)
+
+    def test_update_database_table_commit(self):
+        df = get_timeseries_dataframe(n_time=10).assign(station="QU5")
+        for conn in (
+            Engine(CopyConnection(CATALOG_RESULTS)),
+            SQLAlchemyConnection(CopyConnection(CATALOG_RESULTS)),
+        ):
+            counts = postgresql.update_database_table(
+                df, "timeseries", conn, commit_every=5
+            )
+            self.assertEqual(counts, {"inserted": 10, "updated": 0})
+            dbapi_conn = getattr(conn, "dbapi_connection", None) or conn.connection
+            self.assertEqual(dbapi_conn.commits, 2)
+            postgresql.clear_table_info_cache()
+
+    def test_update_database_table_within_connection(self):
+        conn = CopyConnection(CATALOG_RESULTS)
+        df = get_timeseries_dataframe(n_time=10).assign(station="QU5")
+        counts = postgresql.update_database_table(
+            df, "timeseries", SQLAlchemyConnection(conn), commit_every=5, commit=False
+        )
+
+        # The caller's transaction is never committed
+        self.assertEqual(counts, {"inserted": 10, "updated": 0})
+        self.assertEqual(conn.commits, 0)
+        self.assertEqual(
+            [sql for sql in conn.statements if sql.startswith("DROP TABLE")],
+            ["DROP TABLE tmp_table"] * 2,
+        )
+
+
+CATALOG_RESULTS = {
+    "information_schema.columns": [
+        ("id",),
+        ("station",),
+        ("time",),
+        ("temperature",),
+        ("flag",),
+    ],
+    "pg_index": [
+        ("timeseries_pkey", True, "id"),
+        ("timeseries_station_time_key", False, "station"),
+        ("timeseries_station_time_key", False, "time"),
+    ],
+}
+
+
+class TableInfoTests(unittest.TestCase):
+    def tearDown(self):
+        postgresql.clear_table_info_cache()
+
+    def test_get_table_info_from_catalog(self):
+        conn = CopyConnection(CATALOG_RESULTS)
+        engine = Engine(conn)
+        table_info = postgresql.get_table_info(engine, "timeseries")
+        self.assertEqual(
+            table_info,
+            {
+                "columns": ["id", "station", "time", "temperature", "flag"],
+                "primary_key": ["id"],
+                "unique_keys": [["station", "time"]],
+            },
+        )
+        # The table is never read and the results are cached per connection
+        self.assertFalse(any("timeseries" in sql for sql in conn.statements))
+        n_statements = len(conn.statements)
+        postgresql.get_table_info(engine, "timeseries")
+        self.assertEqual(len(conn.statements), n_statements)
+
+    def test_get_table_info_fallback(self):
+        conn = CopyConnection(
+            {
+                "information_schema.columns": RuntimeError("permission denied"),
+                "LIMIT 0": ["time", "temperature"],
+            }
+        )
+        table_info = postgresql.get_table_info(Engine(conn), "timeseries", "sensors")
+        self.assertEqual(table_info["columns"], ["time", "temperature"])
+        self.assertEqual(
+            conn.statements[-1], "SELECT * FROM sensors.timeseries LIMIT 0"
+        )
+        self.assertEqual(conn.rollbacks, 1)
+
+    def test_get_table_info_within_transaction(self):
+        conn = CopyConnection(
+            {
+                "information_schema.columns": RuntimeError("permission denied"),
+                "LIMIT 0": ["time", "temperature"],
+            }
+        )
+        table_info = postgresql.get_table_info(conn, "timeseries")
+        self.assertEqual(table_info["columns"], ["time", "temperature"])
+
+        # Only the catalog queries are rolled back
+        self.assertEqual(conn.rollbacks, 0)
+        self.assertEqual(conn.statements[0], "SAVEPOINT get_table_info")
+        self.assertEqual(
+            conn.statements[2:],
+            [
+                "ROLLBACK TO SAVEPOINT get_table_info",
+                "RELEASE SAVEPOINT get_table_info",
+                "SELECT * FROM timeseries LIMIT 0",
+            ],
+        )
+
+    def test_update_database_table_conflict_target(self):
+        conn = CopyConnection(CATALOG_RESULTS)
+        df = get_timeseries_dataframe(n_time=10).set_index("time")
+        df["station"] = "QU5"
+        df["extra"] = 1
+        postgresql.update_database_table(df, "timeseries", Engine(conn))
+
+        # The primary key isn't available, use the unique key
+        self.assertIn(
+            'COPY tmp_table ("station", "time", "temperature", "flag")',
+            conn.statements[-2],
+        )
+        self.assertIn('ON CONFLICT ("station", "time")', conn.statements[-1])
+        self.assertEqual(
+            pd.read_csv(StringIO(conn.copied[0]), header=None).shape, (10, 4)
+        )
+
+
+class LoadPartitionsTests(unittest.TestCase):
+    def tearDown(self):
+        postgresql.clear_table_info_cache()
+
+    def test_load_partitions(self):
+        df = pd.concat(
+            [
+                get_timeseries_dataframe(n_time=3 * 24 * 30).assign(station=station)
+                for station in ("QU5", "QU24")
+            ]
+        )
+        df["time"] = (
+            pd.date_range("2022-01-01", periods=len(df) // 2, freq="H").tolist() * 2
+        )
+        engine = Engine(results=CATALOG_RESULTS, copy_errors=[RuntimeError("timeout")])
+        summary = postgresql.load_partitions(
+            df,
+            "timeseries",
+            engine,
+            partition_by=["station"],
+            time_column="time",
+            max_workers=2,
+            retry_delay=0,
+        )
+
+        self.assertEqual(len(summary), 6)
+        self.assertEqual(summary["rows"].sum(), len(df))
+        self.assertEqual(summary["inserted"].sum(), len(df))
+        self.assertEqual(summary["attempts"].sum(), 7)
+        self.assertTrue(summary["error"].isnull().all())
+        self.assertEqual(
+            summary.loc[(0, "QU24", pd.Period("2022-02", "M")), "rows"], 28 * 24
+        )
+        copy_statements = [
+            sql
+            for conn in engine.connections
+            for sql in conn.statements
+            if sql.startswith("COPY")
+        ]
+        self.assertEqual(len(set(copy_statements)), 6)
+
+    def test_load_partitions_failure(self):
+        engine = Engine(
+            results=CATALOG_RESULTS, copy_errors=[RuntimeError("timeout")] * 3
+        )
+        summary = postgresql.load_partitions(
+            get_timeseries_dataframe(n_time=10), "timeseries", engine, retry_delay=0
+        )
+        self.assertEqual(summary["attempts"].tolist(), [3])
+        self.assertEqual(str(summary["error"].iloc[0]), "timeout")
+        self.assertEqual(sum(conn.rollbacks for conn in engine.connections), 3)
+
+    def test_load_partitions_connection_retry(self):
+        engine = Engine(results=CATALOG_RESULTS)
+        postgresql.get_table_info(engine, "timeseries")
+        engine.connect_errors = [RuntimeError("connection refused")]
+        summary = postgresql.load_partitions(
+            get_timeseries_dataframe(n_time=10), "timeseries", engine, retry_delay=0
+        )
+        self.assertEqual(summary["attempts"].tolist(), [2])
+        self.assertTrue(summary["error"].isnull().all())
+
+    def test_load_partitions_bounded_submissions(self):
+        n_loading = []
+        lock = threading.Lock()
+        state = {"read": 0, "loaded": 0}
+
+        def iter_dataframes():
+            for _ in range(10):
+                with lock:
+                    state["read"] += 1
+                yield get_timeseries_dataframe(n_time=10)
+
+        def load_partition(engine, df, table_name, partition_id, *args, **kwargs):
+            time.sleep(0.01)
+            with lock:
+                n_loading.append(state["read"] - state["loaded"])
+                state["loaded"] += 1
+            if partition_id == 3:
+                raise RuntimeError("unexpected")
+            return {"inserted": len(df), "updated": 0, "attempts": 1, "error": None}
+
+        with mock.patch.object(postgresql, "_load_partition", load_partition):
+            summary = postgresql.load_partitions(
+                iter_dataframes(),
+                "timeseries",
+                Engine(results=CATALOG_RESULTS),
+                max_workers=1,
+                max_pending=2,
+            )
+        self.assertLessEqual(max(n_loading), 3)
+        # A failed partition doesn't hide the others
+        self.assertEqual(summary.index.get_level_values(0).tolist(), list(range(10)))
+        self.assertEqual(str(summary.loc[3, "error"].iloc[0]), "unexpected")
+        self.assertEqual(summary["inserted"].sum(), 90)
+
+
+class ChangedRowsTests(unittest.TestCase):
+    def setUp(self):
+        self.df = get_timeseries_dataframe(n_time=1000)
+        self.df["time"] = self.df["time"].dt.tz_localize("UTC")
+        # Existing rows: the first 900 rows with 10 of them modified
+        self.df_existing = self.df.iloc[:900].copy()
+        self.df_existing.loc[5::90, "temperature"] += 1
+
+    def test_get_changed_rows(self):
+        rows = [
+            (time.to_pydatetime(), temperature, flag)
+            for time, temperature, flag in self.df_existing.itertuples(index=False)
+        ]
+        conn = CopyConnection({'FROM timeseries WHERE "time" BETWEEN': rows})
+        df_changed = postgresql.get_changed_rows(self.df, "timeseries", conn, ["time"])
+        self.assertEqual(
+            df_changed.index.tolist(), list(range(5, 900, 90)) + list(range(900, 1000))
+        )
+
+    def test_get_changed_rows_from_hash_column(self):
+        hashes = postgresql.get_row_hashes(self.df_existing)
+        rows = list(zip(self.df_existing["time"].dt.to_pydatetime(), hashes))
+        conn = CopyConnection({"FROM timeseries WHERE": rows})
+        df_changed = postgresql.get_changed_rows(
+            self.df, "timeseries", conn, ["time"], hash_column="row_hash"
+        )
+        self.assertEqual(len(df_changed), 110)
+        self.assertIn('SELECT "time", "row_hash" FROM timeseries', conn.statements[0])
+        self.assertEqual(
+            df_changed["row_hash"].tolist(),
+            postgresql.get_row_hashes(self.df.loc[df_changed.index]).tolist(),
+        )
+
+    def test_get_changed_rows_with_null_hashes(self):
+        hashes = postgresql.get_row_hashes(self.df_existing).tolist()
+        # Rows written without hash, ex: by load_partitions
+        hashes[:100] = [None] * 100
+        rows = list(zip(self.df_existing["time"].dt.to_pydatetime(), hashes))
+        conn = CopyConnection({"FROM timeseries WHERE": rows})
+        df_changed = postgresql.get_changed_rows(
+            self.df, "timeseries", conn, ["time"], hash_column="row_hash"
+        )
+        self.assertEqual(
+            df_changed.index.tolist(),
+            list(range(100)) + list(range(185, 900, 90)) + list(range(900, 1000)),
+        )
+        self.assertIn('SELECT "time", "row_hash" FROM timeseries', conn.statements[0])
+
+    def test_update_unchanged_rows(self):
+        rows = [tuple(row) for row in self.df.itertuples(index=False)]
+        results = {**CATALOG_RESULTS, "FROM timeseries WHERE": rows}
+        results["pg_index"] = [("timeseries_pkey", True, "time")]
+        conn = CopyConnection(results)
+        counts = postgresql.update_database_table(
+            self.df, "timeseries", Engine(conn), only_changed=True
+        )
+        self.assertEqual(counts, {"inserted": 0, "updated": 0})
+        self.assertEqual(conn.copied, [])
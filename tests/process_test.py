@@ -0,0 +1,375 @@
+from process_ocean_data.tools import figures, process
+import unittest
+import tempfile
+import tracemalloc
+import os
+import json
+import importlib.util
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+CTD_QC_CONFIG_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "process_ocean_data",
+    "qc_config",
+    "seabird_ctd_time_series.json",
+)
+
+
+def get_synthetic_adcp_dataset(n_time=20000, n_distance=50):
+    """Generate an ADCP like dataset with in air records at both ends of the deployment"""
+    n_air = n_time // 10
+    pressure = np.full(n_time, 10.0) + np.random.normal(0, 0.01, n_time)
+    pressure[:n_air] = 0
+    pressure[-n_air:] = 0
+    ds = xr.Dataset(
+        coords={
+            "time": pd.date_range("2022-01-01", periods=n_time, freq="1min"),
+            "distance": np.arange(n_distance) + 0.5,
+        }
+    )
+    ds["PRESPR01"] = ("time", pressure)
+    for beam in range(1, 5):
+        ds[f"CMAGZZ0{beam}"] = (
+            ("time", "distance"),
+            np.random.uniform(0, 128, (n_time, n_distance)),
+        )
+    return ds
+
+
+class DetectStartEndTests(unittest.TestCase):
+    def test_detect_start_end(self):
+        ds = get_synthetic_adcp_dataset()
+        n_air = len(ds["time"]) // 10
+        results = process.detect_start_end(ds, "time", "PRESPR01", plot_results=False)
+
+        # First good record follows the first in water record
+        self.assertEqual(results["cut_lead_ensembles"], n_air + 1)
+        self.assertEqual(results["cut_trail_ensembles"], n_air + 1)
+        self.assertEqual(
+            results["first_good_record_time"].values, ds["time"].values[n_air + 1]
+        )
+        self.assertEqual(
+            results["last_good_record_time"].values, ds["time"].values[-n_air - 1]
+        )
+        self.assertEqual(results["pressure_offset_deployment"].values, 0)
+        self.assertEqual(results["pressure_offset_retrieval"].values, 0)
+        self.assertAlmostEqual(
+            float(results["instrument_depth"]),
+            ds["PRESPR01"][n_air + 1 : -n_air].mean().values,
+        )
+
+    def test_detect_start_end_memory(self):
+        ds = get_synthetic_adcp_dataset()
+        is_good_data = (ds["CMAGZZ01"] > 64).any("distance")
+
+        tracemalloc.start()
+        process.detect_start_end(
+            ds, "time", "PRESPR01", is_good_data, plot_results=False
+        )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # The full dataset should never be copied
+        self.assertLess(peak, ds["CMAGZZ01"].nbytes)
+
+    def test_detect_start_end_batch(self):
+        datasets = {
+            f"instrument_{id}": get_synthetic_adcp_dataset(n_time=1000 * id)
+            for id in range(1, 4)
+        }
+        df = process.detect_start_end_batch(datasets)
+
+        self.assertEqual(df.index.tolist(), list(datasets.keys()))
+        for instrument, ds in datasets.items():
+            results = process.detect_start_end(
+                ds, "time", "PRESPR01", plot_results=False
+            )
+            for key, value in results.items():
+                self.assertEqual(df.loc[instrument, key], value)
+
+    def test_detect_start_end_batch_without_results(self):
+        ds = get_synthetic_adcp_dataset(n_time=1000, n_distance=2)
+        ds["PRESPR01"][:] = 0
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            figure_path = os.path.join(tmp_dir, "summary.png")
+            with self.assertLogs(process.logger, "WARNING"):
+                df = process.detect_start_end_batch(
+                    [ds], plot_results=True, figure_path=figure_path
+                )
+            self.assertFalse(os.path.exists(figure_path))
+        self.assertTrue(df.loc[0].isna().all())
+
+
+def get_synthetic_ctd_dataframe(n_time=5000, variables=("TEMPS901", "CNDCST01")):
+    """Generate a CTD like dataframe with spikes, flat lines and missing values"""
+    df = pd.DataFrame(
+        {
+            "time": pd.date_range("2022-01-01", periods=n_time, freq="10s"),
+            "depth": np.full(n_time, 5.0),
+        }
+    )
+    for var in variables:
+        values = np.cumsum(np.random.normal(0, 0.01, n_time)) + 10
+        values[np.random.randint(0, n_time, 50)] += 5
+        values[np.random.randint(0, n_time, 20)] = np.nan
+        values[1000:3500] = values[1000]
+        df[var] = values
+    return df
+
+
+class QartodTests(unittest.TestCase):
+    def test_chunked_qartod(self):
+        with open(CTD_QC_CONFIG_PATH) as f:
+            config = json.load(f)
+        config = {var: config[var] for var in ("TEMPS901", "CNDCST01")}
+        df = get_synthetic_ctd_dataframe()
+
+        df_full = process.run_qartod(df.copy(), config)
+        df_chunked = process.run_qartod(df.copy(), config, chunk_size=700)
+        flag_columns = [col for col in df_full if col.endswith("_test")]
+
+        self.assertEqual(len(flag_columns), 8)
+        self.assertEqual(len(df_full), len(df))
+        for col in flag_columns:
+            self.assertEqual(df_chunked[col].dtype, np.int8)
+            self.assertTrue((df_full[col] == df_chunked[col]).all(), col)
+
+        ds = process.run_qartod(
+            df.set_index("time").to_xarray(), config, chunk_size=700
+        )
+        for col in flag_columns:
+            self.assertTrue((ds[col].values == df_full[col].values).all(), col)
+            self.assertEqual(ds[col].dtype, np.int8)
+            self.assertEqual(sorted(ds[col].attrs["flag_values"]), [1, 2, 3, 4, 9])
+            self.assertTrue(ds[col].attrs["standard_name"].endswith("_quality_flag"))
+            self.assertIn(col, ds[col.split("_")[0]].attrs["ancillary_variables"])
+
+        # Chunks with a different median time interval than the full time series
+        df["time"] = pd.to_datetime(
+            np.concatenate(
+                [
+                    pd.date_range("2022-01-01", periods=2000, freq="10s"),
+                    pd.date_range("2022-01-02", periods=3000, freq="30s"),
+                ]
+            )
+        )
+        df_full = process.run_qartod(df.copy(), config)
+        df_chunked = process.run_qartod(df.copy(), config, chunk_size=700)
+        for col in flag_columns:
+            self.assertTrue((df_full[col] == df_chunked[col]).all(), col)
+
+    def test_parallel_qartod(self):
+        with open(CTD_QC_CONFIG_PATH) as f:
+            config = json.load(f)
+        config = {var: config[var] for var in ("TEMPS901", "CNDCST01")}
+        df = get_synthetic_ctd_dataframe(n_time=2000)
+        df_sequential = process.run_qartod(df.copy(), config)
+        for executor in ("thread", "process"):
+            df_parallel = process.run_qartod(
+                df.copy(), config, max_workers=2, executor=executor
+            )
+            self.assertTrue(df_parallel.equals(df_sequential), executor)
+
+
+class FigureQueueTests(unittest.TestCase):
+    def test_deferred_start_end_figures(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            figure_queue = figures.FigureQueue(dpi=50, max_workers=2)
+            figure_paths = [os.path.join(tmp_dir, f"{id}.png") for id in range(3)]
+            for figure_path in figure_paths:
+                process.detect_start_end(
+                    get_synthetic_adcp_dataset(n_time=1000, n_distance=2),
+                    "time",
+                    "PRESPR01",
+                    figure_path=figure_path,
+                    figure_queue=figure_queue,
+                )
+            self.assertEqual(len(figure_queue), 3)
+            self.assertFalse(any(os.path.exists(path) for path in figure_paths))
+
+            self.assertEqual(sorted(figure_queue.render()), figure_paths)
+            self.assertTrue(all(os.path.exists(path) for path in figure_paths))
+
+    def test_disabled_figure_queue(self):
+        figure_queue = figures.FigureQueue(enabled=False)
+        process.detect_start_end_batch(
+            [get_synthetic_adcp_dataset(n_time=1000, n_distance=2)],
+            plot_results=True,
+            figure_queue=figure_queue,
+        )
+        self.assertEqual(len(figure_queue), 0)
+        self.assertEqual(figure_queue.render(), [])
+
+
+def get_synthetic_adcp_l1_dataset(n_time=20000, n_distance=50):
+    """Generate an ADCP L1 like dataset with velocity flags and a tide signal"""
+    ds = xr.Dataset(
+        coords={
+            "time": pd.date_range("2022-01-01", periods=n_time, freq="1min"),
+            "distance": np.arange(n_distance) + 0.5,
+        },
+        attrs={"beam_angle": "20", "cellSize": 1.0},
+    )
+    pressure = 30 + 2 * np.sin(np.arange(n_time) / 745 * 2 * np.pi)
+    pressure[:10] = 0
+    ds["PPSAADCP"] = ("time", pressure)
+    ds["depth"] = -(ds["distance"] - ds["PPSAADCP"])
+    for var in process.ADCP_VELOCITY_FLAG_VARIABLES:
+        flags = np.random.choice([np.nan, 0, 3], (n_distance, n_time))
+        ds[var] = (("distance", "time"), flags, {"long_name": var})
+    return ds
+
+
+def flag_adcp_surface_and_side_lobe_chained(ds):
+    """Chained flagging previously used by process_hakai_adcp"""
+    for var in process.ADCP_VELOCITY_FLAG_VARIABLES:
+        ds[var] = ds[var].where(ds["depth"] > 0, other=4)
+    side_lobe_coefficient = 1 - np.cos(np.deg2rad(int(ds.attrs["beam_angle"])))
+    side_lobe_depth = ds["PPSAADCP"] * side_lobe_coefficient + ds.attrs["cellSize"]
+    for var in process.ADCP_VELOCITY_FLAG_VARIABLES:
+        ds[var] = ds[var].where((ds["depth"] > side_lobe_depth), other=4)
+        ds[var] = ds[var].where(ds["depth"] > 0, other=4)
+        ds[var] = ds[var].where(ds[var].notnull(), other=1)
+    return ds
+
+
+class AdcpFlagTests(unittest.TestCase):
+    def test_flag_adcp_surface_and_side_lobe(self):
+        ds = get_synthetic_adcp_l1_dataset()
+        ds_expected = flag_adcp_surface_and_side_lobe_chained(ds.copy())
+        ds_flagged = process.flag_adcp_surface_and_side_lobe(ds.copy())
+
+        for var in process.ADCP_VELOCITY_FLAG_VARIABLES:
+            self.assertEqual(ds_flagged[var].dtype, np.int8)
+            self.assertEqual(ds_flagged[var].dims, ("distance", "time"))
+            self.assertEqual(ds_flagged[var].attrs, ds[var].attrs)
+            self.assertTrue((ds_flagged[var] == ds_expected[var]).all(), var)
+
+    @unittest.skipUnless(importlib.util.find_spec("dask"), "dask is not installed")
+    def test_chunked_adcp_flags_to_netcdf(self):
+        ds = get_synthetic_adcp_l1_dataset(n_time=20000, n_distance=10)
+        ds_expected = process.flag_adcp_surface_and_side_lobe(ds.copy())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ds.to_netcdf(os.path.join(tmp_dir, "L1.nc"))
+            chunks = {"time": 5000}
+            with xr.open_dataset(os.path.join(tmp_dir, "L1.nc"), chunks=chunks) as ds:
+                ds = process.flag_adcp_surface_and_side_lobe(ds)
+                for var in process.ADCP_VELOCITY_FLAG_VARIABLES:
+                    self.assertIsNotNone(ds[var].chunks, var)
+                ds.to_netcdf(
+                    os.path.join(tmp_dir, "L1_Hakai.nc"),
+                    encoding=process.get_chunked_netcdf_encoding(ds, chunks),
+                )
+
+            with xr.open_dataset(os.path.join(tmp_dir, "L1_Hakai.nc")) as ds_saved:
+                for var in process.ADCP_VELOCITY_FLAG_VARIABLES:
+                    self.assertEqual(ds_saved[var].encoding["chunksizes"], (10, 5000))
+                    self.assertTrue(ds_saved[var].encoding["zlib"])
+                    self.assertTrue((ds_saved[var] == ds_expected[var]).all(), var)
+
+    def test_chunked_netcdf_encoding_keeps_dtype(self):
+        ds = get_synthetic_adcp_l1_dataset(n_time=20000, n_distance=10)
+        ds["PPSAADCP"].encoding = {"dtype": "int16", "_FillValue": -32768}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ds.to_netcdf(os.path.join(tmp_dir, "L1.nc"))
+            with xr.open_dataset(os.path.join(tmp_dir, "L1.nc")) as ds:
+                encoding = process.get_chunked_netcdf_encoding(ds)
+                ds.to_netcdf(os.path.join(tmp_dir, "L1_Hakai.nc"), encoding=encoding)
+
+            with xr.open_dataset(os.path.join(tmp_dir, "L1_Hakai.nc")) as ds_saved:
+                self.assertEqual(ds_saved["PPSAADCP"].encoding["dtype"], np.int16)
+                self.assertEqual(ds_saved["PPSAADCP"].encoding["_FillValue"], -32768)
+                # In memory variables are split in bounded time chunks
+                self.assertEqual(ds_saved["PPSAADCP"].encoding["chunksizes"], (20000,))
+                self.assertEqual(
+                    ds_saved["LCEWAP01_QC"].encoding["chunksizes"], (10, 3276)
+                )
+
+
+class OutputEncodingTests(unittest.TestCase):
+    def setUp(self):
+        ds = get_synthetic_adcp_l1_dataset(n_time=20000, n_distance=10)
+        self.ds = process.flag_adcp_surface_and_side_lobe(ds)
+        # Velocity at the instrument resolution and a precise position
+        velocity = np.round(np.random.normal(0, 0.3, (10, 20000)), 3)
+        self.ds["LCEWAP01"] = (("distance", "time"), velocity)
+        self.ds["latitude"] = 50.123456789
+
+    def test_output_encoding(self):
+        encoding = process.get_output_encoding(self.ds, chunk_bytes=2**16)
+        self.assertEqual(encoding["LCEWAP01_QC"]["dtype"], "int8")
+        self.assertEqual(encoding["LCEWAP01"]["dtype"], "float32")
+        # Time chunks with the full extent of the other dimensions
+        self.assertEqual(encoding["LCEWAP01"]["chunksizes"], (10, 1638))
+        self.assertEqual(encoding["PPSAADCP"]["chunksizes"], (16384,))
+        self.assertNotIn("latitude", encoding)
+
+        encoding = process.get_output_encoding(self.ds, atol=None)
+        self.assertNotIn("dtype", encoding["LCEWAP01"])
+
+        # Packed variables keep the encoding they were read with
+        self.ds["PPSAADCP"].encoding = {
+            "dtype": "int16",
+            "scale_factor": 0.01,
+            "_FillValue": -32768,
+        }
+        encoding = process.get_output_encoding(self.ds)
+        self.assertEqual(encoding["PPSAADCP"]["dtype"], "int16")
+        self.assertEqual(encoding["PPSAADCP"]["scale_factor"], 0.01)
+        self.assertEqual(encoding["PPSAADCP"]["_FillValue"], -32768)
+
+    def test_save_dataset(self):
+        formats = ["netcdf"]
+        if importlib.util.find_spec("zarr"):
+            formats.append("zarr")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "default.nc")
+            self.ds.to_netcdf(path)
+            default_size = os.path.getsize(path)
+
+            for output_format in formats:
+                path = os.path.join(tmp_dir, f"L1.{output_format[:3]}")
+                process.save_dataset(
+                    self.ds, path, output_format, atol={"LCEWAP01": 1e-4}
+                )
+                opener = xr.open_zarr if output_format == "zarr" else xr.open_dataset
+                with opener(path) as ds_saved:
+                    self.assertEqual(ds_saved["LCEWAP01_QC"].dtype, np.int8)
+                    self.assertEqual(ds_saved["LCEWAP01"].dtype, np.float32)
+                    self.assertEqual(ds_saved["PPSAADCP"].dtype, np.float64)
+                    np.testing.assert_allclose(
+                        ds_saved["LCEWAP01"], self.ds["LCEWAP01"], atol=1e-4
+                    )
+                    self.assertTrue(
+                        (ds_saved["LCEWAP01_QC"] == self.ds["LCEWAP01_QC"]).all()
+                    )
+                if output_format == "netcdf":
+                    self.assertLess(os.path.getsize(path), default_size / 2)
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("zarr") and importlib.util.find_spec("dask"),
+        "zarr or dask is not installed",
+    )
+    def test_save_dask_dataset_to_zarr(self):
+        ds = get_synthetic_adcp_l1_dataset(n_time=20000, n_distance=40)
+        ds = process.flag_adcp_surface_and_side_lobe(ds).chunk({"time": 5000})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "L1.zarr")
+            process.save_dataset(ds, path, chunk_bytes=2**16)
+            with xr.open_zarr(path) as ds_saved:
+                # Every variable shares the smallest time chunk
+                time_chunks = {
+                    ds_saved[var].encoding["chunks"][ds_saved[var].dims.index("time")]
+                    for var in ds_saved.data_vars
+                }
+                self.assertEqual(len(time_chunks), 1)
+                self.assertLess(time_chunks.pop(), 1638)
+                # Dask variables aren't computed to check the float32 precision
+                self.assertEqual(ds_saved["PPSAADCP"].dtype, np.float64)
+                self.assertEqual(ds_saved["LCEWAP01_QC"].dtype, np.int8)
+                for var in ("PPSAADCP", "LCEWAP01_QC"):
+                    self.assertTrue((ds_saved[var] == ds[var]).all().compute(), var)
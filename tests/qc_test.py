@@ -0,0 +1,284 @@
+from process_ocean_data.tools import qc
+import unittest
+import tempfile
+import os
+
+import ipywidgets
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import xarray as xr
+
+
+class AggregateFlagsTests(unittest.TestCase):
+    def test_aggregate_qartod_flags(self):
+        df = pd.DataFrame(
+            {
+                f"var_qartod_test{id}": np.random.choice([1, 2, 3, 4, 9], 1000)
+                for id in range(5)
+            }
+        ).astype("int8")
+        expected = [qc.compare_flags(row, "QARTOD") for row in df.values]
+
+        flags = qc.aggregate_flags(df, "QARTOD")
+        self.assertEqual(flags.dtype, np.int8)
+        self.assertEqual(flags.tolist(), expected)
+
+    def test_aggregate_hakai_flags(self):
+        df = pd.DataFrame(
+            {
+                f"flag{id}": np.random.choice(["AV", "SVC", "SVD", "MV", "PV"], 1000)
+                for id in range(5)
+            }
+        )
+        expected = [qc.compare_flags(list(row), "HAKAI") for row in df.values]
+        self.assertEqual(qc.aggregate_flags(df, "HAKAI").tolist(), expected)
+
+    def test_aggregate_unknown_flags(self):
+        flags = qc.aggregate_flags([np.array([0, 1, 200]), np.array([-1, 3, 0])], "QARTOD")
+        self.assertEqual(flags.tolist(), [9, 3, 9])
+
+    def test_aggregate_integer_flags_with_string_convention(self):
+        flags = qc.aggregate_flags([np.array([1, 3]), np.array([4, 1])], "HAKAI")
+        self.assertEqual(flags.tolist(), ["NaN", "NaN"])
+
+    def test_map_qartod_to_hakai(self):
+        flags = qc.map_flags(np.array([1, 2, 3, 4, 9, 5], dtype="int8"))
+        self.assertEqual(flags.tolist(), ["AV", "MV", "SVC", "SVD", "NaN", None])
+
+
+class FlagStorageTests(unittest.TestCase):
+    def test_flag_categorical(self):
+        flags = np.random.choice(["AV", "SVC", "SVD", "MV"], 100000).astype(object)
+        flags_categorical = qc.to_flag_categorical(flags, "HAKAI")
+
+        self.assertEqual(flags_categorical.codes.dtype, np.int8)
+        self.assertEqual(flags_categorical.astype(object).tolist(), flags.tolist())
+        self.assertGreaterEqual(
+            pd.Series(flags).memory_usage() / pd.Series(flags_categorical).memory_usage(),
+            7,
+        )
+
+    def test_flags_netcdf_round_trip(self):
+        hakai_flags = qc.to_flag_categorical(["AV", "SVC", None, "SVD", "AV"], "HAKAI")
+        qartod_flags = np.array([1, 3, 4, 9, 2], dtype="int8")
+        ds = xr.Dataset(
+            {
+                "hakai_flag": qc.flags_to_dataarray(hakai_flags, "HAKAI"),
+                "qartod_flag": qc.flags_to_dataarray(qartod_flags, "QARTOD"),
+            }
+        )
+        self.assertEqual(ds["qartod_flag"].values.tolist(), qartod_flags.tolist())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "flags.nc")
+            ds.to_netcdf(path)
+            with xr.open_dataset(path) as ds_read:
+                self.assertEqual(ds_read["hakai_flag"].dtype, np.int8)
+                self.assertEqual(ds_read["qartod_flag"].dtype, np.int8)
+                self.assertEqual(
+                    ds_read["qartod_flag"].attrs["flag_meanings"],
+                    "MISSING UNKNOWN GOOD SUSPECT FAIL",
+                )
+                self.assertTrue(
+                    qc.flags_from_dataarray(ds_read["hakai_flag"]).equals(hakai_flags)
+                )
+                self.assertEqual(
+                    qc.flags_from_dataarray(ds_read["qartod_flag"]).tolist(),
+                    qartod_flags.tolist(),
+                )
+
+    def test_aggregate_categorical_flags(self):
+        flags = np.random.choice(["AV", "SVC", "SVD", "MV"], (1000, 3))
+        columns = [qc.to_flag_categorical(flags[:, id], "HAKAI") for id in range(3)]
+        self.assertEqual(
+            qc.aggregate_flags(columns, "HAKAI").tolist(),
+            qc.aggregate_flags(flags, "HAKAI").tolist(),
+        )
+
+
+class DownsampleTests(unittest.TestCase):
+    def setUp(self):
+        self.time = pd.Series(pd.date_range("2022-01-01", periods=100000, freq="1s"))
+        self.values = np.cumsum(np.random.normal(0, 1, 100000))
+        self.values[[10, 5000, 99000]] = [1000, -1000, np.nan]
+
+    def test_downsample_minmax(self):
+        index = qc.downsample_minmax(self.time, self.values, 500)
+        self.assertLessEqual(len(index), 1000)
+        self.assertTrue((np.diff(index) > 0).all())
+        # Extremes are always kept and missing values dropped
+        self.assertIn(10, index)
+        self.assertIn(5000, index)
+        self.assertNotIn(99000, index)
+
+    def test_downsample_lttb(self):
+        index = qc.downsample_lttb(self.time, self.values, 1000)
+        self.assertEqual(len(index), 1000)
+        self.assertTrue((np.diff(index) > 0).all())
+        self.assertIn(10, index)
+        self.assertIn(5000, index)
+        self.assertEqual([index[0], index[-1]], [0, 99999])
+
+    def test_get_selector_mask(self):
+        class Selector:
+            type = "box"
+            xrange = ["2022-01-01 00:00:10", "2022-01-01 00:00:19"]
+            yrange = [-2000, 2000]
+
+        mask = qc.get_selector_mask(self.time, self.values, Selector)
+        self.assertEqual(np.flatnonzero(mask).tolist(), list(range(10, 20)))
+
+        Selector.type = "lasso"
+        Selector.xs = [-0.5, 99.5, 99.5, -0.5]
+        Selector.ys = [-2000, -2000, 2000, 2000]
+        mask = qc.get_selector_mask(np.arange(100000), self.values, Selector)
+        self.assertEqual(np.flatnonzero(mask).tolist(), list(range(100)))
+
+
+def get_interface_widgets(interface):
+    """Retrieve the figure and the buttons and dropdowns of the manual qc interface"""
+    widgets = [interface]
+    for widget in widgets:
+        widgets += getattr(widget, "children", ())
+    figure = [widget for widget in widgets if isinstance(widget, go.FigureWidget)][0]
+    controls = {
+        widget.description.split("\n")[0]: widget
+        for widget in widgets
+        if isinstance(widget, (ipywidgets.Button, ipywidgets.Dropdown))
+    }
+    return figure, controls
+
+
+class ManualQCInterfaceTests(unittest.TestCase):
+    def setUp(self):
+        n_time = 10000
+        self.df = pd.DataFrame(
+            {
+                "time": pd.date_range("2022-01-01", periods=n_time, freq="1s"),
+                "depth": np.ones(n_time),
+                "TEMP": np.random.normal(10, 1, n_time),
+            }
+        )
+        # Duplicated records
+        self.df.loc[5, ["time", "TEMP"]] = self.df.loc[6, ["time", "TEMP"]]
+
+    def test_flag_selected_records(self):
+        interface = qc.manual_qc_interface(
+            self.df, ["TEMP"], "QARTOD", default_flag=2
+        )
+        figure, controls = get_interface_widgets(interface)
+        self.assertEqual([len(trace.x) for trace in figure.data], [0, 10000, 0, 0, 0])
+
+        figure.data[1].selectedpoints = [6, 100, 101]
+        controls["Apply Flag"].click()
+        flagged = np.flatnonzero(self.df["TEMP_review_flag"] == 1)
+        self.assertEqual(flagged.tolist(), [6, 100, 101])
+        self.assertEqual(figure.data[0].customdata.tolist(), [6, 100, 101])
+
+    def test_incremental_trace_updates(self):
+        interface = qc.manual_qc_interface(
+            self.df, ["TEMP"], "QARTOD", default_flag=2
+        )
+        figure, controls = get_interface_widgets(interface)
+        for trace_id, points, flag in (
+            (1, range(0, 5000, 3), 3),
+            (2, range(0, 500), 4),
+            (1, range(0, 1000), 3),
+        ):
+            figure.data[trace_id].selectedpoints = list(points)
+            controls["QARTOD"].value = flag
+            controls["Apply Flag"].click()
+        self.assertEqual(self.df["TEMP_review_flag"].value_counts()[4], 500)
+
+        # Traces updated incrementally match a full redraw of the figure
+        redrawn, _ = get_interface_widgets(
+            qc.manual_qc_interface(self.df, ["TEMP"], "QARTOD", default_flag=2)
+        )
+        for trace, redrawn_trace in zip(figure.data, redrawn.data):
+            self.assertEqual(
+                trace.customdata.tolist(), redrawn_trace.customdata.tolist()
+            )
+            self.assertEqual(list(trace.y), list(redrawn_trace.y))
+
+    def test_review_journal(self):
+        # Journal records are identified by index labels and not positions
+        self.df.index = self.df.index * 2 + 100
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            journal_path = os.path.join(tmp_dir, "review.jsonl")
+            interface = qc.manual_qc_interface(
+                self.df,
+                ["TEMP"],
+                "QARTOD",
+                default_flag=2,
+                journal_path=journal_path,
+                reviewer="tester",
+            )
+            figure, controls = get_interface_widgets(interface)
+            for trace_id, points, flag in (
+                (1, range(0, 5000, 3), 3),
+                (2, range(0, 500), 4),
+            ):
+                figure.data[trace_id].selectedpoints = list(points)
+                controls["QARTOD"].value = flag
+                controls["Apply Flag"].click()
+
+            journal = qc.read_qc_journal(journal_path)
+            self.assertEqual([len(record["index"]) for record in journal], [1667, 500])
+            self.assertEqual(journal[0]["reviewer"], "tester")
+
+            df_reviewed = self.df[["time", "depth", "TEMP"]].copy()
+            df_reviewed["TEMP_review_flag"] = 2
+            qc.apply_qc_journal(df_reviewed, journal_path)
+            self.assertEqual(
+                df_reviewed["TEMP_review_flag"].tolist(),
+                self.df["TEMP_review_flag"].tolist(),
+            )
+
+
+class StackDataFrameVariablesTests(unittest.TestCase):
+    def setUp(self):
+        n_time = 1000
+        self.df = pd.DataFrame(
+            {
+                "time": pd.date_range("2022-01-01", periods=n_time, freq="1s"),
+                "station": pd.Categorical(np.random.choice(["QU5", "QU24"], n_time)),
+                "TEMP": np.random.normal(10, 1, n_time),
+                "SAL": np.random.normal(30, 1, n_time),
+            }
+        )
+        self.df.loc[::7, "SAL"] = np.nan
+
+    def test_stack_dataframe_variables(self):
+        expected = (
+            self.df.set_index(["time", "station"])[["TEMP", "SAL"]]
+            .stack()
+            .rename_axis(["time", "station", "variable"])
+            .rename("value")
+            .reset_index()
+        )
+        df_stacked = qc.stack_dataframe_variables(
+            self.df, ["TEMP", "SAL"], "variable", "value"
+        )
+        self.assertEqual(df_stacked["variable"].dtype, "category")
+        self.assertEqual(df_stacked["station"].dtype, "category")
+        pd.testing.assert_frame_equal(
+            df_stacked.astype({"variable": str}), expected, check_categorical=False
+        )
+
+    def test_iter_stack_dataframe_variables(self):
+        df_stacked = qc.stack_dataframe_variables(
+            self.df, ["TEMP", "SAL"], "variable", "value", keep=["time"]
+        )
+        chunks = list(
+            qc.iter_stack_dataframe_variables(
+                self.df,
+                ["TEMP", "SAL"],
+                "variable",
+                "value",
+                keep=["time"],
+                chunk_size=300,
+            )
+        )
+        self.assertEqual(len(chunks), 4)
+        pd.testing.assert_frame_equal(pd.concat(chunks), df_stacked)